@@ -20,10 +20,400 @@ You should have received a copy of the GNU General Public License
 along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
 import os
+import re
+from multiprocessing import Pool
 from random import sample as rsample
 
 
+# number of set bits of an int (int.bit_count needs Python 3.10)
+popcount = getattr(int, 'bit_count', lambda value: bin(value).count('1'))
+
+# leading bytes of the compressed formats that are read transparently
+COMPRESSION_MAGIC = ((b'\x1f\x8b', gzip.open),
+                     (b'BZh', bz2.open),
+                     (b'\xfd7zXZ\x00', lzma.open))
+
+# binary alignment cache (--alignment-cache): the magic line, the length
+# of the JSON header (8 bytes), the header, the sequence matrix (one byte
+# or, for at most 16 different characters, one nibble per site) and the
+# valid-site bitset of every sequence
+ALIGNMENT_CACHE_MAGIC = b'QSALNCACHE1\n'
+HEX_DIGITS = b'0123456789abcdef'
+
+# uncompressed sequential PHYLIP and FASTA files of at least this size
+# are loaded in parallel chunks when several threads are used
+PARALLEL_LOAD_MIN_SIZE = 1 << 26
+PARALLEL_CHUNKS_PER_PROC = 4
+
+NEXUS_COMMENT = re.compile(r'\[[^\]]*\]')
+NEXUS_NCHAR = re.compile(r'NCHAR\s*=\s*(\d+)', re.IGNORECASE)
+NEXUS_INTERLEAVE = re.compile(r'INTERLEAVE(\s*=\s*(\w+))?', re.IGNORECASE)
+
+
+def compression_opener(fpath):
+    """Open function of the compression format of the file, or None"""
+    with open(fpath, 'rb') as infile:
+        magic = infile.read(6)
+    for prefix, opener in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+def open_alignment(fpath):
+    """Open an alignment file as text, decompressing gzip, bzip2 and xz
+       files on the fly (detected from the file contents)
+    """
+    opener = compression_opener(fpath)
+    if opener is not None:
+        stream = opener(fpath, 'rb')
+        if not hasattr(stream, 'name'):
+            stream.name = fpath
+        return io.TextIOWrapper(stream)
+    return open(fpath, 'r')
+
+
+def read_sequences(alnfile):
+    """Iterate over the (name, sequence) records of an alignment in
+       relaxed PHYLIP (sequential or interleaved), FASTA or NEXUS format,
+       detected from the first line
+    """
+    for line in alnfile:
+        if not line.strip():
+            continue
+        if line[0] == '>':
+            return read_fasta(line, alnfile)
+        if line.strip().upper().startswith('#NEXUS'):
+            return read_nexus(alnfile)
+        return read_phylip(line, alnfile)
+    return iter([])
+
+
+def read_fasta(firstline, alnfile):
+    """Records of a FASTA file (sequences may span several lines)"""
+    name = firstline[1:].split()[0]
+    chunks = []
+    for line in alnfile:
+        if line[0] == '>':
+            yield name, ''.join(chunks)
+            name = line[1:].split()[0]
+            chunks = []
+        else:
+            chunks.append(''.join(line.split()))
+    yield name, ''.join(chunks)
+
+
+def read_phylip(firstline, alnfile):
+    """Records of a relaxed PHYLIP file.  Sequential files (one unbroken
+       sequence per line) are streamed; interleaved files are recognized
+       by a first sequence shorter than the header length and are
+       collected over all blocks before the records are returned.
+    """
+    header = firstline.split()
+    try:
+        ntaxa, nsites = int(header[0]), int(header[1])
+    except (IndexError, ValueError):
+        ntaxa, nsites = None, None
+    names = []
+    chunks = []
+    nlines = 0
+    for line in alnfile:
+        entry = line.split()
+        if not chunks:
+            if len(entry) < 2:
+                continue
+            sequence = ''.join(entry[1:])
+            if names or nsites is None or len(sequence) >= nsites:
+                yield entry[0], sequence
+                names.append(entry[0])
+                continue
+        elif not entry:
+            continue
+        if nlines < ntaxa:
+            # first block, the lines start with the taxon names
+            names.append(entry[0])
+            chunks.append([''.join(entry[1:])])
+        else:
+            chunks[nlines % ntaxa].append(''.join(entry))
+        nlines += 1
+    for name, seqchunks in zip(names, chunks):
+        yield name, ''.join(seqchunks)
+
+
+def read_nexus(alnfile):
+    """Records of the DATA (or CHARACTERS) block of a NEXUS file.
+       Sequences that are not interleaved are streamed, interleaved
+       matrices are collected before the records are returned.
+    """
+    nsites = None
+    interleaved = False
+    in_matrix = False
+    name = None
+    chunks = []
+    seqs = {}
+    for line in alnfile:
+        line = NEXUS_COMMENT.sub('', line)
+        if not in_matrix:
+            words = line.upper().split()
+            if not words:
+                continue
+            if words[0] == 'DIMENSIONS' and NEXUS_NCHAR.search(line):
+                nsites = int(NEXUS_NCHAR.search(line).group(1))
+            elif words[0] == 'FORMAT' and NEXUS_INTERLEAVE.search(line):
+                interleaved = (
+                    NEXUS_INTERLEAVE.search(line).group(2) or
+                    'YES').upper() != 'NO'
+            elif words[0] == 'MATRIX':
+                in_matrix = True
+            continue
+        finished = ';' in line
+        entry = line.split(';')[0].split()
+        if entry:
+            if (not interleaved and name is not None and
+                    nsites is not None and
+                    sum(len(x) for x in chunks) < nsites):
+                # continuation of a wrapped sequence
+                chunks.append(''.join(entry))
+            else:
+                if name is not None and not interleaved:
+                    yield name, ''.join(chunks)
+                name = entry[0].strip("'\"")
+                chunks = [''.join(entry[1:])]
+                if interleaved:
+                    seqs.setdefault(name, []).append(chunks[0])
+        if finished:
+            break
+    if interleaved:
+        for seqname, seqchunks in seqs.items():
+            yield seqname, ''.join(seqchunks)
+    elif name is not None:
+        yield name, ''.join(chunks)
+
+
+class SequenceMatrix(object):
+    """Sequences of equal length stored as the rows of one contiguous
+       byte matrix (taxa x sites) with a name to row index.  The matrix
+       is kept in memory, or written to a scratch file that is
+       memory-mapped once loading is finished (--low-mem).
+       Indexing by name returns the sequence string.
+    """
+
+    def __init__(self, nsites, fpath=None):
+        self.nsites = nsites
+        self.rows = {}
+        self.fpath = fpath
+        self.outfile = None
+        self.data = bytearray()
+        # offset of the matrix in self.data
+        self.base = 0
+        if fpath is not None:
+            self.outfile = open(fpath, 'wb')
+
+    def append(self, name, sequence):
+        """Add the next row"""
+        self.rows[name] = len(self.rows)
+        row = sequence.encode('ascii', 'replace')
+        if self.outfile is not None:
+            self.outfile.write(row)
+        else:
+            self.data += row
+        return ''
+
+    def finish(self):
+        """Map the scratch file after the last row was added"""
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+            if self.rows and self.nsites:
+                with open(self.fpath, 'rb') as infile:
+                    self.data = mmap.mmap(infile.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        return ''
+
+    def attach(self, rows, data, base=0):
+        """Use rows that are already stored in data (e.g. a mapped file),
+           rows maps the names to the row numbers
+        """
+        self.rows = rows
+        self.data = data
+        self.base = base
+        return ''
+
+    def row(self, name, start=0, end=None):
+        """Bytes of the sequence (or of the columns start:end)"""
+        offset = self.base + self.rows[name] * self.nsites
+        end = self.nsites if end is None else end
+        return self.data[offset + start:offset + end]
+
+    def __getitem__(self, name):
+        return self.row(name).decode('ascii')
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class PackedSequenceMatrix(SequenceMatrix):
+    """Read-only SequenceMatrix of an alignment with at most 16 different
+       characters, stored as one nibble (the index in the alphabet) per
+       site with every row padded to whole bytes.
+    """
+
+    def __init__(self, nsites, names, alphabet, data, base):
+        SequenceMatrix.__init__(self, nsites)
+        self.rows = dict((name, i) for i, name in enumerate(names))
+        self.data = data
+        self.base = base
+        self.stride = (nsites + 1) // 2
+        self.decode_table = bytes.maketrans(HEX_DIGITS[:len(alphabet)],
+                                            alphabet)
+
+    def row(self, name, start=0, end=None):
+        """Bytes of the sequence (or of the columns start:end)"""
+        end = self.nsites if end is None else end
+        offset = self.base + self.rows[name] * self.stride
+        nibbles = self.data[offset + start // 2:
+                            offset + (end + 1) // 2].hex()
+        return nibbles[start % 2:start % 2 + end - start].encode(
+            'ascii').translate(self.decode_table)
+
+
+def next_record_start(infile, offset, fasta):
+    """File position of the first record starting at or after offset
+       (a line start for PHYLIP, a '>' line for FASTA), None at the end
+    """
+    marker = b'\n>' if fasta else b'\n'
+    # the byte before offset is included so a record starting exactly
+    # at offset is found
+    infile.seek(offset - 1)
+    position = offset - 1
+    tail = b''
+    while True:
+        block = infile.read(1 << 20)
+        if not block:
+            return None
+        found = (tail + block).find(marker)
+        if found >= 0:
+            return position - len(tail) + found + 1
+        position += len(block)
+        tail = block[-1:]
+
+
+def chunk_bounds(fpath, start, fasta, nchunks):
+    """Split the records from start to the end of the file into about
+       nchunks byte ranges that begin and end at record boundaries
+    """
+    size = os.path.getsize(fpath)
+    step = max((size - start) // nchunks, 1)
+    bounds = []
+    with open(fpath, 'rb') as infile:
+        while start < size:
+            end = size
+            if start + step < size:
+                end = next_record_start(infile, start + step, fasta) or size
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def chunk_records(fpath, start, end, fasta):
+    """(name, sequence) byte records of a chunk of a sequential PHYLIP
+       or FASTA file
+    """
+    with open(fpath, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    if fasta:
+        for record in data[1:].split(b'\n>'):
+            header, _, sequence = record.partition(b'\n')
+            yield header.split()[0], b''.join(sequence.split())
+    else:
+        for line in data.split(b'\n'):
+            entry = line.split()
+            if len(entry) > 1:
+                yield entry[0], b''.join(entry[1:])
+
+
+def load_chunk(fpath, start, end, fasta, first_row, nsites, valid_table,
+               matrix_path):
+    """Parse a chunk (run in a worker process): the sequences are written
+       to their rows of the matrix file, the names, lengths and valid
+       sites are returned for the checks in the main process
+    """
+    records = []
+    with open(matrix_path, 'r+b') as outfile:
+        for row, (name, sequence) in enumerate(
+                chunk_records(fpath, start, end, fasta), first_row):
+            if len(sequence) == nsites:
+                os.pwrite(outfile.fileno(), sequence, row * nsites)
+            sitebits = sequence.translate(valid_table)
+            records.append((name.decode('ascii', 'replace'), len(sequence),
+                            int(sitebits or b'0', 2), sitebits.count(b'1')))
+    return records
+
+
+def pack_row(row, encode_table):
+    """Nibble-pack a row (see PackedSequenceMatrix)"""
+    nibbles = row.translate(encode_table)
+    if len(nibbles) % 2:
+        nibbles += b'0'
+    return bytes.fromhex(nibbles.decode('ascii'))
+
+
+def alignment_cache_key(fpath, data_type):
+    """Identify the input of an alignment cache by the size and
+       modification time of the alignment file and a hash of its first
+       and last MB (hashing all of a very large alignment would take
+       about as long as parsing it)
+    """
+    fstat = os.stat(fpath)
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as infile:
+        digest.update(infile.read(1 << 20))
+        if fstat.st_size > 1 << 21:
+            infile.seek(-(1 << 20), os.SEEK_END)
+            digest.update(infile.read())
+    return {'size': fstat.st_size, 'mtime_ns': fstat.st_mtime_ns,
+            'sha256': digest.hexdigest(), 'data_type': data_type}
+
+
+class GeneView(object):
+    """The columns start:end of a SequenceMatrix, used for the genes of
+       --genetrees without copying the sequences.
+       Indexing by name returns the gene sequence string.
+    """
+
+    def __init__(self, matrix, start, end):
+        self.matrix = matrix
+        self.start = start
+        self.end = end
+
+    def __getitem__(self, name):
+        return self.matrix.row(name, self.start, self.end).decode('ascii')
+
+    def __contains__(self, name):
+        return name in self.matrix
+
+    def __iter__(self):
+        return iter(self.matrix)
+
+    def __len__(self):
+        return len(self.matrix)
+
+
 class Alignment(object):
     """Alignment object containing all sequences.
        Read the alignment into a dict,
@@ -34,7 +424,10 @@ class Alignment(object):
         self.length = 0
         self.seqs = {}
         self.partitions = {}
+        # bitset (int) of the valid sites of each sequence and its count
+        # (the first site is the most significant bit)
         self.valid_sites = {}
+        self.valid_counts = {}
         self.min_overlap = params['min_overlap']
         self.valid_chars = 'AaCcGgTtUu'
         self.invalid_chars = "NnXx-?"
@@ -47,111 +440,265 @@ class Alignment(object):
                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
                 'abcdefghijklmnopqrstuvwxyz')
             self.invalid_chars = "-?"
+        # maps every byte to b'1' (valid character) or b'0'
+        self.valid_table = bytes(49 if chr(i) in self.valid_chars else 48
+                                 for i in range(256))
+        self.invalid_table = bytes(49 if chr(i) in self.invalid_chars
+                                   else 48 for i in range(256))
         self.genes = []
 
     def read_align(self, alnfile, params):
         """Read the full alingment"""
         print("reading alignment from {}".format(alnfile.name))
-        firstline = True
         firstentry = True
         self.min_overlap = params['min_overlap']
-        for line in alnfile:
-            if line[0] == ">":
-                raise IOError("ERROR: The alignment file appears to be FASTA "
-                              "formatted!  Please use the utils/fasta2phy.py "
-                              "script to convert it to PHYLIP.")
-            if firstline:
-                firstline = False
-                continue
-            entry = line.split()
-            if len(entry) > 1:
-                if entry[0] in self.seqs:
-                    raise RuntimeError(
-                        "Sequence label {} is duplicate".format(
-                            entry[0]))
-                if params['low_mem'] is True:
-                    sfilepath = os.path.join(
-                        params['temp_wd'],
-                        "seqtemp.{}.phy".format(entry[0]))
-                    self.seqs[entry[0]] = sfilepath[:]
-                    with open(sfilepath, 'w') as sfile:
-                        sfile.write(entry[1])
-                else:
-                    self.seqs[entry[0]] = entry[1]
-                if firstentry:
-                    self.length = len(entry[1])
-                    firstentry = False
-                else:
-                    if len(entry[1]) != self.length:
-                        raise RuntimeError(
-                            "Sequence '{}' is not the same length({})"
-                            "as the first sequence ({})".format(
-                                entry[0], len(entry[1]), self.length))
-                    validchars, invalidchars = (
-                        self.count_valid_chars(entry[1]))
-                    if params['verbose']:
-                        print(entry[0], "has ",
-                              validchars, "valid sites and",
-                              invalidchars, "invalid sites")
+        cache_path = None
+        if params['alignment_cache']:
+            cache_path = "{}.qscache".format(alnfile.name)
+            cache_key = alignment_cache_key(alnfile.name, params['data_type'])
+            if self.read_cache(cache_path, cache_key):
+                alnfile.close()
+                for seqname, validchars in self.valid_counts.items():
                     if validchars < self.min_overlap:
-                        print("WARNING: Sequence {} has {}"
-                              "valid sequence characters,"
-                              "which is less than the minimum overlap"
-                              "all quartets including this taxon"
-                              "will be rejected!".format(entry[0],
-                                                         validchars))
+                        self.warn_low_overlap(seqname, validchars)
+                return ''
+        if self.read_parallel(alnfile.name, params):
+            if cache_path is not None:
+                self.write_cache(cache_path, cache_key)
+            alnfile.close()
+            return ''
+        for entry in read_sequences(alnfile):
+            if entry[0] in self.seqs:
+                raise RuntimeError(
+                    "Sequence label {} is duplicate".format(
+                        entry[0]))
+            if firstentry:
+                # one contiguous matrix for all sequences, on disk
+                # (memory-mapped) for --low-mem
+                self.seqs = SequenceMatrix(
+                    len(entry[1]),
+                    os.path.join(params['temp_wd'], "alignment.matrix")
+                    if params['low_mem'] is True else None)
+            elif len(entry[1]) != self.length:
+                raise RuntimeError(
+                    "Sequence '{}' is not the same length({})"
+                    "as the first sequence ({})".format(
+                        entry[0], len(entry[1]), self.length))
+            self.seqs.append(entry[0], entry[1])
+            sitebits = self.valid_site_bits(entry[1])
+            self.valid_sites[entry[0]] = int(sitebits or b'0', 2)
+            self.valid_counts[entry[0]] = sitebits.count(b'1')
+            if firstentry:
+                self.length = len(entry[1])
+                firstentry = False
+            else:
+                validchars = self.valid_counts[entry[0]]
+                if params['verbose']:
+                    print(entry[0], "has ",
+                          validchars, "valid sites and",
+                          self.count_valid_chars(entry[1])[1],
+                          "invalid sites")
+                if validchars < self.min_overlap:
+                    self.warn_low_overlap(entry[0], validchars)
+        if firstentry is False:
+            self.seqs.finish()
+            if cache_path is not None:
+                self.write_cache(cache_path, cache_key)
         alnfile.close()
         return ''
 
+    def read_parallel(self, fpath, params):
+        """Load a large uncompressed sequential PHYLIP or FASTA file in
+           byte-range chunks parsed by worker processes, which write the
+           sequences straight into a shared matrix file in the temp dir
+           (mapped afterwards).  The label and length checks are done
+           here over all chunks.  Returns False if the file is not
+           suited for this (then it is read line by line).
+        """
+        if (params['nprocs'] < 2 or
+                os.path.getsize(fpath) < PARALLEL_LOAD_MIN_SIZE or
+                compression_opener(fpath) is not None):
+            return False
+        with open(fpath, 'rb') as infile:
+            firstline = infile.readline()
+            while firstline and not firstline.strip():
+                firstline = infile.readline()
+            fasta = firstline.startswith(b'>')
+            start = infile.tell()
+            if fasta:
+                start -= len(firstline)
+                # the length of the first sequence
+                nsites = 0
+                line = infile.readline()
+                while line and not line.startswith(b'>'):
+                    nsites += len(b''.join(line.split()))
+                    line = infile.readline()
+            else:
+                header = firstline.split()
+                if len(header) != 2 or not all(x.isdigit() for x in header):
+                    return False
+                line = infile.readline()
+                while line and len(line.split()) < 2:
+                    line = infile.readline()
+                nsites = len(b''.join(line.split()[1:]))
+                if nsites < int(header[1]):
+                    # interleaved
+                    return False
+        if nsites == 0:
+            return False
+        nchunks = params['nprocs'] * PARALLEL_CHUNKS_PER_PROC
+        bounds = chunk_bounds(fpath, start, fasta, nchunks)
+        print("reading alignment in {} chunks with {} processes".format(
+            len(bounds), params['nprocs']))
+        # every record takes more than nsites bytes, so a chunk has room
+        # for all of its records starting at this row (the unused rows
+        # stay holes of the sparse matrix file)
+        first_rows = [0]
+        for first, last in bounds:
+            first_rows.append(first_rows[-1] + (last - first) // nsites + 1)
+        matrix_path = os.path.join(params['temp_wd'], "alignment.matrix")
+        with open(matrix_path, 'wb') as outfile:
+            outfile.truncate(first_rows[-1] * nsites)
+        with Pool(params['nprocs']) as pool:
+            chunks = pool.starmap(
+                load_chunk,
+                [(fpath, first, last, fasta, first_row, nsites,
+                  self.valid_table, matrix_path)
+                 for (first, last), first_row in zip(bounds, first_rows)])
+        rows = {}
+        for records, first_row in zip(chunks, first_rows):
+            for row, (seqname, length, validsites, validchars) in enumerate(
+                    records, first_row):
+                if seqname in self.valid_sites:
+                    raise RuntimeError(
+                        "Sequence label {} is duplicate".format(seqname))
+                if length != nsites:
+                    raise RuntimeError(
+                        "Sequence '{}' is not the same length({})"
+                        "as the first sequence ({})".format(
+                            seqname, length, nsites))
+                rows[seqname] = row
+                self.valid_sites[seqname] = validsites
+                self.valid_counts[seqname] = validchars
+                if params['verbose']:
+                    print(seqname, "has ", validchars, "valid sites and",
+                          length - validchars, "invalid sites")
+                if validchars < self.min_overlap:
+                    self.warn_low_overlap(seqname, validchars)
+        self.length = nsites
+        self.seqs = SequenceMatrix(nsites)
+        with open(matrix_path, 'rb') as infile:
+            self.seqs.attach(rows, mmap.mmap(infile.fileno(), 0,
+                                             access=mmap.ACCESS_READ))
+        return True
+
+    def warn_low_overlap(self, seqname, validchars):
+        """Warn about a sequence with too few valid characters"""
+        print("WARNING: Sequence {} has {}"
+              "valid sequence characters,"
+              "which is less than the minimum overlap"
+              "all quartets including this taxon"
+              "will be rejected!".format(seqname, validchars))
+        return ''
+
+    def read_cache(self, fpath, key):
+        """Load the alignment from the binary cache written by an earlier
+           run (memory-mapped), returns False if there is no valid cache
+        """
+        if not os.path.exists(fpath):
+            return False
+        with open(fpath, 'rb') as infile:
+            magic = infile.read(len(ALIGNMENT_CACHE_MAGIC))
+            if magic != ALIGNMENT_CACHE_MAGIC:
+                return False
+            header_size = int.from_bytes(infile.read(8), 'big')
+            header = json.loads(infile.read(header_size).decode('utf-8'))
+            if header['key'] != key:
+                return False
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        base = len(ALIGNMENT_CACHE_MAGIC) + 8 + header_size
+        names = header['names']
+        self.length = header['nsites']
+        if header['alphabet'] is None:
+            self.seqs = SequenceMatrix(self.length)
+            self.seqs.attach(dict((name, i) for i, name in enumerate(names)),
+                             data, base)
+            offset = base + self.length * len(names)
+        else:
+            self.seqs = PackedSequenceMatrix(
+                self.length, names, header['alphabet'].encode('latin-1'),
+                data, base)
+            offset = base + self.seqs.stride * len(names)
+        nbytes = (self.length + 7) // 8
+        for name in names:
+            self.valid_sites[name] = int.from_bytes(
+                data[offset:offset + nbytes], 'big')
+            self.valid_counts[name] = popcount(self.valid_sites[name])
+            offset += nbytes
+        print("read the alignment from the cache {}".format(fpath))
+        return True
+
+    def write_cache(self, fpath, key):
+        """Write the binary alignment cache for later runs"""
+        names = list(self.seqs)
+        alphabet = b''
+        for name in names:
+            # only the characters not seen before are collected
+            alphabet += bytes(set(self.seqs.row(name).translate(
+                None, alphabet)))
+            if len(alphabet) > 16:
+                break
+        alphabet = bytes(sorted(alphabet)) if len(alphabet) <= 16 else None
+        header = json.dumps({
+            'key': key, 'nsites': self.length, 'names': names,
+            'alphabet': (None if alphabet is None
+                         else alphabet.decode('latin-1'))}).encode('utf-8')
+        nbytes = (self.length + 7) // 8
+        try:
+            with open(fpath + '.tmp', 'wb') as outfile:
+                outfile.write(ALIGNMENT_CACHE_MAGIC)
+                outfile.write(len(header).to_bytes(8, 'big'))
+                outfile.write(header)
+                if alphabet is None:
+                    for name in names:
+                        outfile.write(self.seqs.row(name))
+                else:
+                    encode_table = bytes.maketrans(
+                        alphabet, HEX_DIGITS[:len(alphabet)])
+                    for name in names:
+                        outfile.write(pack_row(self.seqs.row(name),
+                                               encode_table))
+                for name in names:
+                    outfile.write(self.valid_sites[name].to_bytes(nbytes,
+                                                                  'big'))
+            os.replace(fpath + '.tmp', fpath)
+        except OSError as exc:
+            print("WARNING: could not write the alignment cache "
+                  "{}: {}".format(fpath, exc))
+        return ''
+
     def read_genes(self, alnfile, params):
-        """Read the gene-partitioned alignment"""
+        """Read the gene-partitioned alignment.
+           The genes are column ranges (views) of the full alignment.
+        """
         print("reading gene tree boundaries from {}".format(
             params['genetrees_file_path']))
-        firstline = True
-        firstentry = True
-        self.min_overlap = params['min_overlap']
         with open(params['genetrees_file_path']) as gfile:
             for line in gfile:
                 entry = [x.strip() for x in line.rstrip().split(',')]
                 gname = entry[1].split("=")[0].strip()
                 coords = entry[1].split("=")[1].strip().split('-')
                 self.partitions[gname] = (int(coords[0]), int(coords[1]))
-                self.seqs[gname] = {}
-                self.valid_sites[gname] = {}
                 self.genes.append(gname)
-        print("reading alignment from {}".format(alnfile.name))
-        for line in alnfile:
-            if firstline:
-                firstline = False
-                continue
-            entry = line.split()
-            if len(entry) > 1:
-                if firstentry is True:
-                    self.length = len(entry[1])
-                    firstentry = False
-                elif len(entry[1]) != self.length:
-                    raise RuntimeError(
-                        "Sequence '{}' is not the same length({})"
-                        "as the first sequence ({})".format(
-                            entry[0], len(entry[1]), self.length))
-                validchars, invalidchars = (
-                    self.count_valid_chars(entry[1]))
-                if params['verbose']:
-                    print(entry[0], "has ",
-                          validchars, "valid sites and",
-                          invalidchars, "invalid sites")
-                if validchars < self.min_overlap:
-                    print("WARNING: Sequence {} has {}"
-                          "valid sequence characters,"
-                          "which is less than the minimum overlap"
-                          "all quartets including this taxon"
-                          "will be rejected!".format(entry[0],
-                                                     validchars))
-                for gene in self.partitions:
-                    self.seqs[gene][entry[0]] = (
-                        entry[1][self.partitions[gene][0] - 1:
-                                 self.partitions[gene][1]])
-        alnfile.close()
+        self.read_align(alnfile, params)
+        for gname, (start, end) in self.partitions.items():
+            if not 1 <= start <= end <= self.length:
+                raise RuntimeError(
+                    "Gene '{}' ({}-{}) is outside of the alignment "
+                    "(1-{})".format(gname, start, end, self.length))
+        matrix = self.seqs
+        self.seqs = dict((gname, GeneView(matrix, start - 1, end))
+                         for gname, (start, end) in self.partitions.items())
         return ''
 
     def __str__(self):
@@ -162,51 +709,40 @@ class Alignment(object):
     def count_valid_chars(self, sequence):
         """for getting the overlap between test seqs
         """
-        valid_chars = 0
-        invalid_chars = 0
-        for xchar in sequence:
-            if xchar in self.valid_chars:
-                valid_chars += 1
-            else:
-                invalid_chars += 1
-        return valid_chars, invalid_chars
+        if isinstance(sequence, str):
+            sequence = sequence.encode('ascii', 'replace')
+        valid_chars = sequence.translate(self.valid_table).count(b'1')
+        return valid_chars, len(sequence) - valid_chars
+
+    def valid_site_bits(self, sequence):
+        """Validity of each site of a sequence as b'1'/b'0' characters"""
+        return sequence.encode('ascii', 'replace').translate(
+            self.valid_table)
 
     def check_aln_overlap(self, replicate):
         """Check for alignment overlap
+           (sites valid in all four sequences, using the site bitsets)
         """
-        n_overlap = 0
         seqnames = replicate[0:4]
         min_overlap = 1 if self.min_overlap < 1 else self.min_overlap
         genename = replicate[4]
-        if genename is None:
-            for i in range(len(self.seqs[seqnames[0]])):
-                if self.seqs[seqnames[0]][i] not in self.valid_chars:
-                    continue
-                is_valid_site = True
-                for seqname in seqnames[1:]:
-                    if self.seqs[seqname][i] not in self.valid_chars:
-                        is_valid_site = False
-                        break
-                if is_valid_site:
-                    n_overlap += 1
-                if n_overlap >= min_overlap:
-                    break
-        else:
-            for i in range(len(self.seqs[genename][seqnames[0]])):
-                if (self.seqs[genename][seqnames[0]][i] not in
-                        self.valid_chars):
-                    continue
-                is_valid_site = True
-                for seqname in seqnames[1:]:
-                    if (self.seqs[genename][seqname][i] not in
-                            self.valid_chars):
-                        is_valid_site = False
-                        break
-                if is_valid_site:
-                    n_overlap += 1
-                if n_overlap >= min_overlap:
-                    break
-        return n_overlap >= min_overlap
+        # the overlap cannot exceed the valid sites of any single sequence
+        for seqname in seqnames:
+            if self.valid_counts[seqname] < min_overlap:
+                return False
+        overlap = self.valid_sites[seqnames[0]]
+        for seqname in seqnames[1:]:
+            overlap &= self.valid_sites[seqname]
+            if genename is None and popcount(overlap) < min_overlap:
+                return False
+        if genename is not None:
+            # keep only the bits of the gene's columns
+            start, end = self.partitions[genename]
+            overlap = (overlap >> (self.length - end)) & (
+                (1 << (end - start + 1)) - 1)
+            if popcount(overlap) < min_overlap:
+                return False
+        return True
 
     def get_random_gene(self):
         """get a random gene from the set of genes in seq
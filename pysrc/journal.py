@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8
+"""
+http://www.github.com/FePhyFoFum/quartetsampling
+
+This file is part of 'quartetsampling'.
+
+'quartetsampling' is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+'quartetsampling' is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import signal
+from alignment import alignment_cache_key
+
+
+class RunJournal(object):
+    """Append-only checkpoint journal (one JSON record per line).
+       Records the settings of the run, every completed replicate result
+       and every finished node so an interrupted run can be resumed
+       without repeating any engine work.  The settings include every
+       option that changes the replicate results and a fingerprint of
+       each input file, so a changed run does not resume.
+    """
+
+    def __init__(self, params, input_files):
+        self.fpath = params['journal_file_path']
+        input_files = list(input_files) + [
+            params[x] for x in ('genetrees_file_path',
+                                'partitions_file_path')
+            if params[x] is not None]
+        self.settings = {
+            'engine': params['engine'],
+            'engine_executable': str(params['engine_executable']),
+            'engine_model': params['engine_model'],
+            'data_type': params['data_type'],
+            'lnlikethresh': params['lnlikethresh'],
+            'nreps': params['nreps'],
+            'min_overlap': params['min_overlap'],
+            'compress_patterns': params['compress_patterns'],
+            'max_quartet_enumeration_threshold': (
+                params['max_quartet_enumeration_threshold']),
+            'inputs': [input_fingerprint(x) for x in input_files]}
+        self.node_results = {}
+        self.finished_nodes = set([])
+        self.resuming = False
+        self.truncated = False
+        if params['resume'] and os.path.exists(self.fpath):
+            self.read()
+            self.jfile = open(self.fpath, 'a')
+            if self.truncated:
+                # start clean after a record cut short by a hard kill
+                self.jfile.write("\n")
+        else:
+            self.jfile = open(self.fpath, 'w')
+            self.write({'settings': self.settings})
+
+    def read(self):
+        """Load the records of an earlier run"""
+        self.truncated = False
+        with open(self.fpath, 'r') as jfile:
+            for line in jfile:
+                self.truncated = not line.endswith("\n")
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'settings' in record:
+                    if record['settings'] != self.settings:
+                        raise RuntimeError(
+                            "The journal '{}' was written by a run with "
+                            "different settings, remove it or use "
+                            "--no-resume to start over".format(self.fpath))
+                elif 'result' in record:
+                    self.node_results.setdefault(record['node'], []).append(
+                        record['result'])
+                elif 'finished' in record:
+                    self.finished_nodes.add(record['node'])
+        self.resuming = True
+        print("resuming from '{}': {} nodes finished, {} replicates "
+              "completed".format(
+                  self.fpath, len(self.finished_nodes),
+                  sum(len(x) for x in self.node_results.values())))
+        return ''
+
+    def write(self, record):
+        """Append a single record"""
+        self.jfile.write(json.dumps(record))
+        self.jfile.write("\n")
+        self.jfile.flush()
+        return ''
+
+    def completed(self, node_label):
+        """Replicate results of the node from the earlier run"""
+        return list(self.node_results.get(node_label, []))
+
+    def is_finished(self, node_label):
+        """True if the node was finalized by the earlier run"""
+        return node_label in self.finished_nodes
+
+    def record_result(self, node_label, result):
+        """Record a completed replicate"""
+        return self.write({'node': node_label, 'result': result})
+
+    def record_node(self, node_label, nreplicates):
+        """Record a finished node"""
+        return self.write({'node': node_label, 'finished': nreplicates})
+
+    def close(self, remove=False):
+        """Close the journal, it is removed once the run is complete"""
+        self.jfile.close()
+        if remove:
+            os.remove(self.fpath)
+        return ''
+
+
+def input_fingerprint(fpath):
+    """Path, size, modification time and partial hash of an input file"""
+    key = alignment_cache_key(fpath, None)
+    del key['data_type']
+    key['path'] = os.path.abspath(fpath)
+    return key
+
+
+class StopRequest(object):
+    """Turns the first SIGINT/SIGTERM into a request to stop once the
+       running replicates have been collected; a second signal gets the
+       default behaviour.
+    """
+
+    def __init__(self):
+        self.signum = None
+        self.handlers = {}
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.handlers[signum] = signal.signal(signum, self.request)
+
+    def request(self, signum, _):
+        """Signal handler"""
+        print("\nreceived signal {}, finishing the running replicates "
+              "(repeat to exit immediately)".format(signum))
+        self.signum = signum
+        self.restore()
+
+    def restore(self):
+        """Reinstate the original signal handlers"""
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        return ''
+
+    def is_set(self):
+        """True once a stop was requested"""
+        return self.signum is not None
+
+
+if __name__ == "__main__":
+    print("This file is a function library, please run quartet_sampling.py")
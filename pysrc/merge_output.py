@@ -39,9 +39,10 @@ def generate_argparser():
         description=__doc__,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         epilog=LICENSE)
-    parser.add_argument('--nodedata', required=True, nargs=1,
-                        help=("file containing paths of one or more"
-                              "RESULT.node.score.csv files"))
+    parser.add_argument('--nodedata', required=True, nargs='+',
+                        help=("one or more RESULT.node.scores.csv files "
+                              "(e.g. the outputs of --shard runs), or files "
+                              "containing their paths, one per line"))
     parser.add_argument('--tree', required=True, type=open,
                         nargs=1,
                         help="tree file in Newick format")
@@ -91,9 +92,16 @@ def main(arguments=None):
         })
     mergedata = DataStore(params)
     filepaths = []
-    with open(args.nodedata[0]) as nfile:
-        for line in nfile:
-            filepaths.append(line.strip())
+    for npath in args.nodedata:
+        with open(npath) as nfile:
+            if nfile.readline().startswith("node_label,"):
+                # a score file itself
+                filepaths.append(npath)
+                continue
+            nfile.seek(0)
+            for line in nfile:
+                if line.strip():
+                    filepaths.append(line.strip())
     for fname in filepaths:
         with open(fname, 'r') as infile:
             firstline = True
@@ -151,8 +159,8 @@ def main(arguments=None):
                  'num_replicates': qfreps[xlabel]}
         mergedata.write_entry(params['merged_file_path'], entry)
         entry = {}
-    treedata.write_scoretrees(params)
-    treedata.write_figtree(params['figtree_file_path'], qfscores)
+    mergedata.close()
+    treedata.write_trees(params, qfscores)
     return ''
 
 
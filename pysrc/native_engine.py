@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8
+"""
+Built-in likelihood engine for single quartets (--engine native).
+Evaluates the three unrooted four-taxon topologies with vectorized
+pruning over site patterns, optimizing the five branch lengths and the
+free model parameters separately for each topology.
+Requires NumPy.
+
+http://www.github.com/FePhyFoFum/quartetsampling
+
+This file is part of 'quartetsampling'.
+
+'quartetsampling' is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+'quartetsampling' is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+import math
+import os
+from collections import Counter
+from statistics import NormalDist
+import numpy as np
+
+
+NUC_STATES = 'ACGT'
+NUC_AMBIGUITY = {
+    'U': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT',
+    'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG'}
+# PAML order, as used by empirical matrix files
+AMINO_STATES = 'ARNDCQEGHILKMFPSTWYV'
+AMINO_AMBIGUITY = {'B': 'ND', 'Z': 'QE', 'J': 'IL'}
+# tip order is L1, L2, R1, R2; each topology joins two pairs of tips
+# (matches the trees written by tree_data.write_test_trees)
+TOPOLOGY_PAIRS = {0: ((0, 1), (2, 3)),
+                  1: ((0, 2), (1, 3)),
+                  2: ((0, 3), (1, 2))}
+MIN_BRLEN = 1e-6
+MAX_BRLEN = 10.0
+START_BRLEN = 0.1
+# bounds of the gamma shape and of the other (exchangeability) parameters
+ALPHA_BOUNDS = (0.02, 100.0)
+RATE_BOUNDS = (0.001, 1000.0)
+
+
+class QuartetModel(object):
+    """Substitution model specification parsed from --engine-model.
+       Supported: JC, HKY, GTR (nuc), POISSON or a PAML format matrix
+       file path (amino), MK (cat); '+G' or '+Gn' adds discrete gamma
+       rates and '+F' uses empirical state frequencies.
+    """
+
+    def __init__(self, model_string, data_type):
+        parts = model_string.split('+')
+        self.name = parts[0] if os.path.exists(parts[0]) else (
+            parts[0].upper())
+        self.ncat = 1
+        self.empirical_freqs = False
+        for part in [x.upper() for x in parts[1:]]:
+            if part.startswith('G'):
+                self.ncat = int(part[1:]) if len(part) > 1 else 4
+            elif part == 'F':
+                self.empirical_freqs = True
+            else:
+                raise RuntimeError(
+                    "Model option '+{}' is not supported by the native "
+                    "engine".format(part))
+        self.data_type = data_type
+        self.paml_exchange = None
+        self.paml_freqs = None
+        if data_type == 'nuc':
+            if self.name not in ('JC', 'HKY', 'GTR'):
+                raise RuntimeError(
+                    "Native engine nucleotide models are JC, HKY "
+                    "and GTR, not '{}'".format(self.name))
+            if self.name in ('HKY', 'GTR'):
+                self.empirical_freqs = True
+        elif data_type == 'amino':
+            if os.path.exists(self.name):
+                self.paml_exchange, self.paml_freqs = read_paml_matrix(
+                    self.name)
+            elif self.name not in ('POISSON', 'JC'):
+                raise RuntimeError(
+                    "Native engine amino acid models are POISSON or "
+                    "the path to a PAML format matrix file, "
+                    "not '{}'".format(self.name))
+        elif self.name not in ('MK', 'JC'):
+            raise RuntimeError(
+                "Native engine categorical model is MK, not '{}'".format(
+                    self.name))
+
+    def __str__(self):
+        return "{}{}{}".format(
+            self.name, "+G{}".format(self.ncat) if self.ncat > 1 else "",
+            "+F" if self.empirical_freqs else "")
+
+
+def read_paml_matrix(fpath):
+    """Read a PAML format amino acid matrix: lower triangle of
+       exchangeabilities followed by the equilibrium frequencies
+    """
+    with open(fpath) as mfile:
+        values = [float(x) for x in mfile.read().split()[:210]]
+    if len(values) < 210:
+        raise RuntimeError("{} is not a PAML format amino acid "
+                           "matrix".format(fpath))
+    exchange = np.zeros((20, 20))
+    k = 0
+    for i in range(1, 20):
+        for j in range(i):
+            exchange[i, j] = exchange[j, i] = values[k]
+            k += 1
+    freqs = np.array(values[190:210])
+    return exchange, freqs / freqs.sum()
+
+
+def tip_states(data_type, seqs):
+    """Returns the state alphabet and the tip partial vector for
+       every character found in the quartet
+    """
+    chars = set()
+    for seq in seqs:
+        chars.update(seq.upper())
+    if data_type == 'nuc':
+        states, ambiguity = NUC_STATES, NUC_AMBIGUITY
+    elif data_type == 'amino':
+        states, ambiguity = AMINO_STATES, AMINO_AMBIGUITY
+    else:
+        # Mk model over the states observed in this quartet
+        states = ''.join(sorted(x for x in chars if x not in '-?'))
+        if len(states) < 2:
+            states += '01'.replace(states, '')[:2 - len(states)]
+        ambiguity = {}
+    partials = {}
+    for char in chars:
+        vec = np.zeros(len(states))
+        for state in ambiguity.get(char, char):
+            if state in states:
+                vec[states.index(state)] = 1.0
+        if not vec.any():  # gaps, N, X, ? and unknown characters
+            vec[:] = 1.0
+        partials[char] = vec
+    return states, partials
+
+
+def site_patterns(seqs):
+    """Compress the quartet alignment columns into unique patterns
+       and their weights
+    """
+    counts = Counter(zip(*[seq.upper() for seq in seqs]))
+    patterns = list(counts)
+    weights = np.array([counts[x] for x in patterns], dtype=float)
+    return patterns, weights
+
+
+def gamma_cdf(xval, alpha):
+    """Regularized lower incomplete gamma function P(alpha, x)"""
+    if xval <= 0:
+        return 0.0
+    lnorm = alpha * math.log(xval) - xval - math.lgamma(alpha)
+    if xval < alpha + 1.0:
+        # series representation
+        term = total = 1.0 / alpha
+        denom = alpha
+        for _ in range(1000):
+            denom += 1.0
+            term *= xval / denom
+            total += term
+            if abs(term) < abs(total) * 1e-14:
+                break
+        return total * math.exp(lnorm)
+    # continued fraction for the upper tail (modified Lentz)
+    tiny = 1e-300
+    bval = xval + 1.0 - alpha
+    cval = 1.0 / tiny
+    dval = 1.0 / bval
+    frac = dval
+    for i in range(1, 1000):
+        aval = -i * (i - alpha)
+        bval += 2.0
+        dval = aval * dval + bval
+        dval = tiny if abs(dval) < tiny else dval
+        cval = bval + aval / cval
+        cval = tiny if abs(cval) < tiny else cval
+        dval = 1.0 / dval
+        delta = dval * cval
+        frac *= delta
+        if abs(delta - 1.0) < 1e-14:
+            break
+    return 1.0 - math.exp(lnorm) * frac
+
+
+def gamma_quantile(prob, alpha):
+    """Quantile of the Gamma(alpha, rate=alpha) distribution
+       (Newton steps from the Wilson-Hilferty approximation,
+       safeguarded by bisection)
+    """
+    third = 1.0 / (9.0 * alpha)
+    xval = 1.0 - third + NormalDist().inv_cdf(prob) * math.sqrt(third)
+    if xval > 0:
+        xval = xval ** 3
+    else:
+        # small quantiles: P(alpha, alpha * x) ~ (alpha * x)^alpha /
+        # (alpha * Gamma(alpha))
+        xval = math.exp((math.log(prob * alpha) + math.lgamma(alpha)) /
+                        alpha) / alpha
+    low, high = 0.0, float('inf')
+    lnorm = alpha * math.log(alpha) - math.lgamma(alpha)
+    for _ in range(100):
+        diff = gamma_cdf(xval * alpha, alpha) - prob
+        if diff < 0:
+            low = xval
+        else:
+            high = xval
+        pdf = math.exp(lnorm + (alpha - 1.0) * math.log(xval) -
+                       alpha * xval)
+        step = xval - diff / pdf if pdf > 0 else low - 1.0
+        if not low < step < high:
+            step = (0.5 * (low + high) if high < float('inf')
+                    else 2.0 * xval)
+        if abs(step - xval) < 1e-10 * xval:
+            return step
+        xval = step
+    return xval
+
+
+@functools.lru_cache(maxsize=1024)
+def discrete_gamma_rates(alpha, ncat):
+    """Mean rate of each of ncat equal-probability gamma categories
+       (cached, the quantiles are expensive and alpha values repeat
+       between rounds and topologies)
+    """
+    if ncat < 2:
+        return np.ones(1)
+    bounds = ([0.0] + [gamma_quantile(i / float(ncat), alpha)
+                       for i in range(1, ncat)] + [float('inf')])
+    cdf1 = [1.0 if math.isinf(x) else gamma_cdf(x * alpha, alpha + 1.0)
+            for x in bounds]
+    rates = np.array([(cdf1[i + 1] - cdf1[i]) * ncat for i in range(ncat)])
+    rates /= rates.mean()
+    rates.flags.writeable = False
+    return rates
+
+
+def bfgs_minimize(func, xval, fval, low, high, maxiter=50, tol=1e-4,
+                  step=1e-5, maxstep=1.0):
+    """Quasi-Newton (BFGS) minimization of func over the box [low, high]
+       from xval (where func is fval), with forward-difference gradients.
+       Only steps that decrease func are taken (Armijo backtracking),
+       so the result is never worse than the start.
+    """
+    xval = np.array(xval, dtype=float)
+    nparams = len(xval)
+
+    def gradient(xpos, fpos):
+        grad = np.empty(nparams)
+        for i in range(nparams):
+            shifted = xpos.copy()
+            delta = step if xpos[i] + step <= high[i] else -step
+            shifted[i] += delta
+            grad[i] = (func(shifted) - fpos) / delta
+        return grad
+
+    grad = gradient(xval, fval)
+    hinv = np.eye(nparams)
+    for _ in range(maxiter):
+        direction = -np.dot(hinv, grad)
+        if np.dot(direction, grad) >= 0:
+            hinv = np.eye(nparams)
+            direction = -grad
+        direction *= min(1.0, maxstep / max(np.abs(direction).max(), 1e-300))
+        scale = 1.0
+        while True:
+            newx = np.clip(xval + scale * direction, low, high)
+            newf = func(newx)
+            if newf <= fval + 1e-4 * np.dot(grad, newx - xval):
+                break
+            scale *= 0.5
+            if scale < 1e-6:
+                return xval, fval
+        improved = fval - newf
+        newgrad = gradient(newx, newf)
+        svec = newx - xval
+        yvec = newgrad - grad
+        xval, fval, grad = newx, newf, newgrad
+        if improved < tol:
+            break
+        curvature = np.dot(svec, yvec)
+        if curvature > 1e-10:
+            rho = 1.0 / curvature
+            left = np.eye(nparams) - rho * np.outer(svec, yvec)
+            hinv = (np.dot(np.dot(left, hinv), left.T) +
+                    rho * np.outer(svec, svec))
+    return xval, fval
+
+
+def push(pmats, partial):
+    """Conditional likelihoods at the top of a branch from those at its
+       bottom: (ncat, n, n) transition matrices applied to partials of
+       shape (npatterns, n) or (ncat, npatterns, n)
+    """
+    return np.matmul(partial, pmats.transpose(0, 2, 1))
+
+
+class QuartetLikelihood(object):
+    """Likelihood of one quartet alignment under a QuartetModel"""
+
+    def __init__(self, seqs, model, weights=None):
+        self.model = model
+        states, partials = tip_states(model.data_type, seqs)
+        self.nstates = len(states)
+        if weights is None:
+            patterns, weights = site_patterns(seqs)
+        else:
+            patterns = list(zip(*[seq.upper() for seq in seqs]))
+            weights = np.asarray(weights, dtype=float)
+        self.weights = weights
+        # tip partials, shape (4, npatterns, nstates)
+        self.tips = np.array([[partials[pattern[i]] for pattern in patterns]
+                              for i in range(4)])
+        # equilibrium frequencies
+        if model.paml_freqs is not None and not model.empirical_freqs:
+            self.freqs = model.paml_freqs.copy()
+        elif model.empirical_freqs:
+            # count unambiguous states only, with a small pseudocount
+            counts = np.full(self.nstates, 0.5)
+            for tip in self.tips:
+                exact = tip.sum(axis=1) == 1
+                counts += (tip[exact] * weights[exact, None]).sum(axis=0)
+            self.freqs = counts / counts.sum()
+        else:
+            self.freqs = np.full(self.nstates, 1.0 / self.nstates)
+        # free parameters, optimized on a log scale
+        self.params = {}
+        if model.ncat > 1:
+            self.params['alpha'] = 1.0
+        if model.name == 'HKY':
+            self.params['kappa'] = 2.0
+        elif model.name == 'GTR':
+            for i in range(5):
+                self.params['rate{}'.format(i)] = 1.0
+        self._eigen = None
+        self._alpha = None
+        self._rates = None
+
+    def empirical_params(self, topology):
+        """Starting values of the model parameters, with the HKY/GTR
+           exchangeabilities estimated from the differences within the
+           two pairs of sequences joined by the topology (a second
+           start for the optimizer)
+        """
+        params = dict(self.params)
+        if self.model.name not in ('HKY', 'GTR'):
+            return params
+        exact = [tip.sum(axis=1) == 1 for tip in self.tips]
+        pairs = np.full((self.nstates, self.nstates), 0.5)
+        for i, j in TOPOLOGY_PAIRS[topology]:
+            both = exact[i] & exact[j]
+            pairs += np.matmul(
+                (self.tips[i][both] * self.weights[both, None]).T,
+                self.tips[j][both])
+        exchange = (pairs + pairs.T) / np.outer(self.freqs, self.freqs)
+        if self.model.name == 'HKY':
+            transitions = exchange[0, 2] + exchange[1, 3]
+            params['kappa'] = 2.0 * transitions / (
+                exchange[0, 1] + exchange[0, 3] + exchange[1, 2] +
+                exchange[2, 3])
+        else:
+            for k, (i, j) in enumerate(((0, 1), (0, 2), (0, 3),
+                                        (1, 2), (1, 3))):
+                params['rate{}'.format(k)] = exchange[i, j] / exchange[2, 3]
+        return dict((name, min(max(val, 0.001), 1000.0))
+                    for name, val in params.items())
+
+    def exchangeabilities(self):
+        """Symmetric exchangeability matrix for the current parameters"""
+        if self.model.paml_exchange is not None:
+            return self.model.paml_exchange
+        exchange = np.ones((self.nstates, self.nstates))
+        if self.model.name == 'HKY':
+            # transitions A<->G and C<->T
+            for i, j in ((0, 2), (1, 3)):
+                exchange[i, j] = exchange[j, i] = self.params['kappa']
+        elif self.model.name == 'GTR':
+            # AC, AG, AT, CG, CT free; GT fixed at 1
+            for k, (i, j) in enumerate(((0, 1), (0, 2), (0, 3),
+                                        (1, 2), (1, 3))):
+                exchange[i, j] = exchange[j, i] = (
+                    self.params['rate{}'.format(k)])
+        return exchange
+
+    def eigen(self):
+        """Eigen decomposition of the normalized rate matrix"""
+        if self._eigen is None:
+            qmat = self.exchangeabilities() * self.freqs[None, :]
+            np.fill_diagonal(qmat, 0.0)
+            np.fill_diagonal(qmat, -qmat.sum(axis=1))
+            qmat /= -np.dot(self.freqs, np.diag(qmat))
+            sqrtpi = np.sqrt(self.freqs)
+            symm = qmat * sqrtpi[:, None] / sqrtpi[None, :]
+            evals, evecs = np.linalg.eigh(0.5 * (symm + symm.T))
+            self._eigen = (evals,
+                           evecs / sqrtpi[:, None],
+                           evecs.T * sqrtpi[None, :])
+            alpha = self.params.get('alpha')
+            if alpha is None:
+                self._rates = np.ones(1)
+            elif alpha != self._alpha:
+                self._rates = discrete_gamma_rates(alpha, self.model.ncat)
+                self._alpha = alpha
+        return self._eigen
+
+    def transition(self, brlen):
+        """Transition matrices for every rate category, (ncat, n, n),
+           or (nbranches, ncat, n, n) for an array of branch lengths
+        """
+        evals, left, right = self.eigen()
+        expt = np.exp(np.multiply.outer(np.multiply.outer(brlen, self._rates),
+                                        evals))
+        return np.matmul(left * expt[..., None, :], right)
+
+    def partials(self, topology, brlens):
+        """Tip partials pushed through their branches, L1/L2/R1/R2 order
+           rearranged to the two pairs of the topology, (4, ncat,
+           npatterns, n)
+        """
+        order = sum(TOPOLOGY_PAIRS[topology], ())
+        pmats = self.transition(np.array([brlens[tip] for tip in order]))
+        return order, np.matmul(self.tips[list(order)][:, None],
+                                pmats.transpose(0, 1, 3, 2))
+
+    def _sum_lnlike(self, left, right):
+        """Weighted log-likelihood from the conditional vectors of the
+           two ends of a branch
+        """
+        sitelikes = np.matmul(left * right, self.freqs).mean(axis=0)
+        return float(np.dot(self.weights,
+                            np.log(np.maximum(sitelikes, 1e-300))))
+
+    def lnlike(self, topology, brlens):
+        """Log-likelihood of the topology (0, 1 or 2) with brlens
+           ordered as tip branches 0-3 then the internal branch
+        """
+        _, partial = self.partials(topology, brlens)
+        lower = push(self.transition(brlens[4]), partial[2] * partial[3])
+        return self._sum_lnlike(partial[0] * partial[1], lower)
+
+    def branch_terms(self, topology, brlens, branch):
+        """Site likelihoods as a function of the length t of one branch,
+           with the rest of the tree held fixed:
+           L_s(t) = mean over c of sum over k of
+                    coefs[c, s, k] * exp(exponents[c, 0, k] * t)
+           (the model is reversible, so the likelihood can be summed at
+           either end of the branch)
+        """
+        evals, left, right = self.eigen()
+        order, partial = self.partials(topology, brlens)
+        if branch == 4:
+            upper = partial[0] * partial[1]
+            lower = partial[2] * partial[3]
+        else:
+            pos = order.index(branch)
+            other = (partial[2 - 2 * (pos // 2)] *
+                     partial[3 - 2 * (pos // 2)])
+            upper = partial[pos ^ 1] * push(self.transition(brlens[4]),
+                                             other)
+            lower = self.tips[branch]
+        coefs = (np.matmul(upper * self.freqs, left) *
+                 np.matmul(lower, right.T))
+        return coefs, np.outer(self._rates, evals)[:, None, :]
+
+    def branch_derivatives(self, coefs, exponents, brlen):
+        """Log-likelihood and its first two derivatives in the length
+           of the branch described by branch_terms
+        """
+        terms = coefs * np.exp(exponents * brlen)
+        sitelikes = np.maximum(terms.sum(axis=2).mean(axis=0), 1e-300)
+        terms *= exponents
+        first = terms.sum(axis=2).mean(axis=0) / sitelikes
+        terms *= exponents
+        second = terms.sum(axis=2).mean(axis=0) / sitelikes
+        return (float(np.dot(self.weights, np.log(sitelikes))),
+                float(np.dot(self.weights, first)),
+                float(np.dot(self.weights, second - first * first)))
+
+    def optimize_branch(self, topology, brlens, branch, maxiter=30,
+                        tol=1e-7):
+        """Newton-Raphson for the length of one branch.  Steps that do
+           not improve the likelihood are halved, so the returned length
+           is never worse than the starting one.
+        """
+        coefs, exponents = self.branch_terms(topology, brlens, branch)
+        brlen = brlens[branch]
+        lnl, grad, hess = self.branch_derivatives(coefs, exponents, brlen)
+        for _ in range(maxiter):
+            if hess < 0:
+                step = -grad / hess
+            else:
+                # not concave here, move in the uphill direction
+                step = brlen if grad > 0 else -0.5 * brlen
+            newlen = min(max(brlen + step, MIN_BRLEN), MAX_BRLEN)
+            while True:
+                newlnl, newgrad, newhess = self.branch_derivatives(
+                    coefs, exponents, newlen)
+                if newlnl >= lnl or abs(newlen - brlen) < tol * brlen:
+                    break
+                newlen = 0.5 * (brlen + newlen)
+            if newlnl < lnl:
+                break
+            done = abs(newlen - brlen) < tol * max(brlen, 1e-3)
+            brlen, lnl, grad, hess = newlen, newlnl, newgrad, newhess
+            if done:
+                break
+        return brlen, lnl
+
+    def optimize_params(self, topology, brlens, lnl, maxiter=30):
+        """Optimize the model parameters jointly (BFGS on a log scale)
+           with the branch lengths held fixed
+        """
+        names = sorted(self.params)
+        bounds = np.log([ALPHA_BOUNDS if name == 'alpha' else RATE_BOUNDS
+                         for name in names])
+
+        def neg_lnlike(logvals):
+            for name, logval in zip(names, logvals):
+                self.params[name] = math.exp(logval)
+            self._eigen = None
+            return -self.lnlike(topology, brlens)
+
+        logvals, fval = bfgs_minimize(
+            neg_lnlike, [math.log(self.params[name]) for name in names],
+            -lnl, bounds[:, 0], bounds[:, 1], maxiter=maxiter, tol=1e-3)
+        neg_lnlike(logvals)
+        return -fval
+
+    def saturated(self, brlens):
+        """True if a fit ended with a branch or an exchangeability at
+           its upper bound (typical of a plateau away from the optimum)
+        """
+        return (max(brlens) > 0.99 * MAX_BRLEN or any(
+            not 1.01 * RATE_BOUNDS[0] < val < 0.99 * RATE_BOUNDS[1]
+            for name, val in self.params.items() if name != 'alpha'))
+
+    def optimize(self, topology, brlens=None, rounds=10, tol=1e-3,
+                 maxiter=30):
+        """Maximum likelihood branch lengths and model parameters, from
+           the current parameters and the given (or default) branch
+           lengths.  Rounds of Newton-Raphson on each branch length
+           and BFGS on the model parameters (at most maxiter steps)
+           alternate; only changes that improve the likelihood are
+           kept.
+        """
+        brlens = (list(brlens) if brlens is not None else
+                  [START_BRLEN] * 5)
+        best = self.lnlike(topology, brlens)
+        for _ in range(rounds):
+            start = best
+            for i in range(5):
+                brlens[i], best = self.optimize_branch(topology, brlens, i)
+            if self.params:
+                best = self.optimize_params(topology, brlens, best, maxiter)
+            if best - start < tol:
+                break
+        return best, brlens
+
+
+def evaluate_quartet(seqs, model_string, data_type, weights=None):
+    """Maximized log-likelihoods of the three quartet topologies.
+       seqs are ordered L1, L2, R1, R2.  Each topology is optimized
+       from the parameters and tip branch lengths of the best fit so
+       far (the defaults for the first topology).  If that fit ends on
+       a bound, a second start uses exchangeabilities estimated from
+       the differences between the sequences the topology joins.
+    """
+    model = QuartetModel(model_string, data_type)
+    qlike = QuartetLikelihood(seqs, model, weights)
+    fitted = (dict(qlike.params), [START_BRLEN] * 5, None)
+    lnlikes = []
+    for topology in (0, 1, 2):
+        best = None
+        for params, brlens in ((fitted[0], fitted[1][:4] + [START_BRLEN]),
+                               (qlike.empirical_params(topology),
+                                [START_BRLEN] * 5)):
+            qlike.params = dict(params)
+            qlike._eigen = None
+            lnl, fitbrlens = qlike.optimize(topology, brlens)
+            if best is None or lnl > best[2]:
+                best = (dict(qlike.params), fitbrlens, lnl)
+            if not qlike.saturated(fitbrlens):
+                break
+        lnlikes.append(best[2])
+        if fitted[2] is None or best[2] > fitted[2]:
+            fitted = best
+    return lnlikes
+
+
+if __name__ == "__main__":
+    print("This file is a function library, please run quartet_sampling.py")
@@ -20,6 +20,7 @@ You should have received a copy of the GNU General Public License
 along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import importlib.util
 import os
 
 
@@ -27,7 +28,8 @@ STANDARD_EXEC = {
     'raxml-ng': 'raxml-ng',
     'raxml': 'raxml',
     'paup': 'paup',
-    'iqtree': 'iqtree'}
+    'iqtree': 'iqtree',
+    'native': None}
 
 
 class ParamSet(dict):
@@ -40,12 +42,14 @@ class ParamSet(dict):
         # Basic params
         self['verbose'] = args.verbose
         self['low_mem'] = args.low_mem
+        self['alignment_cache'] = args.alignment_cache
         self['retain_temp'] = args.retain_temp
         self['data_type'] = args.data_type[0]
         self['calc_qdstats'] = args.calc_qdstats
-        self['max_quartet_enumeration_threshold'] = 0.333333
+        self['max_quartet_enumeration_threshold'] = 0.1
         self['just_clade'] = args.clade is not None
         self['nprocs'] = args.threads[0]
+        self['async_engines'] = args.async_engines
         if args.partitions is not None and args.genetrees is not None:
             raise RuntimeError("Cannot use -g (--genetrees)"
                                "and -q (--partitions) simultaneously")
@@ -72,6 +76,12 @@ class ParamSet(dict):
                 self['engine_model'] = 'PROTGAMMAWAG'
             elif self['data_type'] == 'cat':
                 self['engine_model'] = 'BINGAMMA'
+        elif self['engine'] == 'native':
+            self['engine_model'] = 'GTR+G4'
+            if self['data_type'] == 'amino':
+                self['engine_model'] = 'POISSON+G4+F'
+            elif self['data_type'] == 'cat':
+                self['engine_model'] = 'MK'
         elif self['engine'] == 'iqtree':
             self['engine_model'] = 'GTR+G4'
             if self['data_type'] == 'amino':
@@ -86,13 +96,28 @@ class ParamSet(dict):
                 self['engine_model'] = 'BIN+G'
         if args.engine_model is not None:
             self['engine_model'] = args.engine_model[0]
+        if self['engine'] == 'native':
+            if importlib.util.find_spec('numpy') is None:
+                raise RuntimeError("--engine native requires NumPy")
+            if args.partitions is not None or args.async_engines:
+                raise RuntimeError("--engine native cannot be used with "
+                                   "--partitions or --async-engines")
+        self['engine_batch_size'] = max(args.engine_batch_size, 1)
+        if self['engine_batch_size'] > 1 and self['engine'] != 'paup':
+            raise RuntimeError("--engine-batch-size is currently only "
+                               "available for --engine paup")
+        self['compress_patterns'] = args.compress_patterns
+        if self['compress_patterns']:
+            if self['using_partitions']:
+                raise RuntimeError("--compress-patterns cannot be used with "
+                                   "--partitions")
+            if self['engine'] == 'iqtree':
+                raise RuntimeError("--compress-patterns is not available "
+                                   "for --engine iqtree")
         # Retained for backwards compat -- To be removed
         #################################################
         self['paup'] = bool(args.engine == 'paup')
         ################################################
-        if self['using_genetrees'] is True and self['low_mem']:
-            raise RuntimeError("Cannot use -g (--genetrees) and"
-                               "--low-mem simultaneously")
         # This parameter sets a threshold for how close you need to be to the
         # total number of possible quartets to trigger exhaustive
         # sampling
@@ -125,9 +150,28 @@ class ParamSet(dict):
                                "in the name to prevent accidental file "
                                "deletion!")
         print("setting the temp working dir to {}".format(self["temp_wd"]))
+        self['shard'] = None
+        if args.shard is not None:
+            try:
+                self['shard'] = tuple(int(x) for x in
+                                      args.shard[0].split('/'))
+            except ValueError:
+                self['shard'] = None
+            if (self['shard'] is None or len(self['shard']) != 2 or
+                    not 1 <= self['shard'][0] <= self['shard'][1]):
+                raise RuntimeError("--shard must be given as i/N with "
+                                   "1 <= i <= N, e.g. --shard 2/8")
+        self['plan_shards'] = (args.plan[0] if args.plan is not None
+                               else None)
+        if self['plan_shards'] is not None and self['plan_shards'] < 1:
+            raise RuntimeError("--plan requires a positive number of shards")
         self['result_prefix'] = (args.result_prefix[0]
                                  if args.result_prefix is not None
                                  else "RESULT")
+        if args.result_prefix is None and self['shard'] is not None:
+            # keep the outputs of the shards apart for merge_output.py
+            self['result_prefix'] = "RESULT.shard{}of{}".format(
+                *self['shard'])
         self['results_dir'] = (os.path.abspath(os.path.curdir) if
                                args.results_dir is None else
                                args.results_dir[0])
@@ -140,9 +184,35 @@ class ParamSet(dict):
         self['tree_result_file_path'] = os.path.join(
             self['results_dir'], "{}.labeled.tre".format(
                 self['result_prefix']))
+        self['shard_plan_file_path'] = os.path.join(
+            self['results_dir'], "{}.shard.plan".format(
+                self['result_prefix']))
         self['nodecounts_result_file_path'] = os.path.join(
             self['results_dir'], "{}.node.counts.csv".format(
                 self['result_prefix']))
+        self['journal_file_path'] = os.path.join(
+            self['results_dir'], "{}.journal".format(
+                self['result_prefix']))
+        self['resume'] = not args.no_resume
+        self['result_cache_path'] = None
+        if args.result_cache_path is not None:
+            self['result_cache_path'] = args.result_cache_path[0]
+        elif args.result_cache:
+            self['result_cache_path'] = os.path.join(
+                self['results_dir'], "quartet_cache.sqlite")
+        self['result_cache_size'] = max(args.result_cache_size, 0)
+        self['status_interval'] = args.status_interval
+        self['status_file_path'] = (
+            os.path.join(self['results_dir'], "{}.status.json".format(
+                self['result_prefix']))
+            if self['status_interval'] > 0 else None)
+        self['results_npz_path'] = None
+        if args.results_npz:
+            if importlib.util.find_spec('numpy') is None:
+                raise RuntimeError("--results-npz requires NumPy")
+            self['results_npz_path'] = os.path.join(
+                self['results_dir'], "{}.node.scores.npz".format(
+                    self['result_prefix']))
         self['figtree_file_path'] = "{}.figtree".format(
             self['tree_result_file_path'])
         self['freq_file_path'] = "{}.freq".format(
@@ -23,14 +23,24 @@ along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 
 class Node:
     """Node phylogeny"""
+    # no per-instance __dict__, the data dict is only created when used
+    __slots__ = ('label', 'length', 'parent', 'children', '_data', 'istip')
+
     def __init__(self):
         self.label = ""
         self.length = 0.0
         self.parent = None
         self.children = []
-        self.data = {}
+        self._data = None
         self.istip = False
 
+    @property
+    def data(self):
+        """Dictionary of node annotations (scores etc.)"""
+        if self._data is None:
+            self._data = {}
+        return self._data
+
     def add_child(self, child):
         # make sure that the child is not already in there
         assert child not in self.children
@@ -46,11 +56,13 @@ class Node:
     def leaves(self, v=None):
         if v is None:
             v = []
-        if len(self.children) == 0:
-            v.append(self)
-        else:
-            for child in self.children:
-                child.leaves(v)
+        stack = [self]
+        while stack:
+            xnode = stack.pop()
+            if xnode.children:
+                stack.extend(reversed(xnode.children))
+            else:
+                v.append(xnode)
         return v
 
     def leaves_fancy(self):
@@ -60,13 +72,25 @@ class Node:
         return [n.label for n in self.iternodes() if n.istip]
 
     def iternodes(self, order="preorder"):
+        """Iterate over the subtree (iteratively, so the depth of the
+           tree is not limited by the recursion limit)
+        """
         if order.lower() == "preorder":
-            yield self
-        for child in self.children:
-            for d in child.iternodes(order):
-                yield d
-        if order.lower() == "postorder":
-            yield self
+            stack = [self]
+            while stack:
+                xnode = stack.pop()
+                yield xnode
+                stack.extend(reversed(xnode.children))
+        elif order.lower() == "postorder":
+            stack = [(self, False)]
+            while stack:
+                xnode, visited = stack.pop()
+                if visited:
+                    yield xnode
+                else:
+                    stack.append((xnode, True))
+                    stack.extend((child, False)
+                                 for child in reversed(xnode.children))
 
     def prune(self):
         p = self.parent
@@ -77,28 +101,42 @@ class Node:
     def branch_lengths(self):
         return [n.length for n in self.iternodes()]
 
-    def get_newick_repr(self, showbl=False):
-        ret = ""
-        for i in range(len(self.children)):
-            if i == 0:
-                ret += "("
-            ret += self.children[i].get_newick_repr(showbl)
-            if i == len(self.children)-1:
-                ret += ")"
+    def newick_parts(self):
+        """Yield the Newick structure of the subtree without recursion:
+           the '(', ',' and ')' separators as strings, and each node
+           (to be written as label:length) right after its children
+        """
+        stack = [(self, 0)]
+        while stack:
+            xnode, i = stack.pop()
+            if i < len(xnode.children):
+                yield "(" if i == 0 else ","
+                stack.append((xnode, i + 1))
+                stack.append((xnode.children[i], 0))
             else:
-                ret += ","
-        if self.label is not None:
-            ret += self.label
-        if showbl is True:
-            ret += ":" + str(self.length)
-        return ret
+                if xnode.children:
+                    yield ")"
+                yield xnode
+
+    def get_newick_repr(self, showbl=False):
+        parts = []
+        for part in self.newick_parts():
+            if isinstance(part, str):
+                parts.append(part)
+                continue
+            if part.label is not None:
+                parts.append(part.label)
+            if showbl is True:
+                parts.append(":" + str(part.length))
+        return "".join(parts)
 
     def _calc_depth(self):
-        '''recursively calculate the depth of this node'''
-        if len(self.children) < 1:
-            return self.length
-        else:
-            return self.length + max([c.depth for c in self.children])
+        '''calculate the depth of this node (one postorder pass)'''
+        depths = {}
+        for xnode in self.iternodes(order="postorder"):
+            depths[xnode] = xnode.length + max(
+                [depths.pop(c) for c in xnode.children] or [0.0])
+        return depths[self]
 
     @property
     def depth(self):
@@ -25,77 +25,103 @@ along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import re
 from .node import Node
 
 
-def read_tree_string(instr):
+# quoted label, comment/annotation, branch length, punctuation or
+# unquoted label (unquoted labels may contain spaces, but not start or
+# end with one)
+NEWICK_TOKENS = re.compile(
+    r"'(?:[^']|'')*'"
+    r"|\[[^\]]*\]"
+    r"|:\s*[^\s(),:;\[\]]*"
+    r"|[(),;]"
+    r"|[^\s(),:;\[\]'](?:[^(),:;\[\]'\n\r\t]*[^\s(),:;\[\]'])?")
+
+
+def read_trees(instr):
+    """Iterate over the trees (root nodes) of a Newick string, which may
+       span several lines and contain several ';'-terminated trees.
+       Non-recursive single pass over the tokens.
+    """
     root = None
-    index = 0
-    nextchar = instr[index]
-    start = True
-    keepgoing = True
-    curnode = None
-    while keepgoing is True:
-        if nextchar == "(":
-            if start is True:
-                root = Node()
-                curnode = root
-                start = False
-            else:
-                newnode = Node()
-                curnode.add_child(newnode)
-                curnode = newnode
-        elif nextchar == ',':
-            curnode = curnode.parent
-        elif nextchar == ")":
-            curnode = curnode.parent
-            index += 1
-            nextchar = instr[index]
-            name = ""
-            while True:
-                if nextchar in ',):;[':
-                    break
-                name += nextchar
-                index += 1
-                nextchar = instr[index]
-            curnode.label = name
-            index -= 1
-        elif nextchar == ';':
-            keepgoing = False
-            break
-        elif nextchar == ":":
-            index += 1
-            nextchar = instr[index]
-            brlen = ""
-            while True:
-                if nextchar in ',):;[':
-                    break
-                brlen += nextchar
-                index += 1
-                nextchar = instr[index]
-            curnode.length = float(brlen)
-            index -= 1
-        elif nextchar == ' ':
-            index += 1
-            nextchar = instr[index]
-        else:  # this is an external named node
+    # open internal nodes and the node that was completed last
+    stack = []
+    last = None
+    for token in NEWICK_TOKENS.findall(instr):
+        char = token[0]
+        if char == '(':
             newnode = Node()
-            curnode.add_child(newnode)
-            curnode = newnode
-            curnode.istip = True
-            name = ""
-            while True:
-                if nextchar in ',):;[':
-                    break
-                name += nextchar
-                index += 1
-                nextchar = instr[index]
-            curnode.label = name
-            index -= 1
-        if index < len(instr) - 1:
-            index += 1
-        nextchar = instr[index]
-    return root
+            if stack:
+                newnode.parent = stack[-1]
+                stack[-1].children.append(newnode)
+            else:
+                root = newnode
+            stack.append(newnode)
+            last = None
+        elif char in ',):;':
+            if last is None and char != ';':
+                # unlabeled tip
+                last = new_tip("", stack)
+                if root is None:
+                    root = last
+            if char == ',':
+                last = None
+            elif char == ')':
+                if not stack:
+                    raise ValueError("Unbalanced ')' in the Newick string")
+                last = stack.pop()
+            elif char == ':':
+                try:
+                    last.length = float(token[1:])
+                except ValueError:
+                    raise ValueError(
+                        "Invalid branch length '{}' in the Newick "
+                        "string".format(token[1:].strip()))
+            else:
+                if stack:
+                    raise ValueError("Unbalanced '(' in the Newick string")
+                if root is not None:
+                    yield root
+                root = None
+                stack = []
+                last = None
+        elif char == '[':
+            if last is not None:
+                last.data['comment'] = token[1:-1]
+        else:
+            if char == "'":
+                token = token[1:-1].replace("''", "'")
+            if last is None:
+                last = new_tip(token, stack)
+                if root is None:
+                    root = last
+            else:
+                last.label = token
+    if stack:
+        raise ValueError("Unbalanced '(' in the Newick string")
+    if root is not None:
+        # tolerate a missing final ';'
+        yield root
+
+
+def new_tip(label, stack):
+    """Add a tip to the innermost open node"""
+    tip = Node()
+    tip.istip = True
+    tip.label = label
+    if stack:
+        tip.parent = stack[-1]
+        stack[-1].children.append(tip)
+    return tip
+
+
+def read_tree_string(instr):
+    """Root node of the first tree of a Newick string (None if there is
+       no tree)
+    """
+    return next(read_trees(instr), None)
 
 
 if __name__ == "__main__":
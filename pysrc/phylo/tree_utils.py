@@ -23,22 +23,70 @@ You should have received a copy of the GNU General Public License
 along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import functools
+import hashlib
+
+
+@functools.lru_cache(maxsize=None)
+def tip_hash(label):
+    """Stable random 64-bit code of a tip label, splits are identified
+       by the XOR of the codes of the tips on one side
+    """
+    return int.from_bytes(hashlib.blake2b(label.encode('utf-8'),
+                                          digest_size=8).digest(), 'big')
+
+
+def split_hashes(tree, tips=None):
+    """(hash, number of tips) of the tips below every node in one
+       postorder pass, counting only the labels in tips if given
+    """
+    below = {}
+    for node in tree.iternodes(order="postorder"):
+        if not node.children:
+            below[node] = ((tip_hash(node.label), 1)
+                           if tips is None or node.label in tips else (0, 0))
+        else:
+            code = 0
+            ntips = 0
+            for child in node.children:
+                code ^= below[child][0]
+                ntips += below[child][1]
+            below[node] = (code, ntips)
+    return below
+
+
+def canonical_splits(tree, tips=None):
+    """Map the nontrivial splits (at least two tips on both sides) of
+       the tree, taken as unrooted, to the first node that has them.
+       A split is keyed by the smaller hash of its two sides.
+    """
+    below = split_hashes(tree, tips)
+    total, ntotal = below[tree]
+    splits = {}
+    for node in tree.iternodes():
+        code, ntips = below[node]
+        if 2 <= ntips <= ntotal - 2:
+            splits.setdefault(min(code, total ^ code), node)
+    return splits
+
 
 def rf_dist(tree1, tree2):
-    return 0
+    """Robinson-Foulds distance: the number of splits found in only one
+       of the (unrooted) trees, compared on the tips they share
+    """
+    tips = set(tree1.lvsnms()) & set(tree2.lvsnms())
+    return len(set(canonical_splits(tree1, tips)) ^
+               set(canonical_splits(tree2, tips)))
 
 
 # using rooted trees for unrooted means ignoring anything with one
 def calc_biparts(tree1):
     allbiparts1 = []
     allbiparts2 = []
-    for i in tree1.iternodes():
-        bp1, bp2 = get_bipart(i, tree1)
-        if len(bp1) < 2 or len(bp2) < 2:
-            continue
-        if bp1 in allbiparts1 or bp1 in allbiparts2:
-            continue
-        allbiparts1.append(bp1)
+    rtlvs = set(tree1.lvsnms())
+    for node in canonical_splits(tree1).values():
+        bp2 = set(node.lvsnms())
+        allbiparts1.append(rtlvs - bp2)
         allbiparts2.append(bp2)
     return allbiparts1, allbiparts2
 
@@ -55,53 +103,94 @@ def get_bipart(node, root):
     return bp1, bp2
 
 
+def split_support(trees):
+    """Number of trees that contain each split, and the tree and node
+       where it was seen first (linear in the total size of the trees)
+    """
+    counts = {}
+    first = {}
+    for tree in trees:
+        for key, node in canonical_splits(tree).items():
+            counts[key] = counts.get(key, 0) + 1
+            first.setdefault(key, (tree, node))
+    return counts, first
+
+
 def calc_biparts_support(trees):
-    bipartscount = []
-    allbiparts1 = []
-    allbiparts2 = []
-    for i in range(len(trees)):
-        tree = trees[i]
-        abp1, abp2 = calc_biparts(tree)
-        for tabp1, tabp2 in zip(abp1, abp2):
-            if tabp1 in allbiparts1:
-                bipartscount[allbiparts1.index(tabp1)] += 1
-            elif tabp1 in allbiparts2:
-                bipartscount[allbiparts2.index(tabp1)] += 1
+    counts, first = split_support(trees)
+    for key, count in counts.items():
+        tree, node = first[key]
+        bp2 = set(node.lvsnms())
+        print(set(tree.lvsnms()) - bp2, bp2, count / float(len(trees)))
+
+
+class LCAIndex(object):
+    """Euler tour of a tree with a sparse table of depth minima, built
+       once in O(n log n), for O(1) lowest common ancestor queries
+    """
+
+    def __init__(self, tree):
+        self.euler = []
+        self.first = {}
+        # (depth, position in the Euler tour) of every visit
+        visits = []
+        stack = [[tree, 0]]
+        while stack:
+            node, nextchild = stack[-1]
+            if nextchild == 0:
+                self.first[node] = len(self.euler)
+            visits.append((len(stack), len(self.euler)))
+            self.euler.append(node)
+            if nextchild < len(node.children):
+                stack[-1][1] += 1
+                stack.append([node.children[nextchild], 0])
             else:
-                allbiparts1.append(tabp1)
-                allbiparts2.append(tabp2)
-                bipartscount.append(1)
-    for i in range(len(bipartscount)):
-        print(allbiparts1[i], allbiparts2[i],
-              bipartscount[i]/float(len(trees)))
-
-
-def get_mrca(nodes, tree):
-    traceback = []
-    first = nodes[0]
-    while first != tree:
-        first = first.parent
-        traceback.append(first)
-        if first.parent is None:
-            break
-    curmrca = nodes[0].parent
-    for i in nodes:
-        if i == nodes[0]:
-            continue
-        curmrca = mrca_recurs(curmrca, traceback, i)
-    return curmrca
-
-
-def mrca_recurs(node1, path1, node2):
-    path = path1[path1.index(node1):]
-    parent = node2
-    mrca = None
-    while parent is not None:
-        if parent in path:
-            mrca = parent
-            break
-        parent = parent.parent
-    return mrca
+                stack.pop()
+        # table[j][i] is the shallowest visit of visits[i:i + 2 ** j]
+        self.table = [visits]
+        width = 1
+        while 2 * width <= len(visits):
+            prev = self.table[-1]
+            self.table.append(list(map(min, prev[:-width], prev[width:])))
+            width *= 2
+
+    def lca(self, node1, node2):
+        """Lowest common ancestor of two nodes"""
+        i, j = sorted((self.first[node1], self.first[node2]))
+        level = (j - i + 1).bit_length() - 1
+        row = self.table[level]
+        return self.euler[min(row[i], row[j - (1 << level) + 1])[1]]
+
+    def mrca(self, nodes):
+        """Lowest common ancestor of all the nodes"""
+        mrca = nodes[0]
+        for node in nodes[1:]:
+            mrca = self.lca(mrca, node)
+        return mrca
+
+
+def get_mrca(nodes, tree, lca_index=None):
+    """MRCA of the parent of the first node and the other nodes (so a
+       single node gives its parent), using the LCAIndex of the tree
+       if one is given
+    """
+    nodes = [nodes[0].parent or nodes[0]] + list(nodes[1:])
+    if lca_index is not None:
+        return lca_index.mrca(nodes)
+    # ancestors of the first node, then walk up from every other node
+    # to the deepest ancestor that is shared
+    path = []
+    node = nodes[0]
+    while node is not None:
+        path.append(node)
+        node = node.parent
+    depth = dict((node, i) for i, node in enumerate(path))
+    mrca = 0
+    for node in nodes[1:]:
+        while node not in depth:
+            node = node.parent
+        mrca = max(mrca, depth[node])
+    return path[mrca]
 
 
 # assumes an ultrametric tree
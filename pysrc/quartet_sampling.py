@@ -13,18 +13,17 @@ import argparse
 import os
 import sys
 import time
-from multiprocessing import Manager, Pool
 from shutil import copyfile
 from tree_data import TreeData, write_test_trees
+from tree_data import assign_shards, write_shard_plan
 from rep_data import DataStore
-from rep_data import process_replicate_raxml, process_replicate_raxml_lrt
-from rep_data import process_replicate_raxmlng, process_replicate_raxmlng_lrt
-from rep_data import process_replicate_iqtree, process_replicate_iqtree_lrt
-from rep_data import process_replicate_paup
 from rep_data import get_replicates_exhaustive, get_replicates_random
 from rep_data import write_run_stats
 from paramset import ParamSet, read_config
-from alignment import Alignment
+from alignment import Alignment, open_alignment
+from scheduler import get_scheduler
+from result_cache import open_result_cache
+from journal import RunJournal, StopRequest
 
 
 LICENSE = """from rep_data import
@@ -55,11 +54,15 @@ def generate_argparser():
                         # Prev -t
                         help=("The input tree in Newick "
                               "(parenthetical) format."))
-    parser.add_argument("--align", "--alignment", type=open, nargs=1,
+    parser.add_argument("--align", "--alignment", type=open_alignment,
+                        nargs=1,
                         # Prev -a
                         required=True, dest="align",
-                        help=("Alignment file in \"relaxed phylip\" format, "
-                              "as used by RAxML."))
+                        help=("Alignment file in \"relaxed phylip\" format "
+                              "(sequential or interleaved), as used by "
+                              "RAxML, or in FASTA or NEXUS format; "
+                              "gzip, bzip2 and xz compressed files are "
+                              "read directly."))
     parser.add_argument("--reps", "--number-of-reps", type=int, nargs=1,
                         # Prev -N
                         required=True, default=100, dest="reps",
@@ -143,6 +146,10 @@ def generate_argparser():
                               "used to restart at an intermediate position "
                               "(in case the previous run was canceled before "
                               "completion, for example)."))
+    parser.add_argument("--no-resume", action="store_true",
+                        help=("Ignore (and overwrite) the checkpoint journal "
+                              "of an earlier interrupted run in the results "
+                              "directory instead of resuming from it."))
     parser.add_argument("--stop-node-number", type=int, nargs=1,
                         # Prev -p
                         help=("An integer denoting the node at which to stop. "
@@ -153,10 +160,25 @@ def generate_argparser():
                               "Nodes will be read from topologically "
                               "identical (and isomorphic!) input trees "
                               "in deterministic order."))
+    parser.add_argument("--shard", type=str, nargs=1,
+                        help=("Process only shard i of N (given as 'i/N') "
+                              "so that N independent runs together cover "
+                              "all nodes. Nodes are balanced over the "
+                              "shards by their expected cost. Results are "
+                              "written with the prefix RESULT.shard<i>of<N> "
+                              "unless --result-prefix is given and can be "
+                              "combined with merge_output.py."))
+    parser.add_argument("--plan", type=int, nargs=1,
+                        help=("Write the assignment of nodes to the given "
+                              "number of shards (with the expected cost of "
+                              "each node) to <prefix>.shard.plan and exit."))
     parser.add_argument("--engine", nargs=1, default=('raxml-ng',),
-                        choices=('raxml-ng', 'raxml', 'paup', 'iqtree'),
+                        choices=('raxml-ng', 'raxml', 'paup', 'iqtree',
+                                 'native'),
                         help=("Name of the program to use to infer trees or"
-                              " evaluate tree model likelihoods."))
+                              " evaluate tree model likelihoods. 'native' "
+                              "uses the built-in quartet likelihood "
+                              "calculator (requires NumPy)."))
     parser.add_argument("--engine-exec", nargs=1,
                         help=("Full file path of the tree inference or"
                               " likelihood evaluation engine."))
@@ -179,11 +201,58 @@ def generate_argparser():
     # parser.add_argument("--paup-executable", nargs=1, default=["paup"],
     #                    help=("The name or path of the PAUP executable to "
     #                          "be used for calculated quartets."))
+    parser.add_argument("--async-engines", action="store_true",
+                        help=("Run the engine programs as asynchronous "
+                              "subprocesses of the main process instead of "
+                              "from a pool of Python worker processes. "
+                              "Uses less memory per concurrent replicate "
+                              "(--threads sets the number of concurrent "
+                              "engine processes)."))
+    parser.add_argument("--engine-batch-size", type=int, default=1,
+                        help=("Number of replicates to pack into a single "
+                              "engine invocation (currently PAUP only). "
+                              "Saves the engine start-up time on short "
+                              "quartet alignments."))
+    parser.add_argument("--compress-patterns", action="store_true",
+                        help=("Write each replicate alignment as its unique "
+                              "site patterns plus per-pattern weights "
+                              "(RAxML, RAxML-ng, PAUP and native engines). "
+                              "Greatly reduces temporary file sizes and "
+                              "engine run times on long alignments."))
+    parser.add_argument("--alignment-cache", action="store_true",
+                        help=("Keep a binary copy of the parsed alignment "
+                              "next to the input (<alignment>.qscache) and "
+                              "load it instead of the text alignment when "
+                              "the input file is unchanged."))
+    parser.add_argument("--result-cache", action="store_true",
+                        help=("Keep the engine results in an on-disk cache "
+                              "and reuse them when the same quartet "
+                              "alignment is evaluated again with the same "
+                              "engine settings (also across runs)."))
+    parser.add_argument("--result-cache-path", type=os.path.abspath,
+                        nargs=1,
+                        help=("Location of the result cache (default is "
+                              "quartet_cache.sqlite in the results "
+                              "directory). Implies --result-cache."))
+    parser.add_argument("--result-cache-size", type=int, default=1000000,
+                        help=("Maximum number of entries kept in the result "
+                              "cache, the least recently used are removed "
+                              "at the end of a run (default 1000000)."))
+    parser.add_argument("--results-npz", action="store_true",
+                        help=("Also write the node counts, scores and "
+                              "replicate numbers (and the QF scores) as "
+                              "typed columns to <prefix>.node.scores.npz "
+                              "for fast loading (requires NumPy)."))
+    parser.add_argument("--status-interval", type=float, default=0,
+                        help=("Every this many seconds, write the progress "
+                              "and the provisional counts and scores of the "
+                              "nodes being processed to "
+                              "<prefix>.status.json (default 0, disabled)."))
     parser.add_argument("--ignore-errors", action="store_true",
                         help=("Ignore RAxML and PAUP erroneous runs"))
     parser.add_argument("--low-mem", action="store_true",
                         help=("Do not store large alignment in memory "
-                              "for whole-alignment (non-genetree) mode"))
+                              "(it is memory-mapped from the temp dir)"))
     parser.add_argument('--max-random-sample-proportion', type=float,
                         help=("The proportion of possible replicates explored "
                               "unsuccessfully by the random generation "
@@ -204,6 +273,26 @@ def generate_argparser():
     return parser
 
 
+def remove_temp_files(params):
+    """Remove the temporary working directory and its contents"""
+    if params['retain_temp'] is False:
+        for the_file in os.listdir(params['temp_wd']):
+            file_path = os.path.join(params['temp_wd'], the_file)
+            try:
+                if os.path.isfile(file_path):
+                    if "QuartetSampling" not in file_path:
+                        print(file_path,
+                              " does not contain 'QuartetSampling' "
+                              "and will not be deleted for safety")
+                    else:
+                        os.remove(file_path)
+            except FileNotFoundError as exc:
+                print(file_path, " not found")
+        if 'QuartetSampling' in params['temp_wd']:
+            os.rmdir(params['temp_wd'])
+    return ''
+
+
 def main(arguments=None):
     """Main method for quartet_sampling"""
     if arguments is None:
@@ -225,15 +314,26 @@ def main(arguments=None):
         print(params)
         print("-----------")
     maindata = DataStore(params)
-    #  shared object access for multithreading
-    manager = Manager()
-    lock = manager.RLock()
     aln = Alignment(params)
     if params['using_genetrees']:
         aln.read_genes(args.align[0], params)
     else:
         aln.read_align(args.align[0], params)
     params['min_overlap'] = aln.min_overlap
+    if params['plan_shards'] is not None or params['shard'] is not None:
+        # split the nodes between the shards, the same way in every shard
+        costs = treedata.node_costs(params, aln)
+        if params['plan_shards'] is not None:
+            write_shard_plan(params['shard_plan_file_path'], costs,
+                             assign_shards(costs, params['plan_shards']))
+            print("shard plan written to: {}".format(
+                params['shard_plan_file_path']))
+            remove_temp_files(params)
+            return ''
+        assignment = assign_shards(costs, params['shard'][1])
+        treedata.shard_nodes = set(
+            label for label, shard in assignment.items()
+            if shard == params['shard'][0])
     # k is the node counter
     k = 1
     #  if we are starting at the beginning, initialize the results file
@@ -244,7 +344,25 @@ def main(arguments=None):
                            restype="nodecounts", delim='\t')
     # process the nodes in the tree
     params['starttime'] = time.time()
+    # completed replicates are journaled so an interrupted run can resume
+    # (the input paths are relative to the starting directory)
+    journal = RunJournal(params, [args.tree[0].name, args.align[0].name])
+    # the test trees and partitions file do not change throughout the run,
+    # so write them once before workers start reading them
+    os.chdir(params['temp_wd'])
+    write_test_trees()
+    if params['partitions_file_path'] is not None:
+        copyfile(params['partitions_file_path'], "temp_parts")
+    # one long-lived pool (or event loop) for the whole run,
+    # shared by all nodes
+    cache = open_result_cache(params)
+    stop = StopRequest()
+    scheduler = get_scheduler(params, maindata, cache=cache,
+                              journal=journal, stop_request=stop)
+    repstats = {}
     for fnode in treedata.tree.iternodes():
+        if stop.is_set():
+            break
         if params['verbose'] is True:
             print("testing node", [x.label for x in fnode.leaves()])
         if treedata.clade is not None:
@@ -254,16 +372,17 @@ def main(arguments=None):
         if k > params['stopk']:
             print("Processed all nodes up to the stop node. Exiting...")
             break
-        write_test_trees()
         # skip tips and root
         k, leafsets = treedata.check_node(fnode, k, params)
         if leafsets is False:
             if params['verbose'] is True:
                 print("skipping node...")
             continue
-        # Begin multiprocessing queue
-        results_queue = manager.Queue()
-        n_completed = manager.Value("i", 0, "lock")
+        done = journal.completed(fnode.label)
+        if journal.is_finished(fnode.label):
+            # finished by an earlier run, only the results are replayed
+            scheduler.submit(fnode, [], completed=done)
+            continue
         # Establish replicates
         n_possible_replicates = 1
         for leafset in leafsets.values():
@@ -283,80 +402,39 @@ def main(arguments=None):
                       'total number to be sampled, so will generate all '
                       'and do a random draw')
             replicates, repstats = get_replicates_exhaustive(
-                n_completed, results_queue, leafsets,
-                params, aln, fnode, lock)
+                leafsets, params, aln, fnode, cache=cache, done=done)
         else:
             if params['verbose']:
                 print('Generating random quartets...')
             replicates, repstats = get_replicates_random(
-                n_completed, results_queue, leafsets,
-                params, aln, fnode, lock)
-        nreplicates = len(replicates)
-        if nreplicates < 1:  # no suitable replicates
-            maindata.process_empty_rep_results(fnode, params, nreplicates)
-        else:
-            # copy original partitions file, should not change throughout run
-            if params['partitions_file_path'] is not None:
-                copyfile(params['partitions_file_path'], "temp_parts")
-            # run the raxml calls in parallel
-            # now designate multiprocessing resource pool.
-            # important to do outside node loop. garbage collecting does not
-            # apply to threads! set maxtasksperchild to release mem and files
-            pool = Pool(params['nprocs'], maxtasksperchild=1)
-            # PAUP Case
-            if params['engine'] == 'paup':
-                pool.map(process_replicate_paup, replicates)
-            # IQ-TREE with likelihood threshold
-            elif params['lnlikethresh'] > 0 and params['engine'] == 'iqtree':
-                pool.map(process_replicate_iqtree_lrt, replicates)
-            # IQ-TREE with likelihood threshold
-            elif params['engine'] == 'iqtree':
-                pool.map(process_replicate_iqtree, replicates)
-            # RAxML Classic with likelihood threshold
-            elif params['lnlikethresh'] > 0 and params['engine'] == 'raxml':
-                pool.map(process_replicate_raxml_lrt, replicates)
-            # RAxML Classic without likelihood threshold
-            elif params['engine'] == 'raxml':
-                pool.map(process_replicate_raxml, replicates)
-            # RAxML-ng with likelihood threshold
-            elif params['lnlikethresh'] > 0:
-                pool.map(process_replicate_raxmlng_lrt, replicates)
-            # RAxML-ng without likelihood threshold
-            else:
-                pool.map(process_replicate_raxmlng, replicates)
-
-            pool.close()
-            pool.join()
-            del pool
-            # print("")
-            # now process the results. first open a file to hold topologies
-            # sending params['just_clade'] = True will give back detailed
-            # name results
-            maindata.process_rep_results(fnode, results_queue, params,
-                                         nreplicates) # , leafsets)
-        # clean up
-        del results_queue
-        del n_completed
+                leafsets, params, aln, fnode, cache=cache, done=done)
+        # queue the replicates in the shared pool; nodes whose replicates
+        # have all finished are processed here as well
+        scheduler.submit(fnode, replicates, completed=done)
         # break # Left in place for troubleshooting
-    if params['retain_temp'] is False:
-        for the_file in os.listdir(params['temp_wd']):
-            file_path = os.path.join(params['temp_wd'], the_file)
-            try:
-                if os.path.isfile(file_path):
-                    if "QuartetSampling" not in file_path:
-                        print(file_path,
-                              " does not contain 'QuartetSampling' "
-                              "and will not be deleted for safety")
-                    else:
-                        os.remove(file_path)
-            except FileNotFoundError as exc:
-                print(file_path, " not found")
-        if 'QuartetSampling' in params['temp_wd']:
-            os.rmdir(params['temp_wd'])
+    # wait for the remaining nodes to finish; after a stop request only
+    # what is already running is kept and the rest is left to a resume
+    scheduler.close()
+    if stop.is_set():
+        if cache is not None:
+            cache.close()
+        maindata.close()
+        journal.close()
+        remove_temp_files(params)
+        print(("\ninterrupted, completed replicates are saved in {}\n"
+               "run the same command again to resume").format(
+                   params['journal_file_path']))
+        sys.exit(128 + stop.signum)
+    stop.restore()
+    if cache is not None:
+        repstats.update(cache.stats())
+        cache.close()
+    remove_temp_files(params)
     qf_scores = maindata.write_qf_scores(params["score_result_file_path"])
-    treedata.write_figtree(params['figtree_file_path'], qf_scores)
-    treedata.write_scoretrees(params)
+    maindata.close()
+    treedata.write_trees(params, qf_scores)
     write_run_stats(repstats, params)
+    journal.close(remove=True)
     print(("\ndone.\nscores written to: {}\nlabeled "
            "tree written to: {}\ntotal time {:.2f} hours").format(
                params['score_result_file_path'],
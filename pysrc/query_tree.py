@@ -8,11 +8,12 @@ when using the post-run annotated trees.
 http://www.github.com/FePhyFoFum/quartetsampling
 """
 
+import csv
 import os
 import sys
 import argparse
 from tree_data import TreeData
-from phylo.tree_utils import get_mrca
+from phylo.tree_utils import LCAIndex, get_mrca
 
 
 LICENSE = """
@@ -45,6 +46,14 @@ def generate_argparser():
     parser.add_argument('--data', type=os.path.abspath, nargs=1,
                         help=("CSV output from quartet_sampling"
                               " (RESULT.node.score.csv)"))
+    parser.add_argument('--queries', type=os.path.abspath, nargs=1,
+                        help=("file with one query per line (node names "
+                              "separated by commas, optionally preceded by "
+                              "a query name and ':'), answered without "
+                              "prompting"))
+    parser.add_argument('--out', type=os.path.abspath, nargs=1,
+                        help=("output CSV for --queries (default is "
+                              "the query file name + .profiles.csv)"))
     parser.add_argument("--clade", nargs=1, help=argparse.SUPPRESS)
     parser.add_argument("--verbose", action="store_true",
                         help="verbose screen output")
@@ -54,6 +63,130 @@ def generate_argparser():
     return parser
 
 
+def naround(num):
+    """Round to two digits unless value is NA
+    """
+    return 'NA' if num == 'NA' else round(float(num), 2)
+
+
+def subtree_summaries(tree):
+    """Number of tips, first tip label and the sum and count of the tip
+       QF scores below every node (one postorder pass)
+    """
+    summaries = {}
+    for xnode in tree.iternodes(order="postorder"):
+        if xnode.istip:
+            qf = xnode.data.get('qf', 'NA')
+            summaries[xnode] = ((1, xnode.label, 0.0, 0) if qf == 'NA' else
+                                (1, xnode.label, float(qf), 1))
+        else:
+            summaries[xnode] = merge_summaries(
+                [summaries[x] for x in xnode.children])
+    return summaries
+
+
+def merge_summaries(summaries):
+    """Summary of a group of subtrees"""
+    return (sum(x[0] for x in summaries),
+            summaries[0][1] if summaries else '',
+            sum(x[2] for x in summaries),
+            sum(x[3] for x in summaries))
+
+
+def clade_groups(mrca, summaries):
+    """Summaries of the four groups around the branch of the MRCA: its
+       two daughter subtrees, the sibling subtree(s) and the rest of the
+       tree.  Groups that do not exist next to the root are None.
+    """
+    groups = [summaries[x] for x in mrca.children[:2]]
+    groups.extend([None] * (2 - len(groups)))
+    parent = mrca.parent
+    if parent is None:
+        return groups + [None, None]
+    groups.append(merge_summaries([summaries[x] for x in parent.children
+                                   if x is not mrca]))
+    if parent.parent is None:
+        return groups + [None]
+    root = parent
+    while root.parent is not None:
+        root = root.parent
+    total = summaries[root]
+    inside = summaries[parent]
+    example = [summaries[x][1] for x in parent.parent.children
+               if x is not parent]
+    groups.append((total[0] - inside[0], example[0] if example else '',
+                   total[2] - inside[2], total[3] - inside[3]))
+    return groups
+
+
+def mean_qf(group):
+    """Mean QF score of the tips of a group"""
+    return group[2] / group[3] if group[3] else 'NA'
+
+
+def print_profile(mrca, summaries):
+    """Print the scores and four-group profile of a node"""
+    print("MRCA FOUND", mrca.label)
+    print(mrca.data)
+    print("SCORE={}/{}/{}".format(
+        naround(mrca.data.get('qc', 'NA')),
+        naround(mrca.data.get('qd', 'NA')),
+        naround(mrca.data.get('qi', 'NA')),
+        ))
+    print("TREE divided in to four groups:")
+    for i, group in enumerate(clade_groups(mrca, summaries)):
+        if group is None:
+            print("is root")
+            break
+        print("GROUP{} has {} tips "
+              "including {}, with meanQF={}".format(
+                  i, group[0], group[1], mean_qf(group)))
+    return ''
+
+
+def answer_queries(queryfpath, outfpath, nodes, treedata, summaries):
+    """Write the scores and four-group profiles of the MRCA of every
+       query in the query file to a CSV file
+    """
+    lca_index = LCAIndex(treedata.tree)
+    nqueries = 0
+    header = (["query", "mrca", "qc", "qd", "qi"] +
+              ["group{}_{}".format(i, x) for i in range(4)
+               for x in ("ntips", "tip", "meanqf")])
+    with open(queryfpath) as queryfile, open(outfpath, 'w',
+                                             newline='') as outfile:
+        # labels may contain commas or quotes
+        writer = csv.writer(outfile)
+        writer.writerow(header)
+        for line in queryfile:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            qname, _, names = line.rpartition(':')
+            names = [x.strip() for x in names.split(',') if x.strip()]
+            qname = qname.strip() or ";".join(names)
+            missing = [x for x in names if x not in nodes]
+            if missing or not names:
+                print("query {}: {} not found in the tree".format(
+                    qname, ",".join(missing)))
+                writer.writerow([qname] + ["NA"] * (len(header) - 1))
+                continue
+            if len(names) == 1:
+                mrca = nodes[names[0]]
+            else:
+                mrca = get_mrca([nodes[x] for x in names], treedata.tree,
+                                lca_index=lca_index)
+            row = [qname, mrca.label] + [mrca.data.get(x, 'NA')
+                                         for x in ('qc', 'qd', 'qi')]
+            for group in clade_groups(mrca, summaries):
+                row.extend(["NA"] * 3 if group is None else
+                           [group[0], group[1], mean_qf(group)])
+            writer.writerow(row)
+            nqueries += 1
+    print("{} queries answered, written to {}".format(nqueries, outfpath))
+    return ''
+
+
 def main(arguments=None):
     """Main method for query_tree.py
     """
@@ -83,7 +216,6 @@ def main(arguments=None):
     print("data read")
     # args.nodes = args.nodes[0].split(',')
     nodes = {}
-    parent = {}
     k = 1
     ntotal = 0
     for xnode in treedata.tree.iternodes():
@@ -92,13 +224,17 @@ def main(arguments=None):
             xnode.label = str(k)
         xlabel = xnode.label
         nodes[xlabel] = xnode
-        for xchild in xnode.children:
-            parent[xchild] = xnode
         if xlabel not in data:
             continue
         xnode.data.update([(hdr[i], data[xlabel][i])for i in range(len(hdr))])
         if xnode.istip:
             ntotal += 1
+    summaries = subtree_summaries(treedata.tree)
+    if args.queries is not None:
+        outfpath = (args.out[0] if args.out is not None else
+                    "{}.profiles.csv".format(args.queries[0]))
+        return answer_queries(args.queries[0], outfpath, nodes, treedata,
+                              summaries)
     ret = ''
     print(ntotal, "total nodes in tree")
     print("Get MRCA data based on two nodes, separated by a comma")
@@ -112,59 +248,7 @@ def main(arguments=None):
                 mrca = nodes[ret[0]]
             else:
                 mrca = get_mrca([nodes[x] for x in ret], treedata.tree)
-            print("MRCA FOUND", mrca.label)
-            print(mrca.data)
-
-            def naround(num):
-                """Round to two digits unless value is NA
-                """
-                return 'NA' if num == 'NA' else round(float(num), 2)
-
-            print("SCORE={}/{}/{}".format(
-                naround(mrca.data['qc']),
-                naround(mrca.data['qd']),
-                naround(mrca.data['qi']),
-                ))
-            print("TREE divided in to four groups:")
-
-            def node_profile(xnode, grp):
-                """Get profile of a specific node in the tree
-                """
-                ntip = 0
-                tipname = ''
-                qfscores = []
-                for ynode in xnode.iternodes():
-                    if ynode.istip:
-                        if tipname == '':
-                            tipname = ynode.label[:]
-                        ntip += 1
-                        if 'qf' in ynode.data:
-                            qfscores.append(float(ynode.data['qf']))
-                print("GROUP{} has {} tips "
-                      "including {}, with meanQF={}".format(
-                          grp, ntip, tipname, sum(qfscores)/len(qfscores)))
-                return ntip
-            ntip1 = node_profile(mrca.children[0], 0)
-            ntip2 = node_profile(mrca.children[1], 1)
-            mrca_parent = parent[mrca]
-            if mrca_parent == treedata.tree:
-                print("is root")
-            else:
-                for child in mrca_parent.children:
-                    if child != mrca:
-                        ntip3 = node_profile(child, 2)
-            mrca_grandparent = parent[mrca_parent]
-            if mrca_grandparent == treedata.tree:
-                print("is root")
-            else:
-                ntip4 = ntotal - (ntip1 + ntip2 + ntip3)
-                for child in mrca_grandparent.children:
-                    if child != mrca_parent:
-                        for xnode in child.iternodes():
-                            if xnode.istip:
-                                print("GROUP3 has {} tips including {}".format(
-                                    ntip4, xnode.label))
-                                break
+            print_profile(mrca, summaries)
         except Exception as exc:
             print(exc, sys.exc_info())
             print("error, try again or enter 'quit' to quit")
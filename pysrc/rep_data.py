@@ -21,24 +21,46 @@ You should have received a copy of the GNU General Public License
 along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import asyncio
+import json
 import os
 import random
 import math
 import subprocess
-from itertools import product
+import time
+from collections import Counter
 from shutil import copyfile
 from phylo import tree_reader
 from phylo import tree_utils
 
 
+# columns of the --results-npz output
+NPZ_COLUMNS = (('node_label', str), ('is_tip', bool),
+               ('count0', 'i8'), ('count1', 'i8'), ('count2', 'i8'),
+               ('count3', 'i8'), ('freq0', 'f8'), ('qc', 'f8'),
+               ('qd', 'f8'), ('qi', 'f8'), ('qdsig', 'f8'), ('qf', 'f8'),
+               ('diff', 'f8'), ('num_replicates', 'f8'))
+# process groups of the engines started by async_engines runs, so that
+# they can be killed if the run is aborted
+RUNNING_ENGINES = set()
+
+
+class ReplicateSkipped(Exception):
+    """Raised instead of starting an engine once a stop was requested"""
+
+
 class DataStore():
     """Main data storage and output functions"""
 
+    # output buffer size and seconds between flushes of the result files
+    buffer_size = 1 << 20
+    flush_interval = 30
+
     def __init__(self, params):
         self.tree_counts = {}
         self.leaf_counts = {}
         self.node_replicates = {}
+        self.last_results = {}
         for dirname in (params['results_dir'], params['temp_wd']):
             if not os.path.exists(dirname):
                 print("creating {}".format(dirname))
@@ -53,57 +75,115 @@ class DataStore():
                         "nodecounts": ['node_label',
                                        'count0', 'count1', 'count2',
                                        'topo0', 'topo1', 'topo2']}
+        # result files stay open (buffered) until close()
+        self.outfiles = {}
+        self.last_flush = time.time()
+        self.npz_file_path = params.get('results_npz_path')
+        self.records = []
+
+    def output(self, file_path, mode="a"):
+        """Open (or reuse) the buffered handle of an output file"""
+        if mode == "w" and file_path in self.outfiles:
+            self.outfiles.pop(file_path).close()
+        if file_path not in self.outfiles:
+            self.outfiles[file_path] = open(file_path, mode,
+                                            buffering=self.buffer_size)
+        return self.outfiles[file_path]
+
+    def verbout(self, params):
+        """Handle of the --verbout file (None if not requested)"""
+        if params['verbout'] is not True:
+            return None
+        return self.output(params['verbout_file_path'])
 
     def write_headers(self, file_path, restype="main", delim=","):
         """Write the headers into the file"""
-        with open(file_path, "w") as resultsfile:
-            resultsfile.write("{}\n".format(delim.join(self.headers[restype])))
+        self.output(file_path, "w").write(
+            "{}\n".format(delim.join(self.headers[restype])))
         return ''
 
     def write_entry(self, file_path, entry, restype="main", delim=","):
         """Add an entry to the file"""
-        with open(file_path, "a") as resultsfile:
-            resultsfile.write("{}\n".format(delim.join([
-                str(entry.get(x, "NA")) for x in self.headers[restype]])))
+        self.output(file_path).write("{}\n".format(delim.join([
+            str(entry.get(x, "NA")) for x in self.headers[restype]])))
+        if time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+        return ''
+
+    def flush(self):
+        """Write the buffered entries to the result files"""
+        for outfile in self.outfiles.values():
+            outfile.flush()
+        self.last_flush = time.time()
+        return ''
+
+    def close(self):
+        """Flush and close the result files, write the .npz results"""
+        for outfile in self.outfiles.values():
+            outfile.close()
+        self.outfiles = {}
+        if self.npz_file_path is not None:
+            write_results_npz(self.npz_file_path, self.records)
+        return ''
+
+    def add_rep_result(self, fnode, result, params):
+        """Add the result of one replicate to the counts of its node"""
+        if fnode not in self.tree_counts:
+            self.tree_counts[fnode] = {}
+        rep_info = {'diff_exceeds_cutoff': None,
+                    'best_tree': None,
+                    'likelihood_diff': None}
+        if params['verbose']:
+            print("---")
+            print("Seqnames: ", result['seq_names'])
+        if params['engine'] == 'paup':
+            # using paup
+            rep_info = result
+        else:
+            rep_info = result
+        if rep_info['diff_exceeds_cutoff'] is False:
+            rep_info['best_tree'] = 3
+        # case of not exceeding the likelihood = tree 3 for QI calc
+        self.tree_counts[fnode][rep_info['best_tree']] = (
+            self.tree_counts[fnode].get(rep_info['best_tree'], 0) + 1)
+        for seqname in result['seq_names'].values():
+            if seqname not in self.leaf_counts:
+                self.leaf_counts[seqname] = {}
+            self.leaf_counts[seqname][rep_info['best_tree']] = (
+                self.leaf_counts[seqname].get(
+                    rep_info['best_tree'], 0) + 1)
+        # only the last result is kept (for the diff and example topologies)
+        self.last_results[fnode] = result
         return ''
 
-    def process_rep_results(self, fnode, results_queue, params, nreplicates):
-        """Process the output from a replicate"""
+    def provisional_scores(self, fnode, ncompleted, nreplicates, params):
+        """Counts and scores of a node from the replicates done so far"""
+        counts = self.tree_counts.get(fnode, {})
+        qscores = calc_qc_qd_qi(counts, dict(params, verbose=False,
+                                             calc_qdstats=False))
+        status = {'node_label': fnode.label,
+                  'completed': ncompleted,
+                  'num_replicates': nreplicates}
+        for x in (0, 1, 2, 3):
+            status['count{}'.format(x)] = counts.get(x, 0)
+        for x in ('freq0', 'qc', 'qd', 'qi'):
+            status[x] = qscores[x]
+        return status
+
+    def process_rep_results(self, fnode, params, nreplicates):
+        """Process the results of a node whose replicates have all been
+           added with add_rep_result
+        """
         record_detail = False
         detail_name_sets = []
         detail_tree_sets = []
         notes = ''
         tree_counts_detailed = 0
-        if fnode not in self.tree_counts:
-            self.tree_counts[fnode] = {}
-        while not results_queue.empty():
-            result = results_queue.get()
-            rep_info = {'diff_exceeds_cutoff': None,
-                        'best_tree': None,
-                        'likelihood_diff': None}
-            if params['verbose']:
-                print("---")
-                print("Seqnames: ", result['seq_names'])
-            if params['engine'] == 'paup':
-                # using paup
-                rep_info = result
-            else:
-                rep_info = result
-            if rep_info['diff_exceeds_cutoff'] is False:
-                rep_info['best_tree'] = 3
-            # case of not exceeding the likelihood = tree 3 for QI calc
-            self.tree_counts[fnode][rep_info['best_tree']] = (
-                self.tree_counts[fnode].get(rep_info['best_tree'], 0) + 1)
-            for seqname in result['seq_names'].values():
-                if seqname not in self.leaf_counts:
-                    self.leaf_counts[seqname] = {}
-                self.leaf_counts[seqname][rep_info['best_tree']] = (
-                    self.leaf_counts[seqname].get(
-                        rep_info['best_tree'], 0) + 1)
+        result = rep_info = self.last_results.pop(fnode)
         # calcluate the q scores
         # qc_score, qd_score, qi_score, freq0
         qscores = calc_qc_qd_qi(
-            self.tree_counts[fnode], params)
+            self.tree_counts[fnode], params, self.verbout(params))
         fnode.data["qc_score"] = na_fmt(qscores['qc'])
         fnode.data["qd_score"] = na_fmt(qscores['qd'])
         fnode.data["qd_sig"] = na_fmt(qscores['qdsig'])
@@ -148,6 +228,8 @@ class DataStore():
                               result['seq_names']["R1"],
                               result['seq_names']["L2"])
                          }, restype='nodecounts', delim='\t')
+        self.add_record(fnode.label, False, self.tree_counts[fnode], qscores,
+                        rep_info['likelihood_diff'], nreplicates)
         if record_detail:
             detail_name_sets.append(set(result["seq_names"].values()))
             detail_tree_sets.append(rep_info['best_tree'])
@@ -169,7 +251,7 @@ class DataStore():
                 self.write_headers(clade_file_path, restype="clade")
                 for xnode in fnode_dict:
                     nqscores = calc_qc_qd_qi(
-                        fnode_dict[xnode], params)
+                        fnode_dict[xnode], params, self.verbout(params))
                     self.write_entry(clade_file_path, {
                         "taxon": entry,
                         "tree1": fnode_dict[xnode][0],
@@ -198,6 +280,8 @@ class DataStore():
              "freq0": 0,
              "num_replicates": nreplicates,
              "notes": 'found no suitable replicates'})
+        self.add_record(fnode.label, False, {}, {'freq0': 0}, None,
+                        nreplicates)
         return ''
 
     def write_qf_scores(self, outfile):
@@ -211,8 +295,39 @@ class DataStore():
                 outfile, {"node_label": fnode, "qf": qf_score,
                           "num_replicates": total, "notes": ''})
             qf_scores[fnode] = qf_score + 0.0
+            self.add_record(fnode, True, self.leaf_counts[fnode],
+                            {'qf': qf_score}, None, total)
         return qf_scores
 
+    def add_record(self, label, is_tip, counts, qscores, diff, nreplicates):
+        """Keep a row of the .npz results (if requested)"""
+        if self.npz_file_path is None:
+            return ''
+        self.records.append(
+            (label, is_tip) +
+            tuple(counts.get(x, 0) for x in (0, 1, 2, 3)) +
+            tuple(na_float(qscores.get(x)) for x in (
+                'freq0', 'qc', 'qd', 'qi', 'qdsig', 'qf')) +
+            (na_float(diff), nreplicates))
+        return ''
+
+
+def na_float(num):
+    """Float value, or NaN for NA and missing values"""
+    return float('nan') if num is None or num == 'NA' else float(num)
+
+
+def write_results_npz(fpath, records):
+    """Write the node and taxon results as typed columns (NumPy .npz),
+       one row per node (is_tip False) or taxon with a QF score
+    """
+    import numpy as np
+    columns = list(zip(*records)) or [()] * len(NPZ_COLUMNS)
+    np.savez(fpath, **dict(
+        (name, np.array(values, dtype=dtype))
+        for (name, dtype), values in zip(NPZ_COLUMNS, columns)))
+    return ''
+
 
 def na_fmt(num):
     """Formats float or returns NA"""
@@ -237,8 +352,10 @@ def chi2_test(val0, val1):
         return (0, 1)
 
 
-def calc_qc_qd_qi(counts, params):
-    """Calculate the QC, QD, and QI scores"""
+def calc_qc_qd_qi(counts, params, verbout=None):
+    """Calculate the QC, QD, and QI scores
+       (the frequencies and scores are added to verbout if given)
+    """
     if params['verbose'] is True:
         print(counts)
     total = float(sum(counts.get(x, 0) for x in (0, 1, 2)))
@@ -269,116 +386,225 @@ def calc_qc_qd_qi(counts, params):
             _, qd_sig = chi2_test(counts.get(1, 0), counts.get(2, 0))
         qi_score = ('NA' if params['lnlikethresh'] == 0
                     else (1.0 - (counts.get(3, 0) / utotal)))
-        if params['verbout'] is True:
-            with open(params['verbout_file_path'], 'a') as vfile:
-                vfile.write('{}\n'.format(','.join([
-                    str(x) for x in ufreqs + [
-                        qc_score, qd_score, qi_score]])))
+        if verbout is not None:
+            verbout.write('{}\n'.format(','.join([
+                str(x) for x in ufreqs + [qc_score, qd_score, qi_score]])))
         qscores = {'qc': qc_score,
                    'qd': qd_score, 'qdsig': qd_sig,
                    'qi': qi_score, 'freq0': freqs[0]}
     return qscores
 
 
-def empty_rep(j, fnode, lock, results_queue, n_completed, params):
+def empty_rep(j, fnode, params):
     """Create empty replicate object"""
     rep = params.copy()
-    rep["queue"] = results_queue
-    rep["lock"] = lock
     rep["node_id"] = fnode.label
     rep["replicate_id"] = str(j)
-    rep["n_completed"] = n_completed
     rep["seqs"] = {}
     rep["seq_names"] = {}
     rep["genename"] = None
     return rep
 
 
-def get_replicates_exhaustive(n_completed, results_queue, leafsets,
-                              params, aln, fnode, lock):
-    """Get a single sampling replicate set"""
+def compress_site_patterns(seqs):
+    """Collapse identical alignment columns into unique site patterns
+       Returns the pattern sequences (keyed as seqs) and the number of
+       original columns represented by each pattern
+    """
+    names = list(seqs)
+    counts = Counter(zip(*[seqs[x].upper() for x in names]))
+    patterns = list(counts)
+    pattern_seqs = dict(
+        (name, ''.join(pattern[i] for pattern in patterns))
+        for i, name in enumerate(names))
+    return pattern_seqs, [counts[x] for x in patterns]
+
+
+def write_replicate_files(rep, params, cache=None):
+    """Write the temporary engine input files for an accepted replicate.
+       If the result is already in the cache it is attached to the
+       replicate instead and no files are written.
+    """
+    # generate labels for temp files
+    rep["unique_label"] = "{}.{}".format(
+        rep["node_id"], rep["replicate_id"])
+    rep["aln_fname"] = os.path.join(
+        params['temp_wd'],
+        "temp_inseqs.{}".format(rep["unique_label"]))
+    if cache is not None:
+        rep['cache_key'] = cache.replicate_key(rep['seqs'])
+        rep['cached_result'] = cache.lookup(rep['cache_key'], rep)
+        if rep['cached_result'] is not None:
+            del rep['seqs']
+            return ''
+    if params['compress_patterns']:
+        rep['seqs'], rep['site_weights'] = compress_site_patterns(
+            rep['seqs'])
+    if rep['engine'] == 'native':
+        # the built-in engine works on the sequences directly
+        return ''
+    if rep['engine'] == 'paup':
+        write_paup(rep["aln_fname"], rep["seqs"],
+                   datatype=rep["data_type"],
+                   quit_paup=rep["engine_batch_size"] < 2,
+                   weights=rep.get('site_weights'))
+    else:
+        write_raxml(rep["aln_fname"], rep["seqs"])
+        if params['compress_patterns']:
+            rep['weights_fname'] = os.path.join(
+                params['temp_wd'],
+                "temp_weights.{}".format(rep["unique_label"]))
+            write_site_weights(rep['weights_fname'], rep['site_weights'])
+            del rep['site_weights']
+    del rep["seqs"]
+    if rep["using_partitions"]:
+        # make a copy of the partitions file
+        newpartfile = os.path.join(
+            params['temp_wd'],
+            "temp_parts.{}".format(rep["unique_label"]))
+        copyfile(params['partitions_file_path'], newpartfile)
+        rep["part_fname"] = newpartfile[:]
+    return ''
+
+
+def quartet_axes(leafsets, params, aln):
+    """Index the choices for each position of a quartet:
+       the L1, L2, R1 and R2 leaf sets (LeafRange, indexed in place)
+       and the genes
+    """
+    axes = [leafsets[x] for x in ('L1', 'L2', 'R1', 'R2')]
+    axes.append(list(aln.genes) if params['using_genetrees'] else [None])
+    return axes
+
+
+def random_permutation(npossible):
+    """Yield range(npossible) in random order, drawing lazily without
+       replacement (a Fisher-Yates shuffle that only stores the swapped
+       positions), so each draw is O(1) in time and memory
+    """
+    swapped = {}
+    for i in range(npossible):
+        j = random.randrange(i, npossible)
+        value = swapped.get(j, j)
+        if j != i:
+            swapped[j] = swapped.pop(i, i)
+        else:
+            swapped.pop(i, None)
+        yield value
+
+
+def encode_quartet(quartet, axes_index):
+    """Mixed-radix index of (L1, L2, R1, R2, gene), the inverse of
+       decode_quartet ('axes_index' maps each axis item to its position)
+    """
+    index = 0
+    for item, positions in zip(quartet, axes_index):
+        index = index * len(positions) + positions[item]
+    return index
+
+
+def done_quartet_indices(done, axes):
+    """Indices of the quartets in the results from an earlier run"""
+    if not done:
+        return set([])
+    axes_index = [dict((item, i) for i, item in enumerate(axis))
+                  for axis in axes]
+    return set(encode_quartet([x['seq_names'][y] for y in
+                               ('L1', 'L2', 'R1', 'R2')] +
+                              [x.get('genename')], axes_index)
+               for x in done)
+
+
+def quartet_replicate(quartet, rep_id, fnode, params, aln):
+    """Build the replicate record for an accepted quartet"""
+    rep = empty_rep(rep_id, fnode, params)
+    genename = quartet[4]
+    for i, subtree_name in enumerate(['L1', 'L2', 'R1', 'R2']):
+        leaf_name = quartet[i]
+        if params['using_genetrees']:
+            rep['genename'] = genename[:]
+            rep['seqs'][subtree_name] = aln.seqs[genename][leaf_name]
+        else:
+            rep['seqs'][subtree_name] = aln.seqs[leaf_name]
+        rep['seq_names'][subtree_name] = leaf_name
+    return rep
+
+
+def decode_quartet(index, axes):
+    """Convert a mixed-radix quartet index into (L1, L2, R1, R2, gene)"""
+    quartet = []
+    for axis in reversed(axes):
+        index, pos = divmod(index, len(axis))
+        quartet.append(axis[pos])
+    return tuple(reversed(quartet))
+
+
+def get_replicates_exhaustive(leafsets, params, aln, fnode, cache=None,
+                              done=None):
+    """Get a single sampling replicate set
+       'done' holds results of the node from an earlier run, those
+       quartets are not sampled again and count towards the total.
+    """
     replicates = []
     repstats = {}
-    # need to make sure we don't repeat, so generate all the quartets
-    if params['using_genetrees']:
-        possible_quartets = list(product(leafsets['L1'], leafsets['L2'],
-                                         leafsets['R1'], leafsets['R2'],
-                                         aln.genes))
-    else:
-        possible_quartets = list(product(leafsets['L1'], leafsets['L2'],
-                                         leafsets['R1'], leafsets['R2'],
-                                         [None]))
+    done = done if done is not None else []
+    nreps = params['nreps'] - len(done)
+    # need to make sure we don't repeat, so draw the quartets without
+    # replacement from the index space of all possible quartets
+    axes = quartet_axes(leafsets, params, aln)
+    done_quartets = done_quartet_indices(done, axes)
+    n_possible_quartets = 1
+    for axis in axes:
+        n_possible_quartets *= len(axis)
     # look through them in random order for suitable ones
     nonoverlapping_count = 0
-    while len(replicates) < params['nreps'] and possible_quartets:
-        proposed_quartet = random.sample(possible_quartets, 1)[0]
-        possible_quartets.remove(proposed_quartet)
+    for index in random_permutation(n_possible_quartets):
+        if len(replicates) >= nreps:
+            break
+        if index in done_quartets:
+            continue
+        proposed_quartet = decode_quartet(index, axes)
         if aln.check_aln_overlap(proposed_quartet) is False:
             nonoverlapping_count += 1
             if params['verbose']:
                 print('non-overlap count: {}'.format(nonoverlapping_count))
             continue
         # if we made it here then the proposed rep is acceptable
-        rep = empty_rep(len(replicates), fnode, lock,
-                        results_queue, n_completed, params)
-        for i, subtree_name in enumerate(['L1', 'L2', 'R1', 'R2']):
-            leaf_name = proposed_quartet[i]
-            if params['using_genetrees']:
-                rgenename = proposed_quartet[4]
-                rep['genename'] = rgenename[:]
-                rep['seqs'][subtree_name] = aln.seqs[rgenename][leaf_name]
-                rep['seq_names'][subtree_name] = leaf_name
-            else:
-                rep['seqs'][subtree_name] = aln.seqs[leaf_name]
-                rep['seq_names'][subtree_name] = leaf_name
+        rep = quartet_replicate(proposed_quartet, len(done) + len(replicates),
+                                fnode, params, aln)
         replicates.append(rep)
-        rep["unique_label"] = "{}.{}".format(
-            rep["node_id"], rep["replicate_id"])
-        rep["aln_fname"] = os.path.join(
-            params['temp_wd'],
-            "temp_inseqs.{}".format(rep["unique_label"]))
         # write file for successful rep
-        if rep['engine'] == 'paup':
-            write_paup(rep["aln_fname"], rep["seqs"],
-                       datatype=rep["data_type"])
-        else:
-            if params["low_mem"] is True:
-                # print(rep['seqs'], rep['seq_names'])
-                cat_raxml(rep["aln_fname"], rep["seqs"], rep["seq_names"])
-            else:
-                write_raxml(rep["aln_fname"], rep["seqs"])
-        del rep["seqs"]
-        if rep["using_partitions"]:
-            # make a copy of the partitions file
-            newpartfile = os.path.join(
-                params['temp_wd'],
-                "temp_parts.{}".format(rep["unique_label"]))
-            copyfile(params['partitions_file_path'], newpartfile)
-            rep["part_fname"] = newpartfile[:]
-    if len(replicates) < 1:
+        write_replicate_files(rep, params, cache=cache)
+    if len(done) + len(replicates) < 1:
         print('WARNING: generated all possible quartets '
               'and did not find a suitable one! If you have the -O '
               'flag enabled, alignment may not have enough data at '
               'this edge (i.e. low partial decisiveness).')
-    elif len(replicates) < params['nreps']:
+    elif len(done) + len(replicates) < params['nreps']:
         print('WARNING: only {} suitable replicates for this node.'.format(
-            len(replicates)))
+            len(done) + len(replicates)))
     repstats['nonoverlapping_count'] = nonoverlapping_count + 0
     return replicates, repstats
 
 
-def get_replicates_random(n_completed, results_queue, leafsets,
-                          params, aln, fnode, lock):
-    """Get random replicate quartets using full sampling"""
+def get_replicates_random(leafsets, params, aln, fnode, cache=None,
+                          done=None):
+    """Get random replicate quartets using full sampling
+       'done' holds results of the node from an earlier run, those
+       quartets are not sampled again and count towards the total.
+    """
     replicates = []
     repstats = {}
+    done = done if done is not None else []
+    # index the leaf sets once, a quartet is then a single random integer
+    # in the mixed-radix space of all (L1, L2, R1, R2, gene) choices,
+    # which also serves as its key for the duplicate check
+    axes = quartet_axes(leafsets, params, aln)
     n_possible_replicates = 1
-    for leafset in leafsets.values():
-        n_possible_replicates *= len(leafset)
-    if params['using_genetrees']:
-        n_possible_replicates *= len(aln.seqs)
-    observed_quartets = set([])
-    for j in range(params['nreps']):
+    for axis in axes:
+        n_possible_replicates *= len(axis)
+    observed_quartets = done_quartet_indices(done, axes)
+    for j in range(len(done), params['nreps']):
         if params['verbose']:
             print('looking for unique replicate {}'.format(j))
         rep = None
@@ -394,49 +620,30 @@ def get_replicates_random(n_completed, results_queue, leafsets,
         # loop until we find an acceptable replicate, or we hit the
         # maximum allowed proportion to attempt
         while attempted_count < max_attempts:
-            proposed_quartet = set()
-            proposed_rep = empty_rep(len(replicates), fnode, lock,
-                                     results_queue, n_completed, params)
             # generate a random replicate
-            rgenename = None
-            if params['using_genetrees']:
-                rgenename = aln.get_random_gene()
-            for subtree_name, leaf_names in leafsets.items():
-                randleaf = random.sample(list(leaf_names), 1)[0]
-                # should really be doing this check when loading files
-                if params['using_genetrees']:
-                    if randleaf not in aln.seqs[rgenename]:
-                        raise RuntimeError(
-                            "FATAL ERROR: name {} not in alignment".format(
-                                randleaf))
-                    if params['verbose']:
-                        print(" {} = {}".format(subtree_name, randleaf))
-                    proposed_rep['seq_names'][subtree_name] = randleaf
-                    proposed_rep['genename'] = rgenename[:]
-                    proposed_rep['seqs'][subtree_name] = (
-                        aln.seqs[rgenename][randleaf])
-                else:
-                    if randleaf not in aln.seqs:
-                        raise RuntimeError(
-                            "FATAL ERROR: name {} not in alignment".format(
-                                randleaf))
-                    if params['verbose']:
-                        print(" {} = {}".format(subtree_name, randleaf))
-                    proposed_rep['seqs'][subtree_name] = aln.seqs[randleaf]
-                    proposed_rep['seq_names'][subtree_name] = randleaf
-                proposed_quartet.add(randleaf)
-            proposed_quartet = tuple(list(sorted(proposed_quartet)) +
-                                     [rgenename])
+            index = random.randrange(n_possible_replicates)
             attempted_count += 1
-            if proposed_quartet in observed_quartets:
+            if index in observed_quartets:
                 duplicate_count += 1
                 if params['verbose']:
                     print('duplicate count= ', duplicate_count,
                           ', possible=', n_possible_replicates)
                 continue
             # quartet is unique, remember that we tried it
-            observed_quartets.add(proposed_quartet)
+            observed_quartets.add(index)
             observed_count += 1
+            proposed_quartet = decode_quartet(index, axes)
+            if params['verbose']:
+                print(" L1 = {}\n L2 = {}\n R1 = {}\n R2 = {}".format(
+                    *proposed_quartet[:4]))
+            # should really be doing this check when loading files
+            seqs = (aln.seqs[proposed_quartet[4]]
+                    if params['using_genetrees'] else aln.seqs)
+            for leaf_name in proposed_quartet[:4]:
+                if leaf_name not in seqs:
+                    raise RuntimeError(
+                        "FATAL ERROR: name {} not in alignment".format(
+                            leaf_name))
             if aln.check_aln_overlap(proposed_quartet) is False:
                 nonoverlapping_count += 1
                 if params['verbose']:
@@ -446,34 +653,13 @@ def get_replicates_random(n_completed, results_queue, leafsets,
                               n_possible_replicates))
                 continue
             # if we made it here then the proposed rep is acceptable
-            rep = proposed_rep
+            rep = quartet_replicate(proposed_quartet, len(done) +
+                                    len(replicates), fnode, params, aln)
             if params['verbose']:
                 print("passed taxa", ",".join(list(proposed_quartet[:4])))
-                print("passed gene {}".format(rgenename))
-            # generate labels for temp files
-            rep["unique_label"] = "{}.{}".format(
-                rep["node_id"], rep["replicate_id"])
-            rep["aln_fname"] = os.path.join(
-                params['temp_wd'],
-                "temp_inseqs.{}".format(rep["unique_label"]))
+                print("passed gene {}".format(proposed_quartet[4]))
             # write file for successful rep
-            if rep['engine'] == 'paup':
-                write_paup(rep["aln_fname"], rep["seqs"],
-                           datatype=rep['data_type'])
-            else:
-                if params["low_mem"] is True:
-                    cat_raxml(rep["aln_fname"], rep["seqs"], rep["seq_names"])
-                else:
-                    write_raxml(rep["aln_fname"], rep["seqs"])
-            del rep["seqs"]
-            if rep["using_partitions"]:
-                # make a copy of the partitions file
-                newpartfile = os.path.join(
-                    params['temp_wd'],
-                    "temp_parts.{}".format(rep["unique_label"]))
-                copyfile(params['partitions_file_path'], newpartfile)
-                rep["part_fname"] = newpartfile[:]
-                # make a copy of the partitions file
+            write_replicate_files(rep, params, cache=cache)
             break
         # if there is no rep, then we hit the max number of attempts
         if rep is None:
@@ -494,48 +680,128 @@ def get_replicates_random(n_completed, results_queue, leafsets,
     return replicates, repstats
 
 
-def process_replicate_raxml(replicate):
-    """Process individual replicate sampling"""
+def check_stop_flag(stop_flag, nreplicates):
+    """Raise ReplicateSkipped if the scheduler has asked to stop"""
+    if stop_flag is not None and stop_flag.is_set():
+        raise ReplicateSkipped(
+            "{} replicate(s) left for a resumed run".format(nreplicates))
+    return ''
+
+
+def process_replicate(replicate, setup_func, parse_func):
+    """Run the engine for an individual replicate and parse its output"""
     os.chdir(replicate["temp_wd"])
-    temp_file_paths = [replicate['aln_fname'],
-                       "{}.reduced".format(replicate['aln_fname'])]
-    # just alias dictionary elements for convenience
-    result = {"label": replicate['unique_label']}
-    result["seq_names"] = replicate["seq_names"].copy()
-    # generate a label that will be unique within this run
-    #  (but probably not among runs!)
-    temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
-    engine_args = [replicate['engine_executable'],
-                   "-s", replicate['aln_fname'],
-                   "-m", replicate['engine_model'],
-                   "-T", "1",
-                   "-p", "11341",
-                   "--silent",
-                   "-F",
-                   "-n", temp_ml_search_label]
-    if replicate['using_partitions']:
-        temp_file_paths.extend([replicate['part_fname'],
-                                "{}.reduced".format(replicate['part_fname'])])
-        engine_args.extend(["-q", replicate["part_fname"]])
-    result["engine_args"] = " ".join(engine_args)
+    engine_args, temp_file_paths = setup_func(replicate)
+    if replicate['verbose']:
+        print('calling: {}'.format(" ".join(engine_args)))
     proc = subprocess.Popen(engine_args, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
+    sout, _ = proc.communicate()
+    return finish_replicate(replicate, parse_func, sout, temp_file_paths)
+
+
+async def process_replicate_async(replicate, setup_func, parse_func,
+                                  semaphore, stop_flag=None):
+    """Run the engine for an individual replicate as an asyncio
+       subprocess (no Python worker process is needed)
+    """
+    async with semaphore:
+        check_stop_flag(stop_flag, 1)
+        engine_args, temp_file_paths = setup_func(replicate)
+        if replicate['verbose']:
+            print('calling: {}'.format(" ".join(engine_args)))
+        sout = await run_engine_async(engine_args, replicate["temp_wd"])
+    return finish_replicate(replicate, parse_func, sout, temp_file_paths)
+
+
+async def run_engine_async(engine_args, cwd):
+    """Run an engine in its own session (so a terminal interrupt does not
+       reach it) and return its standard output
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *engine_args, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, cwd=cwd, start_new_session=True)
+    RUNNING_ENGINES.add(proc.pid)
+    try:
+        sout, _ = await proc.communicate()
+    finally:
+        RUNNING_ENGINES.discard(proc.pid)
+    return sout
+
+
+def process_replicate_batch(replicates, batch_setup_func, setup_func,
+                            parse_func):
+    """Run several replicates through a single engine invocation and
+       split the output back into one result per replicate
+    """
+    os.chdir(replicates[0]["temp_wd"])
+    engine_args, batch_file_paths = batch_setup_func(replicates)
+    if replicates[0]['verbose']:
+        print('calling: {}'.format(" ".join(engine_args)))
+    proc = subprocess.Popen(engine_args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    sout, _ = proc.communicate()
+    return finish_batch(replicates, setup_func, parse_func, sout,
+                        batch_file_paths)
+
+
+async def process_replicate_batch_async(replicates, batch_setup_func,
+                                        setup_func, parse_func, semaphore,
+                                        stop_flag=None):
+    """Run several replicates through a single engine invocation as an
+       asyncio subprocess
+    """
+    async with semaphore:
+        check_stop_flag(stop_flag, len(replicates))
+        engine_args, batch_file_paths = batch_setup_func(replicates)
+        if replicates[0]['verbose']:
+            print('calling: {}'.format(" ".join(engine_args)))
+        sout = await run_engine_async(engine_args,
+                                      replicates[0]["temp_wd"])
+    return finish_batch(replicates, setup_func, parse_func, sout,
+                        batch_file_paths)
+
+
+def finish_batch(replicates, setup_func, parse_func, sout, batch_file_paths):
+    """Demultiplex the output of a batch into replicate results"""
+    results = []
+    for replicate in replicates:
+        # only the temp file list is needed from the single setup
+        _, temp_file_paths = setup_func(replicate)
+        results.append(finish_replicate(replicate, parse_func, sout,
+                                        temp_file_paths))
+    if replicates[0]['retain_temp'] is False:
+        for fpath in batch_file_paths:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+    return results
+
+
+def finish_replicate(replicate, parse_func, sout, temp_file_paths):
+    """Parse the engine output and remove the temporary files"""
     if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
+        if "fix your data" in sout.decode('utf-8'):
             print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
-    if replicate['verbose']:
-        print('calling:{}'.format(result["engine_args"]))
-    result["label"] = replicate['unique_label']
+    result = parse_func(replicate, temp_file_paths)
+    if replicate['retain_temp'] is False:
+        for fpath in temp_file_paths:
+            if os.path.exists(fpath):
+                if replicate['verbose'] is True:
+                    print("REMOVED", fpath)
+                os.remove(fpath)
+            elif replicate['verbose'] is True:
+                print("NOTFOUND", fpath)
+    return result
+
+
+def tree_search_result(replicate, tpath):
+    """Result of an unconstrained tree search, from the best tree file"""
+    result = {"label": replicate['unique_label'],
+              "seq_names": replicate["seq_names"].copy(),
+              "genename": replicate["genename"]}
     best_tree = None
-    lpath = os.path.join(replicate['temp_wd'],
-                         "RAXML_info.tts.{}".format(result["label"]))
-    tpath = os.path.join(replicate['temp_wd'],
-                         "RAxML_result.tts.{}".format(result["label"]))
-    temp_file_paths.extend([lpath, tpath])
     with open(tpath, "r") as tfile:
-        tline = tfile.readline()
-    restree = tree_reader.read_tree_string(tline)
+        restree = tree_reader.read_tree_string(tfile.read())
     likelihood1, likelihood2 = tree_utils.calc_biparts(restree)
     if ("L1" in likelihood1[0] and "L2" in likelihood1[0]) or (
             "R1" in likelihood1[0] and "R2" in likelihood1[0]):
@@ -552,82 +818,15 @@ def process_replicate_raxml(replicate):
     result['diff_exceeds_cutoff'] = True
     result['best_tree'] = best_tree
     result['likelihood_diff'] = 0
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                os.remove(fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    return result
 
 
-def process_replicate_raxml_lrt(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
-    # just alias dictionary elements for convenience
-    result = {}
-    result["label"] = replicate['unique_label']
-    temp_file_paths = [replicate['aln_fname'],
-                       "{}.reduced".format(replicate['aln_fname'])]
-    result["seq_names"] = replicate["seq_names"].copy()
-    # generate a label that will be unique within this run
-    #  (but probably not among runs!)
-    temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
-    # this will test the three topologies
-    # test alignment readability by raxml, also filters missing columns
-    base_engine_args = [replicate['engine_executable'],
-                        "-s", replicate['aln_fname'],
-                        "-m", replicate['engine_model'],
-                        "-T", "1",
-                        "-p", "11341",
-                        "--silent",
-                        "-F",
-                        "-f", "N"]
-    if replicate['using_partitions']:
-        temp_file_paths.extend([replicate['part_fname'],
-                                "{}.reduced".format(replicate['part_fname'])])
-        base_engine_args.extend(["-q", replicate["part_fname"]])
-    treelikelihoods = {0: 0, 1: 0, 2: 0}
+def likelihood_test_result(replicate, treelikelihoods, lpath):
+    """Result of the likelihood comparison of the three topologies"""
+    result = {"label": replicate['unique_label'],
+              "seq_names": replicate["seq_names"].copy(),
+              "genename": replicate["genename"]}
     likelihood_diff_exceeds_cutoff = False
-    # correct = None
-    engine_args = base_engine_args + [
-        "-n", "{}".format(temp_ml_search_label),
-        "-z", "test.trees"
-        ]
-    result["engine_args"] = " ".join(engine_args)
-    if replicate['verbose']:
-        print('calling: {}'.format(result["engine_args"]))
-    proc = subprocess.Popen(engine_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
-    if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
-            print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
-    lpath = os.path.join(replicate['temp_wd'],
-                         "RAxML_info.tts.{}".format(
-                             result["label"]))
-    tpath = os.path.join(replicate['temp_wd'],
-                         "RAxML_result.tts.{}".format(
-                             result["label"]))
-    temp_file_paths.extend([lpath, tpath])
-    if not os.path.exists(lpath):
-        if replicate['ignore_error'] is False:
-            raise RuntimeError("'{}' does not exist".format(lpath))
-    with open(lpath, "r") as info_result:
-        for line in info_result:
-            if "Tree 0 Likelihood " in line:
-                treelikelihoods[0] = (
-                    -1 * float(line.split(" ")[3]))
-            if "Tree 1 Likelihood " in line:
-                treelikelihoods[1] = (
-                    -1 * float(line.split(" ")[3]))
-            if "Tree 2 Likelihood " in line:
-                treelikelihoods[2] = (
-                    -1 * float(line.split(" ")[3]))
     srt_likelihoods = [(treelikelihoods[x], x) for x in (0, 1, 2)]
     srt_likelihoods.sort()
     likelihood_diff = abs(srt_likelihoods[0][0] - srt_likelihoods[1][0])
@@ -642,246 +841,215 @@ def process_replicate_raxml_lrt(replicate):
     result["diff_exceeds_cutoff"] = likelihood_diff_exceeds_cutoff
     result["best_tree"] = srt_likelihoods[0][1]
     result["likelihood_diff"] = likelihood_diff
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                if replicate['verbose'] is True:
-                    print("REMOVED", fpath)
-                os.remove(fpath)
-            elif replicate['verbose'] is True:
-                print("NOTFOUND", fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
+    result["tree_likelihoods"] = [treelikelihoods[x] for x in (0, 1, 2)]
+    return result
+
+
+def read_log_likelihoods(replicate, lpath, patterns, field):
+    """Read the three topology likelihoods from an engine log file"""
+    if not os.path.exists(lpath):
+        if replicate['ignore_error'] is False:
+            raise RuntimeError("'{}' does not exist".format(lpath))
+    treelikelihoods = {0: 0, 1: 0, 2: 0}
+    with open(lpath, "r") as info_result:
+        for line in info_result:
+            for i, pattern in enumerate(patterns):
+                if pattern in line:
+                    treelikelihoods[i] = (
+                        -1 * float(line.split(" ")[field]))
+    return treelikelihoods
+
+
+def add_site_weights(replicate, engine_args, temp_file_paths, flag):
+    """Pass the site pattern weights file to the engine, if any"""
+    if replicate.get('weights_fname') is not None:
+        engine_args.extend([flag, replicate['weights_fname']])
+        temp_file_paths.append(replicate['weights_fname'])
     return ''
 
 
-def process_replicate_raxmlng(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
+def setup_raxml(replicate):
+    """RAxML Classic tree search arguments"""
+    temp_file_paths = [replicate['aln_fname'],
+                       "{}.reduced".format(replicate['aln_fname'])]
+    # generate a label that will be unique within this run
+    #  (but probably not among runs!)
+    temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
+    engine_args = [replicate['engine_executable'],
+                   "-s", replicate['aln_fname'],
+                   "-m", replicate['engine_model'],
+                   "-T", "1",
+                   "-p", "11341",
+                   "--silent",
+                   "-F",
+                   "-n", temp_ml_search_label]
+    add_site_weights(replicate, engine_args, temp_file_paths, "-a")
+    if replicate['using_partitions']:
+        temp_file_paths.extend([replicate['part_fname'],
+                                "{}.reduced".format(replicate['part_fname'])])
+        engine_args.extend(["-q", replicate["part_fname"]])
+    return engine_args, temp_file_paths
+
+
+def parse_raxml(replicate, temp_file_paths):
+    """RAxML Classic tree search result"""
+    lpath = os.path.join(replicate['temp_wd'],
+                         "RAXML_info.tts.{}".format(
+                             replicate["unique_label"]))
+    tpath = os.path.join(replicate['temp_wd'],
+                         "RAxML_result.tts.{}".format(
+                             replicate["unique_label"]))
+    temp_file_paths.extend([lpath, tpath])
+    return tree_search_result(replicate, tpath)
+
+
+def setup_raxml_lrt(replicate):
+    """RAxML Classic likelihood evaluation arguments"""
     temp_file_paths = [replicate['aln_fname'],
                        "{}.reduced".format(replicate['aln_fname'])]
-    # just alias dictionary elements for convenience
-    result = {"label": replicate['unique_label']}
-    result["seq_names"] = replicate["seq_names"].copy()
     # generate a label that will be unique within this run
     #  (but probably not among runs!)
-    # temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
+    temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
+    # this will test the three topologies
+    # test alignment readability by raxml, also filters missing columns
+    engine_args = [replicate['engine_executable'],
+                   "-s", replicate['aln_fname'],
+                   "-m", replicate['engine_model'],
+                   "-T", "1",
+                   "-p", "11341",
+                   "--silent",
+                   "-F",
+                   "-f", "N"]
+    add_site_weights(replicate, engine_args, temp_file_paths, "-a")
+    if replicate['using_partitions']:
+        temp_file_paths.extend([replicate['part_fname'],
+                                "{}.reduced".format(replicate['part_fname'])])
+        engine_args.extend(["-q", replicate["part_fname"]])
+    engine_args.extend(["-n", "{}".format(temp_ml_search_label),
+                        "-z", "test.trees"])
+    return engine_args, temp_file_paths
+
+
+def parse_raxml_lrt(replicate, temp_file_paths):
+    """RAxML Classic likelihood evaluation result"""
+    lpath = os.path.join(replicate['temp_wd'],
+                         "RAxML_info.tts.{}".format(
+                             replicate["unique_label"]))
+    tpath = os.path.join(replicate['temp_wd'],
+                         "RAxML_result.tts.{}".format(
+                             replicate["unique_label"]))
+    temp_file_paths.extend([lpath, tpath])
+    treelikelihoods = read_log_likelihoods(
+        replicate, lpath, ("Tree 0 Likelihood ", "Tree 1 Likelihood ",
+                           "Tree 2 Likelihood "), 3)
+    return likelihood_test_result(replicate, treelikelihoods, lpath)
+
+
+def setup_raxmlng(replicate):
+    """RAxML-ng tree search arguments"""
+    temp_file_paths = [replicate['aln_fname'],
+                       "{}.reduced".format(replicate['aln_fname'])]
     engine_args = [replicate['engine_executable'],
                    "--msa", replicate['aln_fname'],
                    "--threads", "1",
                    "--seed", "11341"]
+    add_site_weights(replicate, engine_args, temp_file_paths,
+                     "--site-weights")
     if replicate['using_partitions']:
         temp_file_paths.extend([replicate['part_fname'],
                                 "{}.reduced".format(replicate['part_fname'])])
         engine_args.extend(["--model", replicate["part_fname"]])
     else:
         engine_args.extend(["--model", replicate['engine_model']])
-    result["engine_args"] = " ".join(engine_args)
-    proc = subprocess.Popen(engine_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
-    if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
-            print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
-    if replicate['verbose']:
-        print('calling:{}'.format(result["engine_args"]))
-    result["label"] = replicate['unique_label']
-    best_tree = None
+    return engine_args, temp_file_paths
+
+
+def parse_raxmlng(replicate, temp_file_paths):
+    """RAxML-ng tree search result"""
     lpath = os.path.join(replicate['temp_wd'],
                          "{}.raxml.log".format(replicate['aln_fname']))
     tpath = os.path.join(replicate['temp_wd'],
                          "{}.raxml.bestTree".format(replicate['aln_fname']))
     temp_file_paths.extend([lpath, tpath])
-    with open(tpath, "r") as tfile:
-        tline = tfile.readline()
-    restree = tree_reader.read_tree_string(tline)
-    likelihood1, likelihood2 = tree_utils.calc_biparts(restree)
-    if ("L1" in likelihood1[0] and "L2" in likelihood1[0]) or (
-            "R1" in likelihood1[0] and "R2" in likelihood1[0]):
-        best_tree = 0
-    elif ("L1" in likelihood1[0] and "R1" in likelihood1[0]) or (
-            "L2" in likelihood1[0] and "R2" in likelihood1[0]):
-        best_tree = 1
-    elif ("L1" in likelihood1[0] and "R2" in likelihood1[0]) or (
-            "L2" in likelihood1[0] and "R1" in likelihood1[0]):
-        best_tree = 2
-    if replicate['verbose']:
-        print("---")
-        print(best_tree, likelihood1, likelihood2)
-    result['diff_exceeds_cutoff'] = True
-    result['best_tree'] = best_tree
-    result['likelihood_diff'] = 0
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                os.remove(fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    return tree_search_result(replicate, tpath)
 
 
-def process_replicate_raxmlng_lrt(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
-    # just alias dictionary elements for convenience
-    result = {}
-    result["label"] = replicate['unique_label']
+def setup_raxmlng_lrt(replicate):
+    """RAxML-ng likelihood evaluation arguments"""
     temp_file_paths = [replicate['aln_fname'],
                        "{}.reduced".format(replicate['aln_fname'])]
-    result["seq_names"] = replicate["seq_names"].copy()
-    # generate a label that will be unique within this run
-    #  (but probably not among runs!)
-    # temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
     # this will test the three topologies
     # test alignment readability by raxml, also filters missing columns
-    base_engine_args = [replicate['engine_executable'],
-                        "--evaluate",
-                        "--msa", replicate['aln_fname'],
-                        "--threads", "1",
-                        "--seed", "11341",
-                        "--tree", "test.trees"]
+    engine_args = [replicate['engine_executable'],
+                   "--evaluate",
+                   "--msa", replicate['aln_fname'],
+                   "--threads", "1",
+                   "--seed", "11341",
+                   "--tree", "test.trees"]
+    add_site_weights(replicate, engine_args, temp_file_paths,
+                     "--site-weights")
     if replicate['using_partitions']:
         temp_file_paths.extend([replicate['part_fname'],
                                 "{}.reduced".format(replicate['part_fname'])])
-        base_engine_args.extend(["-q", replicate["part_fname"]])
+        engine_args.extend(["-q", replicate["part_fname"]])
     else:
-        base_engine_args.extend(["--model", replicate['engine_model']])
-    treelikelihoods = {0: 0, 1: 0, 2: 0}
-    likelihood_diff_exceeds_cutoff = False
-    # correct = None
-    result["engine_args"] = " ".join(base_engine_args)
-    if replicate['verbose']:
-        print('calling: {}'.format(result["engine_args"]))
-    proc = subprocess.Popen(base_engine_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
-    if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
-            print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
+        engine_args.extend(["--model", replicate['engine_model']])
+    return engine_args, temp_file_paths
+
+
+def parse_raxmlng_lrt(replicate, temp_file_paths):
+    """RAxML-ng likelihood evaluation result"""
     lpath = os.path.join(replicate['temp_wd'],
                          "{}.raxml.log".format(replicate['aln_fname']))
     tpath = os.path.join(replicate['temp_wd'],
                          "{}.raxml.bestTree".format(replicate['aln_fname']))
     temp_file_paths.extend([lpath, tpath])
-    if not os.path.exists(lpath):
-        if replicate['ignore_error'] is False:
-            raise RuntimeError("'{}' does not exist".format(lpath))
-    with open(lpath, "r") as info_result:
-        for line in info_result:
-            if "Tree #1, final logLikelihood:" in line:
-                treelikelihoods[0] = (
-                    -1 * float(line.split(" ")[5]))
-            if "Tree #2, final logLikelihood:" in line:
-                treelikelihoods[1] = (
-                    -1 * float(line.split(" ")[5]))
-            if "Tree #3, final logLikelihood:" in line:
-                treelikelihoods[2] = (
-                    -1 * float(line.split(" ")[5]))
-    srt_likelihoods = [(treelikelihoods[x], x) for x in (0, 1, 2)]
-    srt_likelihoods.sort()
-    likelihood_diff = abs(srt_likelihoods[0][0] - srt_likelihoods[1][0])
-    if likelihood_diff > replicate['lnlikethresh']:
-        likelihood_diff_exceeds_cutoff = True
-    if replicate['verbose']:
-        print("-" * 5)
-        print("Filename: ", lpath)
-        print("Likelihoods:", treelikelihoods)
-        print("Lowest L:", srt_likelihoods[0][1], "; Diff = ", likelihood_diff,
-              "; Exceeds cutoff = ", likelihood_diff_exceeds_cutoff)
-    result["diff_exceeds_cutoff"] = likelihood_diff_exceeds_cutoff
-    result["best_tree"] = srt_likelihoods[0][1]
-    result["likelihood_diff"] = likelihood_diff
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                if replicate['verbose'] is True:
-                    print("REMOVED", fpath)
-                os.remove(fpath)
-            elif replicate['verbose'] is True:
-                print("NOTFOUND", fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    treelikelihoods = read_log_likelihoods(
+        replicate, lpath, ("Tree #1, final logLikelihood:",
+                           "Tree #2, final logLikelihood:",
+                           "Tree #3, final logLikelihood:"), 5)
+    return likelihood_test_result(replicate, treelikelihoods, lpath)
 
 
-def process_replicate_paup(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
+def setup_paup(replicate):
+    """PAUP likelihood scoring arguments"""
     temp_file_paths = [replicate['aln_fname']]
-    result = {"label": replicate['unique_label']}
-    # just alias dictionary elements for convenience
-    paup_out_file_path = os.path.join(
-        replicate['temp_wd'],
-        "temp_inseqs.{}.out".format(result['label']))
-    result["seq_names"] = replicate["seq_names"].copy()
-    # write the alignment    result["label"] = replicate['unique_label']
     # this will test the three topologies
     paup_args = [replicate["engine_executable"], replicate['aln_fname']]
-    result["paup_args"] = " ".join(paup_args)
-    if replicate['verbose']:
-        print('calling: ', result['paup_args'])
-    proc = subprocess.Popen(paup_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    proc.communicate()
+    return paup_args, temp_file_paths
+
+
+def setup_paup_batch(replicates):
+    """PAUP likelihood scoring arguments for a batch of replicates"""
+    batch_fname = os.path.join(
+        replicates[0]['temp_wd'],
+        "temp_batch.{}.nex".format(replicates[0]['unique_label']))
+    write_paup_batch(batch_fname, replicates)
+    paup_args = [replicates[0]["engine_executable"], batch_fname]
+    return paup_args, [batch_fname]
+
+
+def parse_paup(replicate, temp_file_paths):
+    """PAUP likelihood scoring result"""
+    paup_out_file_path = os.path.join(
+        replicate['temp_wd'],
+        "temp_inseqs.{}.out".format(replicate['unique_label']))
+    temp_file_paths.append(paup_out_file_path)
     treelikelihoods = {0: 0, 1: 0, 2: 0, 3: 0}
-    likelihood_diff_exceeds_cutoff = False
-    outfile = open(paup_out_file_path, "r")
-    resstr = outfile.readlines()
+    with open(paup_out_file_path, "r") as outfile:
+        resstr = outfile.readlines()
     for elem in resstr:
         if "Tree" in elem:
             continue
         row = elem.strip().split()
         treelikelihoods[int(row[0]) - 1] = float(row[1])
-    srt_likelihoods = [(treelikelihoods[x], x) for x in (0, 1, 2)]
-    srt_likelihoods.sort()
-    likelihood_diff = abs(srt_likelihoods[0][0] - srt_likelihoods[1][0])
-    if likelihood_diff > replicate['lnlikethresh']:
-        likelihood_diff_exceeds_cutoff = True
-    if replicate['verbose']:
-        print("-"*5)
-        print("Filename: ", paup_out_file_path)
-        print("Likelihoods:", treelikelihoods)
-        print("Lowest L:", srt_likelihoods[0][1], "; Diff = ", likelihood_diff,
-              "; Exceeds cutoff = ", likelihood_diff_exceeds_cutoff)
-    result['diff_exceeds_cutoff'] = likelihood_diff_exceeds_cutoff
-    result['best_tree'] = srt_likelihoods[0][1]
-    result['likelihood_diff'] = likelihood_diff
-    temp_file_paths.append(paup_out_file_path)
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                os.remove(fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    return likelihood_test_result(replicate, treelikelihoods,
+                                  paup_out_file_path)
 
 
-def process_replicate_iqtree(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
+def setup_iqtree(replicate):
+    """IQ-TREE tree search arguments"""
     temp_file_paths = [replicate['aln_fname']]
-    # just alias dictionary elements for convenience
-    result = {"label": replicate['unique_label']}
-    result["seq_names"] = replicate["seq_names"].copy()
-    # generate a label that will be unique within this run
-    #  (but probably not among runs!)
-    # temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
     engine_args = [replicate['engine_executable'],
                    "-s", replicate['aln_fname'],
                    "-nt", "1",
@@ -890,17 +1058,11 @@ def process_replicate_iqtree(replicate):
     if replicate['using_partitions']:
         temp_file_paths.extend([replicate['part_fname']])
         engine_args.extend(["-q", replicate["part_fname"]])
-    result["engine_args"] = " ".join(engine_args)
-    proc = subprocess.Popen(engine_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
-    if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
-            print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
-    if replicate['verbose']:
-        print('calling:{}'.format(result["engine_args"]))
-    result["label"] = replicate['unique_label']
-    best_tree = None
+    return engine_args, temp_file_paths
+
+
+def parse_iqtree(replicate, temp_file_paths):
+    """IQ-TREE tree search result"""
     lpath = os.path.join(replicate['temp_wd'],
                          "{}.iqtree".format(replicate['aln_fname']))
     tpath = os.path.join(replicate['temp_wd'],
@@ -910,74 +1072,29 @@ def process_replicate_iqtree(replicate):
         os.path.join(replicate['temp_wd'],
                      "{}.{}".format(replicate['aln_fname'], x))
         for x in ('bionj', 'mldist', 'trees', 'ckp.gz', 'log')])
-    with open(tpath, "r") as tfile:
-        tline = tfile.readline()
-    restree = tree_reader.read_tree_string(tline)
-    likelihood1, likelihood2 = tree_utils.calc_biparts(restree)
-    if ("L1" in likelihood1[0] and "L2" in likelihood1[0]) or (
-            "R1" in likelihood1[0] and "R2" in likelihood1[0]):
-        best_tree = 0
-    elif ("L1" in likelihood1[0] and "R1" in likelihood1[0]) or (
-            "L2" in likelihood1[0] and "R2" in likelihood1[0]):
-        best_tree = 1
-    elif ("L1" in likelihood1[0] and "R2" in likelihood1[0]) or (
-            "L2" in likelihood1[0] and "R1" in likelihood1[0]):
-        best_tree = 2
-    if replicate['verbose']:
-        print("---")
-        print(best_tree, likelihood1, likelihood2)
-    result['diff_exceeds_cutoff'] = True
-    result['best_tree'] = best_tree
-    result['likelihood_diff'] = 0
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                os.remove(fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    return tree_search_result(replicate, tpath)
 
 
-def process_replicate_iqtree_lrt(replicate):
-    """Process individual replicate sampling"""
-    os.chdir(replicate["temp_wd"])
-    # just alias dictionary elements for convenience
-    result = {}
-    result["label"] = replicate['unique_label']
+def setup_iqtree_lrt(replicate):
+    """IQ-TREE likelihood evaluation arguments"""
     temp_file_paths = [replicate['aln_fname']]
-    result["seq_names"] = replicate["seq_names"].copy()
-    # generate a label that will be unique within this run
-    #  (but probably not among runs!)
-    # temp_ml_search_label = "tts.{}".format(replicate["unique_label"])
     # this will test the three topologies
-    # test alignment readability by raxml, also filters missing columns
-    base_engine_args = [replicate['engine_executable'],
-                        "-s", replicate['aln_fname'],
-                        "-nt", "1",
-                        "-seed", "11341",
-                        "-z", "test.trees"]
+    engine_args = [replicate['engine_executable'],
+                   "-s", replicate['aln_fname'],
+                   "-nt", "1",
+                   "-seed", "11341",
+                   "-z", "test.trees"]
     if replicate['using_partitions']:
         temp_file_paths.extend([replicate['part_fname'],
                                 "{}.reduced".format(replicate['part_fname'])])
-        base_engine_args.extend(["-q", replicate["part_fname"]])
+        engine_args.extend(["-q", replicate["part_fname"]])
     else:
-        base_engine_args.extend(["-m", replicate['engine_model']])
-    treelikelihoods = {0: 0, 1: 0, 2: 0}
-    likelihood_diff_exceeds_cutoff = False
-    # correct = None
-    result["engine_args"] = " ".join(base_engine_args)
-    if replicate['verbose']:
-        print('calling: {}'.format(result["engine_args"]))
-    proc = subprocess.Popen(base_engine_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    serr, _ = proc.communicate()
-    if replicate['verbose'] is True:
-        if "fix your data" in serr.decode('utf-8'):
-            print("PARTITIONS WARNING OR MISSING DATA FROM RAXML")
+        engine_args.extend(["-m", replicate['engine_model']])
+    return engine_args, temp_file_paths
+
+
+def parse_iqtree_lrt(replicate, temp_file_paths):
+    """IQ-TREE likelihood evaluation result"""
     lpath = os.path.join(replicate['temp_wd'],
                          "{}.log".format(replicate['aln_fname']))
     tpath = os.path.join(replicate['temp_wd'],
@@ -987,49 +1104,97 @@ def process_replicate_iqtree_lrt(replicate):
         os.path.join(replicate['temp_wd'],
                      "{}.{}".format(replicate['aln_fname'], x))
         for x in ('bionj', 'mldist', 'trees', 'ckp.gz')])
-    if not os.path.exists(lpath):
-        if replicate['ignore_error'] is False:
-            raise RuntimeError("'{}' does not exist".format(lpath))
-    with open(lpath, "r") as info_result:
-        for line in info_result:
-            if "Tree 1 / LogL:" in line:
-                treelikelihoods[0] = (
-                    -1 * float(line.split(" ")[4]))
-            if "Tree 2 / LogL:" in line:
-                treelikelihoods[1] = (
-                    -1 * float(line.split(" ")[4]))
-            if "Tree 3 / LogL:" in line:
-                treelikelihoods[2] = (
-                    -1 * float(line.split(" ")[4]))
-    srt_likelihoods = [(treelikelihoods[x], x) for x in (0, 1, 2)]
-    srt_likelihoods.sort()
-    likelihood_diff = abs(srt_likelihoods[0][0] - srt_likelihoods[1][0])
-    if likelihood_diff > replicate['lnlikethresh']:
-        likelihood_diff_exceeds_cutoff = True
-    if replicate['verbose']:
-        print("-" * 5)
-        print("Filename: ", lpath)
-        print("Likelihoods:", treelikelihoods)
-        print("Lowest L:", srt_likelihoods[0][1], "; Diff = ", likelihood_diff,
-              "; Exceeds cutoff = ", likelihood_diff_exceeds_cutoff)
-    result["diff_exceeds_cutoff"] = likelihood_diff_exceeds_cutoff
-    result["best_tree"] = srt_likelihoods[0][1]
-    result["likelihood_diff"] = likelihood_diff
-    if replicate['retain_temp'] is False:
-        for fpath in temp_file_paths:
-            if os.path.exists(fpath):
-                if replicate['verbose'] is True:
-                    print("REMOVED", fpath)
-                os.remove(fpath)
-            elif replicate['verbose'] is True:
-                print("NOTFOUND", fpath)
-    replicate["queue"].put(result)
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    replicate["lock"].acquire()
-    sys.stdout.flush()
-    replicate['lock'].release()
-    return ''
+    treelikelihoods = read_log_likelihoods(
+        replicate, lpath, ("Tree 1 / LogL:", "Tree 2 / LogL:",
+                           "Tree 3 / LogL:"), 4)
+    return likelihood_test_result(replicate, treelikelihoods, lpath)
+
+
+def process_replicate_native(replicate):
+    """Process individual replicate sampling with the built-in
+       likelihood engine (no engine process or temp files)
+    """
+    from native_engine import evaluate_quartet
+    lnlikes = evaluate_quartet(
+        [replicate['seqs'][x] for x in ('L1', 'L2', 'R1', 'R2')],
+        replicate['engine_model'], replicate['data_type'],
+        weights=replicate.get('site_weights'))
+    treelikelihoods = dict((x, -1 * lnlikes[x]) for x in (0, 1, 2))
+    result = likelihood_test_result(replicate, treelikelihoods,
+                                    "native engine")
+    if replicate['lnlikethresh'] == 0:
+        # tree inference mode, the best of the three topologies is the
+        # inferred tree
+        result['diff_exceeds_cutoff'] = True
+        result['likelihood_diff'] = 0
+    return result
+
+
+# (setup, parse) functions for each engine, with and without the
+# likelihood threshold
+ENGINE_TASKS = {
+    ('raxml', False): (setup_raxml, parse_raxml),
+    ('raxml', True): (setup_raxml_lrt, parse_raxml_lrt),
+    ('raxml-ng', False): (setup_raxmlng, parse_raxmlng),
+    ('raxml-ng', True): (setup_raxmlng_lrt, parse_raxmlng_lrt),
+    ('iqtree', False): (setup_iqtree, parse_iqtree),
+    ('iqtree', True): (setup_iqtree_lrt, parse_iqtree_lrt),
+    ('paup', False): (setup_paup, parse_paup),
+    ('paup', True): (setup_paup, parse_paup),
+    }
+
+
+# engines that can process several replicates in one invocation:
+# (batch setup, single setup, parse)
+ENGINE_BATCH_TASKS = {
+    'paup': (setup_paup_batch, setup_paup, parse_paup),
+    }
+
+
+def get_engine_tasks(params):
+    """Select the engine setup and parsing functions for this run"""
+    return ENGINE_TASKS[(params['engine'], params['lnlikethresh'] > 0)]
+
+
+def get_engine_batch_tasks(params):
+    """Select the batch setup, setup and parsing functions for this run"""
+    return ENGINE_BATCH_TASKS[params['engine']]
+
+
+def process_replicate_raxml(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_raxml, parse_raxml)
+
+
+def process_replicate_raxml_lrt(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_raxml_lrt, parse_raxml_lrt)
+
+
+def process_replicate_raxmlng(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_raxmlng, parse_raxmlng)
+
+
+def process_replicate_raxmlng_lrt(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_raxmlng_lrt,
+                             parse_raxmlng_lrt)
+
+
+def process_replicate_paup(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_paup, parse_paup)
+
+
+def process_replicate_iqtree(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_iqtree, parse_iqtree)
+
+
+def process_replicate_iqtree_lrt(replicate):
+    """Process individual replicate sampling"""
+    return process_replicate(replicate, setup_iqtree_lrt, parse_iqtree_lrt)
 
 
 def write_raxml(fname, seqs):
@@ -1040,18 +1205,15 @@ def write_raxml(fname, seqs):
     return ''
 
 
-def cat_raxml(fname, seqs, seqnames):
-    """Concatenate sequences for fasta"""
-    with open(fname, 'w') as outfile:
-        for repname, _ in seqnames.items():
-            outfile.write(">{}\n".format(repname))
-            with open(seqs[repname], 'r') as sfile:
-                outfile.write(sfile.readline().rstrip())
-            outfile.write("\n")
+def write_site_weights(fname, weights):
+    """Write the site pattern weights file for RAxML/RAxML-ng"""
+    with open(fname, "w") as outfile:
+        outfile.write(" ".join(str(x) for x in weights))
+        outfile.write("\n")
     return ''
 
 
-def write_paup(fpath, seqs, datatype="nuc"):
+def write_paup(fpath, seqs, datatype="nuc", quit_paup=True, weights=None):
     """Write PAUP output"""
     paup_datatype = 'dna'
     if datatype == 'amino':
@@ -1070,7 +1232,18 @@ def write_paup(fpath, seqs, datatype="nuc"):
                     "  matrix\n")
         for hdr in seqs:
             pfile.write("    {} {}\n".format(hdr, seqs[hdr]))
-        pfile.write("    ;\nend;\n\nbegin trees;\n")
+        pfile.write("    ;\nend;\n\n")
+        if weights is not None:
+            # group the site patterns by their weight
+            wtchars = {}
+            for i, weight in enumerate(weights):
+                wtchars.setdefault(weight, []).append(str(i + 1))
+            pfile.write("begin assumptions;\n"
+                        "  wtset * qsweights = " +
+                        ", ".join("{}: {}".format(weight, " ".join(chars))
+                                  for weight, chars in wtchars.items()) +
+                        ";\nend;\n\n")
+        pfile.write("begin trees;\n")
         for hdr, val in test_trees.items():
             pfile.write("  utree t{} = {};\n".format(hdr, val))
         pfile.write(
@@ -1079,12 +1252,25 @@ def write_paup(fpath, seqs, datatype="nuc"):
             # "  lset lcollapse=no precision=double nst=6"
             # " rmatrix=estimate basefreq=empirical;\n"
             "  lset lcollapse=no precision=double nst=1 basefreq=equal;\n"
-            "  lscores all /scorefile="+fpath+".out replace=yes;\n"
-            "  quit;\n"
+            "  lscores all /scorefile="+fpath+".out replace=yes;\n" +
+            ("  quit;\n" if quit_paup else "") +
             "end;\n")
     return ''
 
 
+def write_paup_batch(fpath, replicates):
+    """Write a PAUP file that executes several replicate files in turn"""
+    with open(fpath, "w") as pfile:
+        pfile.write("#nexus\n"
+                    "begin paup;\n"
+                    "  set warnreset=no;\n")
+        for replicate in replicates:
+            pfile.write("  execute '{}';\n".format(replicate['aln_fname']))
+        pfile.write("  quit;\n"
+                    "end;\n")
+    return ''
+
+
 def write_run_stats(repstats, params):
     """Write run stats to file"""
     with open(params['run_stats_file_path'], 'w') as outfile:
@@ -1093,5 +1279,14 @@ def write_run_stats(repstats, params):
     return ''
 
 
+def write_status(fpath, status):
+    """Replace the status file (so readers never see a partial file)"""
+    with open(fpath + ".tmp", 'w') as outfile:
+        json.dump(status, outfile, indent=1)
+        outfile.write("\n")
+    os.replace(fpath + ".tmp", fpath)
+    return ''
+
+
 if __name__ == "__main__":
     print("This file is a function library, please run quartet_sampling.py")
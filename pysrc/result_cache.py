@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8
+"""
+http://www.github.com/FePhyFoFum/quartetsampling
+
+This file is part of 'quartetsampling'.
+
+'quartetsampling' is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+'quartetsampling' is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import sqlite3
+import time
+from rep_data import likelihood_test_result
+
+
+class ResultCache(object):
+    """Persistent cache of quartet engine results (SQLite).
+       Entries are keyed by a hash of the quartet alignment (in L1, L2,
+       R1, R2 order) and the engine settings, so they can be reused by
+       later runs on the same data.  Likelihood evaluations store the
+       three topology log-likelihoods, tree searches the best topology.
+       The cache is only accessed from the main process, but it may be
+       shared by concurrent runs (e.g. --shard): it uses write-ahead
+       logging, commits every stored result at once and only writes the
+       last-used times of cache hits when it is closed.  A busy or
+       failing database degrades to cache misses with a warning.
+    """
+
+    # seconds to wait for another run's write lock
+    lock_timeout = 10
+
+    def __init__(self, params):
+        self.fpath = params['result_cache_path']
+        self.max_entries = params['result_cache_size']
+        self.lrt = params['lnlikethresh'] > 0
+        settings = [params['engine'], str(params['engine_executable']),
+                    params['engine_model'], params['data_type'],
+                    'lrt' if self.lrt else 'search']
+        if params['partitions_file_path'] is not None:
+            with open(params['partitions_file_path'], 'rb') as pfile:
+                settings.append(hashlib.sha256(pfile.read()).hexdigest())
+        self.settings = "\t".join(settings)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.warned = False
+        # last-used times of the cache hits, written by close()
+        self.used = {}
+        self.conn = sqlite3.connect(self.fpath, timeout=self.lock_timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, best_tree INTEGER, "
+            "lnl0 REAL, lnl1 REAL, lnl2 REAL, last_used REAL)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used "
+            "ON results (last_used)")
+        self.conn.commit()
+
+    def replicate_key(self, seqs):
+        """Hash of the canonicalized quartet alignment and settings"""
+        digest = hashlib.sha256(self.settings.encode('utf-8'))
+        for subtree_name in ('L1', 'L2', 'R1', 'R2'):
+            digest.update(b'\n')
+            digest.update(seqs[subtree_name].upper().encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, key, replicate):
+        """Return the cached result for the replicate, or None"""
+        try:
+            row = self.conn.execute(
+                "SELECT best_tree, lnl0, lnl1, lnl2 FROM results "
+                "WHERE key = ?", (key, )).fetchone()
+        except sqlite3.OperationalError as exc:
+            self.warn(exc)
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used[key] = time.time()
+        if self.lrt:
+            # the threshold test is redone so cached likelihoods can be
+            # used with any --lnlike value
+            treelikelihoods = dict((i, -1 * row[i + 1]) for i in (0, 1, 2))
+            return likelihood_test_result(replicate, treelikelihoods,
+                                          self.fpath)
+        return {"label": replicate['unique_label'],
+                "seq_names": replicate["seq_names"].copy(),
+                "genename": replicate["genename"],
+                "diff_exceeds_cutoff": True,
+                "best_tree": row[0],
+                "likelihood_diff": 0}
+
+    def store(self, key, result):
+        """Save the result of an engine run"""
+        if result.get('best_tree') is None:
+            return ''
+        lnlikes = [None, None, None]
+        if self.lrt:
+            if 'tree_likelihoods' not in result:
+                return ''
+            lnlikes = [-1 * x for x in result['tree_likelihoods']]
+            if 0 in lnlikes:  # missing from the engine output
+                return ''
+        try:
+            # committed at once, the write lock is only held briefly
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO results "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [key, result['best_tree']] + lnlikes + [time.time()])
+        except sqlite3.OperationalError as exc:
+            self.warn(exc)
+            return ''
+        self.stored += 1
+        return ''
+
+    def warn(self, exc):
+        """Report the first failed cache access of the run"""
+        if not self.warned:
+            print("WARNING: result cache {} is not available ({}), "
+                  "continuing without it".format(self.fpath, exc))
+            self.warned = True
+        return ''
+
+    def close(self):
+        """Record the last use of the cache hits, evict the least
+           recently used entries and close the cache
+        """
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE results SET last_used = ? WHERE key = ?",
+                    [(used, key) for key, used in self.used.items()])
+                nentries = self.conn.execute(
+                    "SELECT COUNT(*) FROM results").fetchone()[0]
+                if nentries > self.max_entries:
+                    self.conn.execute(
+                        "DELETE FROM results WHERE key IN (SELECT key "
+                        "FROM results ORDER BY last_used LIMIT ?)",
+                        (nentries - self.max_entries, ))
+        except sqlite3.OperationalError as exc:
+            self.warn(exc)
+        self.conn.close()
+        return ''
+
+    def stats(self):
+        """Hit and miss counts for the run statistics file"""
+        return {'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_stored': self.stored}
+
+
+def open_result_cache(params):
+    """Open the result cache if one was requested"""
+    if params['result_cache_path'] is None:
+        return None
+    return ResultCache(params)
+
+
+if __name__ == "__main__":
+    print("This file is a function library, please run quartet_sampling.py")
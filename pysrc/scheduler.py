@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8
+"""
+http://www.github.com/FePhyFoFum/quartetsampling
+
+This file is part of 'quartetsampling'.
+
+'quartetsampling' is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+'quartetsampling' is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import atexit
+import math
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import Event, Pool
+from rep_data import process_replicate_raxml, process_replicate_raxml_lrt
+from rep_data import process_replicate_raxmlng, process_replicate_raxmlng_lrt
+from rep_data import process_replicate_iqtree, process_replicate_iqtree_lrt
+from rep_data import process_replicate_paup, process_replicate_native
+from rep_data import get_engine_tasks, get_engine_batch_tasks
+from rep_data import process_replicate_async
+from rep_data import process_replicate_batch, process_replicate_batch_async
+from rep_data import write_status
+from rep_data import RUNNING_ENGINES, check_stop_flag
+
+# seconds between checks for a stop request while waiting on results
+STOP_POLL_INTERVAL = 0.5
+# set in each pool worker by init_worker
+WORKER_STOP_FLAG = None
+
+
+def init_worker(stop_flag):
+    """Pool initializer, interrupts are handled by the main process.
+       Each worker leads its own process group, shared with the engines
+       it starts, so a terminal interrupt does not reach the engines,
+       and a worker terminated by the pool takes its engine with it.
+    """
+    global WORKER_STOP_FLAG
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+        signal.signal(signal.SIGTERM, kill_worker_group)
+    WORKER_STOP_FLAG = stop_flag
+
+
+def kill_worker_group(signum, frame):
+    """SIGTERM handler of the pool workers"""
+    kill_process_group(os.getpid())
+
+
+def run_unless_stopped(func, nreplicates, *args):
+    """Pool task, runs func unless the scheduler has asked to stop
+       (the replicates are then left for a resumed run)
+    """
+    check_stop_flag(WORKER_STOP_FLAG, nreplicates)
+    return func(*args)
+
+
+def get_replicate_function(params):
+    """Select the replicate processing function for the engine"""
+    # Built-in engine
+    if params['engine'] == 'native':
+        return process_replicate_native
+    # PAUP Case
+    if params['engine'] == 'paup':
+        return process_replicate_paup
+    # IQ-TREE with likelihood threshold
+    if params['lnlikethresh'] > 0 and params['engine'] == 'iqtree':
+        return process_replicate_iqtree_lrt
+    # IQ-TREE without likelihood threshold
+    if params['engine'] == 'iqtree':
+        return process_replicate_iqtree
+    # RAxML Classic with likelihood threshold
+    if params['lnlikethresh'] > 0 and params['engine'] == 'raxml':
+        return process_replicate_raxml_lrt
+    # RAxML Classic without likelihood threshold
+    if params['engine'] == 'raxml':
+        return process_replicate_raxml
+    # RAxML-ng with likelihood threshold
+    if params['lnlikethresh'] > 0:
+        return process_replicate_raxmlng_lrt
+    # RAxML-ng without likelihood threshold
+    return process_replicate_raxmlng
+
+
+class NodeScheduler(object):
+    """Single worker pool shared by every node in the run.
+       Replicates from successive nodes are fed into the same pool so the
+       next node can start while the previous one is still draining.
+       Workers return their result records directly; these are added to
+       the counts of their node here in the parent as they arrive, and
+       each node is finalized, in submission order, as soon as all of
+       its replicates have completed.
+    """
+
+    def __init__(self, params, maindata, cache=None, journal=None,
+                 stop_request=None):
+        self.params = params
+        self.maindata = maindata
+        self.cache = cache
+        self.journal = journal
+        self.stop_request = stop_request
+        self.draining = False
+        self.func = get_replicate_function(params)
+        self.pending = deque()
+        self.results = queue.Queue()
+        self.queued_reps = 0
+        self.n_completed = 0
+        self.n_finished = 0
+        self.last_status = 0
+        # keep roughly two nodes (or two rounds of workers) in flight
+        self.max_queued_reps = 2 * max(params['nprocs'], params['nreps'])
+        self.start()
+
+    def start(self):
+        """Start the worker processes"""
+        self.stop_flag = Event()
+        self.pool = Pool(self.params['nprocs'], initializer=init_worker,
+                         initargs=(self.stop_flag, ))
+        # the workers and engines are not in the process group of the
+        # main process, so they have to be killed if it exits with an error
+        atexit.register(self.abort)
+        return ''
+
+    def submit(self, fnode, replicates, completed=None):
+        """Queue the replicates of a node, then finalize finished nodes.
+           'completed' holds results of the node from an earlier run.
+        """
+        completed = completed if completed is not None else []
+        nodejob = {'fnode': fnode,
+                   'nreplicates': len(replicates) + len(completed),
+                   'ncompleted': len(completed), 'failed': 0,
+                   'cache_keys': {}}
+        for result in completed:
+            self.maindata.add_rep_result(fnode, result, self.params)
+        # results found in the cache do not need the engine
+        runnable = []
+        for replicate in replicates:
+            if replicate.get('cached_result') is not None:
+                self._receive(nodejob, replicate['cached_result'])
+                continue
+            if replicate.get('cache_key') is not None:
+                nodejob['cache_keys'][replicate['unique_label']] = (
+                    replicate['cache_key'])
+            runnable.append(replicate)
+        if self.params['engine_batch_size'] > 1 and runnable:
+            # pack several replicates per engine call, but not so many
+            # that the workers would be left idle
+            batch_size = min(self.params['engine_batch_size'],
+                             int(math.ceil(len(runnable) /
+                                           float(self.params['nprocs']))))
+            for i in range(0, len(runnable), batch_size):
+                self.run_batch(nodejob, runnable[i:i + batch_size])
+        else:
+            for replicate in runnable:
+                self.run_replicate(nodejob, replicate)
+        self.pending.append(nodejob)
+        self.queued_reps += nodejob['nreplicates']
+        self.collect()
+        return ''
+
+    def run_replicate(self, nodejob, replicate):
+        """Hand a single replicate to the pool"""
+        self.pool.apply_async(
+            run_unless_stopped, (self.func, 1, replicate),
+            callback=partial(self._receive, nodejob),
+            error_callback=partial(self._receive_error, nodejob, 1))
+        return ''
+
+    def run_batch(self, nodejob, replicates):
+        """Hand a batch of replicates to the pool as a single task"""
+        self.pool.apply_async(
+            run_unless_stopped,
+            (process_replicate_batch, len(replicates), replicates) +
+            get_engine_batch_tasks(self.params),
+            callback=partial(self._receive_batch, nodejob),
+            error_callback=partial(self._receive_error, nodejob,
+                                   len(replicates)))
+        return ''
+
+    def _receive(self, nodejob, result):
+        """Pool callback, runs in the result handler thread of the parent"""
+        self.results.put((nodejob, result, None))
+
+    def _receive_batch(self, nodejob, results):
+        """Pool callback for a batch, splits it into replicate results"""
+        for result in results:
+            self._receive(nodejob, result)
+
+    def _receive_error(self, nodejob, nfailed, exc):
+        """Pool error callback, passes worker exceptions to the main thread"""
+        self.results.put((nodejob, nfailed, exc))
+
+    def stop_requested(self):
+        """True once the run was asked to stop (by a signal)"""
+        return (self.stop_request is not None and
+                self.stop_request.is_set())
+
+    def _store_result(self, block):
+        """Move one completed replicate result onto its node.
+           A blocking wait gives up after STOP_POLL_INTERVAL seconds so
+           that the caller can check for a stop request.
+        """
+        try:
+            nodejob, result, exc = self.results.get(
+                block=block, timeout=STOP_POLL_INTERVAL)
+        except queue.Empty:
+            return ''
+        if exc is not None:
+            if not self.draining:
+                raise exc
+            # skipped after the stop request, or an engine stopped by
+            # the same signal: the node is left for a resumed run
+            nodejob['failed'] += result
+            return ''
+        self.maindata.add_rep_result(nodejob['fnode'], result, self.params)
+        nodejob['ncompleted'] += 1
+        self.n_completed += 1
+        cache_key = nodejob['cache_keys'].pop(result['label'], None)
+        if cache_key is not None:
+            self.cache.store(cache_key, result)
+        if self.journal is not None:
+            self.journal.record_result(nodejob['fnode'].label, result)
+        self.publish_status()
+        return ''
+
+    def collect(self, wait_all=False):
+        """Finalize completed nodes in submission order.
+           Blocks on the oldest node while the queue is over capacity,
+           until a stop is requested.
+        """
+        while not self.results.empty():
+            self._store_result(False)
+        while self.pending:
+            nodejob = self.pending[0]
+            if nodejob['ncompleted'] < nodejob['nreplicates']:
+                if self.stop_requested() or not (
+                        wait_all or (len(self.pending) > 1 and
+                                     self.queued_reps >
+                                     self.max_queued_reps)):
+                    break
+                self._store_result(True)
+                continue
+            self.pending.popleft()
+            self.finish_node(nodejob)
+        return ''
+
+    def finish_node(self, nodejob):
+        """Write the results of a node whose replicates are all done"""
+        self.queued_reps -= nodejob['nreplicates']
+        if nodejob['nreplicates'] < 1:  # no suitable replicates
+            self.maindata.process_empty_rep_results(
+                nodejob['fnode'], self.params, nodejob['nreplicates'])
+        else:
+            # sending params['just_clade'] = True will give back
+            # detailed name results
+            self.maindata.process_rep_results(
+                nodejob['fnode'], self.params, nodejob['nreplicates'])
+        if self.journal is not None:
+            self.journal.record_node(nodejob['fnode'].label,
+                                     nodejob['nreplicates'])
+        self.n_finished += 1
+        if self.params['verbose']:
+            print("{} replicates completed".format(self.n_completed))
+        return ''
+
+    def publish_status(self, force=False):
+        """Write the progress and the provisional scores of the nodes
+           in flight to the status file (every status_interval seconds)
+        """
+        if self.params['status_file_path'] is None or not (
+                force or time.time() - self.last_status >=
+                self.params['status_interval']):
+            return ''
+        self.last_status = time.time()
+        write_status(self.params['status_file_path'], {
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'elapsed_hours': round(
+                (time.time() - self.params['starttime']) / 3600., 4),
+            'nodes_finished': self.n_finished,
+            'replicates_completed': self.n_completed,
+            'nodes': [self.maindata.provisional_scores(
+                nodejob['fnode'], nodejob['ncompleted'],
+                nodejob['nreplicates'], self.params)
+                      for nodejob in self.pending]})
+        return ''
+
+    def drain(self):
+        """Collect the replicates that are already running, then shut
+           down.  Queued replicates are skipped by the workers, engine
+           failures are tolerated and nodes with missing replicates are
+           left unfinished and unjournaled (to be resumed later).
+        """
+        self.draining = True
+        self.stop_flag.set()
+        self.publish_status(force=True)
+        while self.pending:
+            nodejob = self.pending[0]
+            if (nodejob['ncompleted'] + nodejob['failed'] <
+                    nodejob['nreplicates']):
+                self._store_result(True)
+                continue
+            self.pending.popleft()
+            if nodejob['failed'] == 0:
+                self.finish_node(nodejob)
+        # every task has returned, nothing is left to wait for
+        self.stop(terminate=True)
+        return ''
+
+    def close(self):
+        """Wait for all outstanding nodes and shut down the pool, or
+           drain it if a stop is requested meanwhile
+        """
+        self.collect(wait_all=True)
+        if self.stop_requested():
+            return self.drain()
+        self.publish_status(force=True)
+        self.stop()
+        return ''
+
+    def stop(self, terminate=False):
+        """Shut down the worker processes"""
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        atexit.unregister(self.abort)
+        return ''
+
+    def abort(self):
+        """Kill the worker processes and their running engines"""
+        self.pool.terminate()
+        return ''
+
+
+class AsyncNodeScheduler(NodeScheduler):
+    """Runs the engine calls from an asyncio event loop in the main
+       process instead of a pool of Python workers.  Up to 'nprocs'
+       engine subprocesses run concurrently; their output is parsed in
+       the loop and handed to the same node bookkeeping as the pool.
+    """
+
+    def start(self):
+        """Start the event loop in a background thread"""
+        self.stop_flag = threading.Event()
+        self.setup_func, self.parse_func = get_engine_tasks(self.params)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.run_coroutine_threadsafe(
+            self._make_semaphore(), self.loop).result()
+        atexit.register(self.abort)
+        return ''
+
+    async def _make_semaphore(self):
+        """Semaphore bound to the event loop, limits running engines"""
+        return asyncio.Semaphore(self.params['nprocs'])
+
+    def run_replicate(self, nodejob, replicate):
+        """Schedule a single replicate on the event loop"""
+        future = asyncio.run_coroutine_threadsafe(
+            process_replicate_async(replicate, self.setup_func,
+                                    self.parse_func, self.semaphore,
+                                    self.stop_flag),
+            self.loop)
+        future.add_done_callback(partial(self._future_done, self._receive,
+                                         nodejob, 1))
+        return ''
+
+    def run_batch(self, nodejob, replicates):
+        """Schedule a batch of replicates as a single engine call"""
+        batch_setup_func, setup_func, parse_func = (
+            get_engine_batch_tasks(self.params))
+        future = asyncio.run_coroutine_threadsafe(
+            process_replicate_batch_async(replicates, batch_setup_func,
+                                          setup_func, parse_func,
+                                          self.semaphore, self.stop_flag),
+            self.loop)
+        future.add_done_callback(partial(self._future_done,
+                                         self._receive_batch, nodejob,
+                                         len(replicates)))
+        return ''
+
+    def _future_done(self, receive_func, nodejob, nreplicates, future):
+        """Future callback, passes the result or exception on"""
+        if future.exception() is not None:
+            self._receive_error(nodejob, nreplicates, future.exception())
+        else:
+            receive_func(nodejob, future.result())
+
+    def stop(self, terminate=False):
+        """Stop the event loop (after a drain no engine is left running)"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        atexit.unregister(self.abort)
+        return ''
+
+    def abort(self):
+        """Kill the running engines"""
+        for pid in list(RUNNING_ENGINES):
+            kill_process_group(pid)
+        return ''
+
+
+def kill_process_group(pid):
+    """Kill a process and the process group it leads"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except OSError:  # already gone
+        pass
+    return ''
+
+
+def get_scheduler(params, maindata, cache=None, journal=None,
+                  stop_request=None):
+    """Create the scheduler for the selected execution mode"""
+    if params['async_engines']:
+        return AsyncNodeScheduler(params, maindata, cache=cache,
+                                  journal=journal, stop_request=stop_request)
+    return NodeScheduler(params, maindata, cache=cache, journal=journal,
+                         stop_request=stop_request)
+
+
+if __name__ == "__main__":
+    print("This file is a function library, please run quartet_sampling.py")
@@ -20,32 +20,165 @@ You should have received a copy of the GNU General Public License
 along with 'quartetsampling'.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import heapq
 import time
 from phylo.tree_reader import read_tree_string
 from phylo.tree_utils import get_mrca
 
 
+# number of Newick pieces collected before the output trees are written
+TREE_WRITE_BUFFER = 1 << 14
+
+SCORE_TREE_KEYS = ('freq0', 'qc_score', 'qd_score', 'qi_score')
+
+FIGTREE_SETTINGS = ('end;\n\n\n\nbegin figtree;\n\n'
+                    '\tset appearance.backgroundColour=#-1;\n'
+                    '\tset appearance.branchColorAttribute="freq";\n'
+                    '\tset appearance.branchLineWidth=1.0;\n'
+                    '\tset appearance.foregroundColour=#-16777216;\n'
+                    '\tset appearance.selectionColour=#-2144520576;\n'
+                    '\tset branchLabels.displayAttribute="Branch times";\n'
+                    '\tset branchLabels.fontName="sansserif";\n'
+                    '\tset branchLabels.fontSize=8;\n'
+                    '\tset branchLabels.fontStyle=0;\n'
+                    '\tset branchLabels.isShown=false;\n'
+                    '\tset branchLabels.significantDigits=4;\n'
+                    '\tset layout.expansion=0;\n'
+                    '\tset layout.layoutType="RECTILINEAR";\n'
+                    '\tset layout.zoom=0;\n'
+                    '\tset nodeBars.barWidth=4.0;\n'
+                    '\tset nodeLabels.displayAttribute="label";\n'
+                    '\tset nodeLabels.fontName="sansserif";\n'
+                    '\tset nodeLabels.fontSize=8;\n'
+                    '\tset nodeLabels.fontStyle=0;\n'
+                    '\tset nodeLabels.isShown=false;\n'
+                    '\tset nodeLabels.significantDigits=4;\n'
+                    '\tset polarLayout.alignTipLabels=false;\n'
+                    '\tset polarLayout.angularRange=0;\n'
+                    '\tset polarLayout.rootAngle=0;\n'
+                    '\tset polarLayout.rootLength=100;\n'
+                    '\tset polarLayout.showRoot=true;\n'
+                    '\tset radialLayout.spread=0.0;\n'
+                    '\tset rectilinearLayout.alignTipLabels=false;\n'
+                    '\tset rectilinearLayout.curvature=0;\n'
+                    '\tset rectilinearLayout.rootLength=100;\n'
+                    '\tset scale.offsetAge=0.0;\n'
+                    '\tset scale.rootAge=1.0;\n'
+                    '\tset scale.scaleFactor=1.0;\n'
+                    '\tset scale.scaleRoot=false;\n'
+                    '\tset scaleAxis.automaticScale=true;\n'
+                    '\tset scaleAxis.fontSize=8.0;\n'
+                    '\tset scaleAxis.isShown=false;\n'
+                    '\tset scaleAxis.lineWidth=1.0;\n'
+                    '\tset scaleAxis.majorTicks=1.0;\n'
+                    '\tset scaleAxis.origin=0.0;\n'
+                    '\tset scaleAxis.reverseAxis=false;\n'
+                    '\tset scaleAxis.showGrid=true;\n'
+                    '\tset scaleAxis.significantDigits=4;\n'
+                    '\tset scaleBar.automaticScale=true;\n'
+                    '\tset scaleBar.fontSize=10.0;\n'
+                    '\tset scaleBar.isShown=true;\n'
+                    '\tset scaleBar.lineWidth=1.0;\n'
+                    '\tset scaleBar.scaleRange=0.0;\n'
+                    '\tset scaleBar.significantDigits=4;\n'
+                    '\tset tipLabels.displayAttribute="Names";\n'
+                    '\tset tipLabels.fontName="sansserif";\n'
+                    '\tset tipLabels.fontSize=8;\n'
+                    '\tset tipLabels.fontStyle=0;\n'
+                    '\tset tipLabels.isShown=true;\n'
+                    '\tset tipLabels.significantDigits=4;\n'
+                    '\tset trees.order=true;\n'
+                    '\tset trees.orderType="decreasing";\n'
+                    '\tset trees.rooting=false;\n'
+                    '\tset trees.rootingType="User Selection";\n'
+                    '\tset trees.transform=false;\n'
+                    '\tset trees.transformType="cladogram";\nend;\n\n')
+
+
+def output_labels(xnode, qfscores):
+    """Labels of the node in the labeled tree, the freq/qc/qd/qi score
+       trees and the FigTree tree (None for no label)
+    """
+    label = xnode.label
+    if xnode.children and "freq0" in xnode.data:
+        if len(xnode.data["freq0"]) > 0:
+            figlabel = ("[&label={},freq={},qc={},qd={},qi={},"
+                        "reps={},score={}/{}/{}]").format(
+                            xnode.label,
+                            xnode.data["freq0"],
+                            xnode.data["qc_score"],
+                            xnode.data["qd_score"],
+                            xnode.data["qi_score"],
+                            xnode.data["replicates"],
+                            xnode.data["qc_score"],
+                            xnode.data["qd_score"],
+                            xnode.data["qi_score"])
+        else:
+            figlabel = "[&label={},reps={}]".format(
+                xnode.label, xnode.data["replicates"])
+    else:
+        if label in qfscores:
+            label = "{}[&qf={}]".format(label, qfscores[label])
+        figlabel = label
+    if len(xnode.children) > 1:
+        scorelabels = ["{}={}".format(datakey.replace('_score', ''),
+                                      xnode.data.get(datakey, ''))
+                       for datakey in SCORE_TREE_KEYS]
+    else:
+        scorelabels = [label] * len(SCORE_TREE_KEYS)
+    return [label] + scorelabels + [figlabel]
+
+
+class LeafRange(object):
+    """Leaf labels of a subtree (or of the rest of the tree) given as
+       intervals of the tip order of TreeData instead of a set.
+       Supports len(), indexing and iteration, so quartets can be drawn
+       from it in O(1).
+    """
+
+    def __init__(self, labels, intervals):
+        self.labels = labels
+        self.intervals = [(start, end) for start, end in intervals
+                          if start < end]
+        self.size = sum(end - start for start, end in self.intervals)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        for start, end in self.intervals:
+            if 0 <= index < end - start:
+                return self.labels[start + index]
+            index -= end - start
+        raise IndexError("leaf index out of range")
+
+    def __iter__(self):
+        for start, end in self.intervals:
+            for i in range(start, end):
+                yield self.labels[i]
+
+
 class TreeData(object):
     """Main Tree Information"""
 
     def __init__(self, args):
         self.tree = None
         print("reading tree from {}".format(args.tree[0].name))
-        self.tree = read_tree_string(args.tree[0].readline())
+        self.tree = read_tree_string(args.tree[0].read())
         if self.tree is None:
             raise RuntimeError(
                 "Could not find a tree in the treefile: {}".format(
                     args.tree[0].name))
         args.tree[0].close()
-        self.leaves = self.tree.leaves()
+        self.index_leaves()
         self.nleaves = len(self.leaves)
         if args.verbose:
             print("tree has {} leaves".format(self.nleaves))
-        self.rootlabelset = set()
-        for leaf in self.leaves:
-            self.rootlabelset.add(leaf.label)
-        self.numnodes = (len(list(self.tree.iternodes())) -
-                         len(list(self.tree.leaves())))
+        self.numnodes = len(self.spans) - self.nleaves
+        # labels of the nodes processed by this run (--shard), None for all
+        self.shard_nodes = None
         self.clade = None
         if args.clade is not None:
             names = args.clade.split(",")
@@ -62,6 +195,47 @@ class TreeData(object):
                     raise RuntimeError("{} not found. Exiting...".format(i))
             self.clade = get_mrca(nodes, self.tree)
 
+    def index_leaves(self):
+        """Number the tips in tree order and give every node the
+           interval (start, end) of the numbers of its tips
+           (one iterative postorder pass)
+        """
+        self.leaves = []
+        self.tip_labels = []
+        self.spans = {}
+        stack = [(self.tree, False)]
+        while stack:
+            xnode, visited = stack.pop()
+            if visited:
+                self.spans[xnode] = (self.spans[xnode.children[0]][0],
+                                     self.spans[xnode.children[-1]][1])
+            elif not xnode.children:
+                self.spans[xnode] = (len(self.leaves), len(self.leaves) + 1)
+                self.leaves.append(xnode)
+                self.tip_labels.append(xnode.label)
+            else:
+                stack.append((xnode, True))
+                stack.extend((child, False)
+                             for child in reversed(xnode.children))
+        return ''
+
+    def leaf_range(self, nodes, complement=False):
+        """LeafRange of the tips below the nodes, or of all other tips"""
+        intervals = sorted(self.spans[x] for x in nodes)
+        if complement:
+            gaps = []
+            position = 0
+            for start, end in intervals:
+                gaps.append((position, start))
+                position = max(position, end)
+            gaps.append((position, self.nleaves))
+            intervals = gaps
+        return LeafRange(self.tip_labels, intervals)
+
+    def nleaves_below(self, xnode):
+        """Number of tips below the node"""
+        return self.spans[xnode][1] - self.spans[xnode][0]
+
     def __str__(self):
         print("tree:", self.tree.get_newick_repr())
         print("leaves", [x.label for x in self.leaves])
@@ -92,7 +266,8 @@ class TreeData(object):
             time_string = (user_feedback_time(k, root_bipart_label, params,
                                               self.numnodes)
                            if k > params["startk"] else "")
-            if not params.get("suppress_feedback", False) is True:
+            if (not params.get("suppress_feedback", False) is True and
+                    self.in_shard(fnode)):
                 print("\nprocessing node {}/{}{}".format(
                     k, self.numnodes, time_string))
         #  require a bifurcating tree
@@ -121,161 +296,91 @@ class TreeData(object):
                   root_bipart_label + ").")
             fnode.label = root_bipart_label
             return k, False
-        # sanity check
-        allset = set()
-        for leafset in leafsets.values():
-            assert len(leafset) > 0
-            allset.update(leafset)
-        assert len(allset) == self.nleaves
-        del allset
+        # sanity check (the leaf ranges are disjoint by construction)
+        sizes = [len(leafset) for leafset in leafsets.values()]
+        assert min(sizes) > 0 and sum(sizes) == self.nleaves
+        if not self.in_shard(fnode):
+            # processed by another shard of the run
+            return k, False
         return k, leafsets
 
-    def write_scoretrees(self, params):
-        """Various trees annotated with scores"""
-        # LEAVING THESE FOR SIMS, BUT REMOVE AFTER THAT AND JUST USE THE
-        # MULTILABELED ONE, FREQ IS GOING TO BE QS_FREQ UNTIL AFTER SIMS
-        # write the tree with all processed nodes labeled
-        with open(params['tree_result_file_path'], "w") as tree_file_path:
-            tree_file_path.write(self.tree.get_newick_repr(True) + ";")
-        # write a tree with the frequencies at the nodes
-        for datakey, datafile in (
-                ('freq0', 'freq_file_path'),
-                ('qc_score', 'qc_tree_file_path'),
-                ('qd_score', 'qd_tree_file_path'),
-                ('qi_score', 'qi_tree_file_path')):
-            for i in self.tree.iternodes():
-                if (len(i.children) > 1 and
-                        i is not self.tree and datakey in i.data):
-                    i.label = "{}={}".format(datakey.replace('_score', ''),
-                                             i.data.get(datakey, ''))
-                elif len(i.children) > 1:
-                    i.label = "{}={}".format(datakey.replace('_score', ''),
-                                             i.data.get(datakey, ''))
-            with open(params[datafile], "w") as freq_file_path:
-                freq_file_path.write(self.tree.get_newick_repr(True) + ";")
-        return ''
+    def in_shard(self, fnode):
+        """True if the node is processed by this run"""
+        return self.shard_nodes is None or fnode.label in self.shard_nodes
 
-    def write_figtree(self, outfname, qfscores):
-        """Write output in FigTree format with scores"""
-        # change the names (internal only) to be the full figtree style label
-        for xnode in self.tree.iternodes():
-            xnode.data["lab"] = xnode.label  # so we can use it later
-            if "freq0" not in xnode.data:
-                if xnode.label in qfscores:
-                    lab = ("{}[&qf={}]".format(
-                        xnode.label,
-                        qfscores[xnode.label]))
-                    xnode.label = lab
-            #    continue
-            elif len(xnode.children) == 0:
-                if xnode.label in qfscores:
-                    lab = ("{}[&qf={}]".format(
-                        xnode.label,
-                        qfscores[xnode.label]))
-                    xnode.label = lab
-            elif len(xnode.data["freq0"]) > 0:
-                lab = ("[&label={},freq={},qc={},qd={},qi={},"
-                       "reps={},score={}/{}/{}]").format(
-                           xnode.label,
-                           xnode.data["freq0"],
-                           xnode.data["qc_score"],
-                           xnode.data["qd_score"],
-                           xnode.data["qi_score"],
-                           xnode.data["replicates"],
-                           xnode.data["qc_score"],
-                           xnode.data["qd_score"],
-                           xnode.data["qi_score"]
-                           )
-                xnode.label = lab
-            else:
-                lab = ("[&label={},reps={}]").format(
-                    xnode.label,
-                    xnode.data["replicates"])
-                xnode.label = lab
-        outf = open(outfname, "w")
-        outf.write('#NEXUS\nbegin trees;\n\n')
-        outf.write('\ttree tree1 = [&R] {};\n\n'.format(
-            self.tree.get_newick_repr(True)))
-        outf.write('end;\n\n\n\nbegin figtree;\n\n'
-                   '\tset appearance.backgroundColour=#-1;\n'
-                   '\tset appearance.branchColorAttribute="freq";\n'
-                   '\tset appearance.branchLineWidth=1.0;\n'
-                   '\tset appearance.foregroundColour=#-16777216;\n'
-                   '\tset appearance.selectionColour=#-2144520576;\n'
-                   '\tset branchLabels.displayAttribute="Branch times";\n'
-                   '\tset branchLabels.fontName="sansserif";\n'
-                   '\tset branchLabels.fontSize=8;\n'
-                   '\tset branchLabels.fontStyle=0;\n'
-                   '\tset branchLabels.isShown=false;\n'
-                   '\tset branchLabels.significantDigits=4;\n'
-                   '\tset layout.expansion=0;\n'
-                   '\tset layout.layoutType="RECTILINEAR";\n'
-                   '\tset layout.zoom=0;\n'
-                   '\tset nodeBars.barWidth=4.0;\n'
-                   '\tset nodeLabels.displayAttribute="label";\n'
-                   '\tset nodeLabels.fontName="sansserif";\n'
-                   '\tset nodeLabels.fontSize=8;\n'
-                   '\tset nodeLabels.fontStyle=0;\n'
-                   '\tset nodeLabels.isShown=false;\n'
-                   '\tset nodeLabels.significantDigits=4;\n'
-                   '\tset polarLayout.alignTipLabels=false;\n'
-                   '\tset polarLayout.angularRange=0;\n'
-                   '\tset polarLayout.rootAngle=0;\n'
-                   '\tset polarLayout.rootLength=100;\n'
-                   '\tset polarLayout.showRoot=true;\n'
-                   '\tset radialLayout.spread=0.0;\n'
-                   '\tset rectilinearLayout.alignTipLabels=false;\n'
-                   '\tset rectilinearLayout.curvature=0;\n'
-                   '\tset rectilinearLayout.rootLength=100;\n'
-                   '\tset scale.offsetAge=0.0;\n'
-                   '\tset scale.rootAge=1.0;\n'
-                   '\tset scale.scaleFactor=1.0;\n'
-                   '\tset scale.scaleRoot=false;\n'
-                   '\tset scaleAxis.automaticScale=true;\n'
-                   '\tset scaleAxis.fontSize=8.0;\n'
-                   '\tset scaleAxis.isShown=false;\n'
-                   '\tset scaleAxis.lineWidth=1.0;\n'
-                   '\tset scaleAxis.majorTicks=1.0;\n'
-                   '\tset scaleAxis.origin=0.0;\n'
-                   '\tset scaleAxis.reverseAxis=false;\n'
-                   '\tset scaleAxis.showGrid=true;\n'
-                   '\tset scaleAxis.significantDigits=4;\n'
-                   '\tset scaleBar.automaticScale=true;\n'
-                   '\tset scaleBar.fontSize=10.0;\n'
-                   '\tset scaleBar.isShown=true;\n'
-                   '\tset scaleBar.lineWidth=1.0;\n'
-                   '\tset scaleBar.scaleRange=0.0;\n'
-                   '\tset scaleBar.significantDigits=4;\n'
-                   '\tset tipLabels.displayAttribute="Names";\n'
-                   '\tset tipLabels.fontName="sansserif";\n'
-                   '\tset tipLabels.fontSize=8;\n'
-                   '\tset tipLabels.fontStyle=0;\n'
-                   '\tset tipLabels.isShown=true;\n'
-                   '\tset tipLabels.significantDigits=4;\n'
-                   '\tset trees.order=true;\n'
-                   '\tset trees.orderType="decreasing";\n'
-                   '\tset trees.rooting=false;\n'
-                   '\tset trees.rootingType="User Selection";\n'
-                   '\tset trees.transform=false;\n'
-                   '\tset trees.transformType="cladogram";\nend;\n\n')
-        outf.close()
-        for xnode in self.tree.iternodes():
-            if "freq0" not in xnode.data:
+    def node_costs(self, params, aln):
+        """Expected relative cost of each node that will be processed:
+           the number of replicates it can get times the sites per
+           replicate alignment.  Nodes are labeled as in the main loop.
+        """
+        plan_params = dict(params)
+        plan_params.update({'suppress_feedback': True,
+                            'starttime': time.time()})
+        shard_nodes, self.shard_nodes = self.shard_nodes, None
+        ngenes = len(aln.genes) if params['using_genetrees'] else 1
+        sites = aln.length / float(ngenes)
+        costs = []
+        k = 1
+        for fnode in self.tree.iternodes():
+            if self.clade is not None and fnode is not self.clade:
                 continue
-            if len(xnode.children) == 0:
+            if k > params['stopk']:
+                break
+            k, leafsets = self.check_node(fnode, k, plan_params)
+            if leafsets is False:
                 continue
-            xnode.label = xnode.data["lab"]
+            n_possible_replicates = ngenes
+            for leafset in leafsets.values():
+                n_possible_replicates *= len(leafset)
+            costs.append((fnode.label,
+                          min(n_possible_replicates, params['nreps']) *
+                          sites))
+        self.shard_nodes = shard_nodes
+        return costs
+
+    def write_trees(self, params, qfscores):
+        """Write the labeled tree, the trees with the freq/qc/qd/qi
+           scores at the nodes and the FigTree file in one traversal
+           (streamed to the files, the node labels are left unchanged)
+        """
+        outfiles = [open(params[x], "w") for x in (
+            'tree_result_file_path', 'freq_file_path', 'qc_tree_file_path',
+            'qd_tree_file_path', 'qi_tree_file_path', 'figtree_file_path')]
+        try:
+            outfiles[-1].write('#NEXUS\nbegin trees;\n\n'
+                               '\ttree tree1 = [&R] ')
+            buffers = [[] for _ in outfiles]
+            for part in self.tree.newick_parts():
+                if isinstance(part, str):
+                    for buf in buffers:
+                        buf.append(part)
+                else:
+                    length = ":" + str(part.length)
+                    for buf, label in zip(buffers,
+                                          output_labels(part, qfscores)):
+                        if label is not None:
+                            buf.append(label)
+                        buf.append(length)
+                if len(buffers[0]) >= TREE_WRITE_BUFFER:
+                    for outf, buf in zip(outfiles, buffers):
+                        outf.write("".join(buf))
+                        buf.clear()
+            for outf, buf in zip(outfiles, buffers):
+                outf.write("".join(buf))
+            for outf in outfiles[:-1]:
+                outf.write(";")
+            outfiles[-1].write(';\n\n' + FIGTREE_SETTINGS)
+        finally:
+            for outf in outfiles:
+                outf.close()
         return ''
 
     def set_leaf_sets(self, fnode, root_bipart_label=None):
-        """Get sets of leaves"""
+        """Get sets of leaves (as LeafRange intervals of the tip order)"""
         leafsets = {}
         # two daughter subtrees
         for i, lbl in enumerate(["R1", "R2"]):
-            leafsets[lbl] = set([fnode.children[i].label, ]
-                                if fnode.istip
-                                else [l.label for l in
-                                      fnode.children[i].leaves()])
+            leafsets[lbl] = self.leaf_range([fnode.children[i]])
         # sibling/parent subtrees
         is_other_side_of_root = False  # used when we hit root a second time
         skip_tip_child_of_root = False  # used when a child of root is a tip
@@ -285,7 +390,8 @@ class TreeData(object):
             if sib != fnode:
                 testsib = True
                 # if one of the subtrees is the root, skip over it
-                if len(sib.leaves()) + len(fnode.leaves()) == self.nleaves:
+                if (self.nleaves_below(sib) + self.nleaves_below(fnode) ==
+                        self.nleaves):
                     # if we already processed this bipart (on other side of
                     # the root), don't do it again
                     if root_bipart_label is not None:
@@ -294,11 +400,8 @@ class TreeData(object):
                     # get the subtrees opposite the root
                     if len(sib.children) == 2:
                         for i, lbl in enumerate(["L1", "L2"]):
-                            leafsets[lbl] = set(
-                                [sib.children[i].label, ]
-                                if sib.children[i].istip
-                                else [l.label for l in
-                                      sib.children[i].leaves()])
+                            leafsets[lbl] = self.leaf_range(
+                                [sib.children[i]])
                     elif len(sib.children) == 0:
                         skip_tip_child_of_root = True
                         tip_child_label = sib.label
@@ -312,15 +415,40 @@ class TreeData(object):
                 # otherwise not at root, all connected subtrees have children
                 else:
                     # sibling subtree
-                    leafsets["L1"] = set([l.label for l in sib.leaves()])
+                    leafsets["L1"] = self.leaf_range([sib])
                     # the rest of the tree
-                    leafsets["L2"] = self.rootlabelset - \
-                        (leafsets["R1"].union(leafsets["R2"]).union(
-                            leafsets["L1"]))  # set()
+                    leafsets["L2"] = self.leaf_range([fnode, sib],
+                                                     complement=True)
         return leafsets, testsib, root_bipart_label, is_other_side_of_root, \
             skip_tip_child_of_root, tip_child_label
 
 
+def assign_shards(costs, nshards):
+    """Balance the nodes over the shards (longest processing time first):
+       each node, from the most to the least expensive, goes to the
+       shard with the lowest total so far.  Returns {node label: shard}
+       with shards numbered from 1.
+    """
+    assignment = {}
+    loads = [(0.0, i) for i in range(1, nshards + 1)]
+    heapq.heapify(loads)
+    for label, cost in sorted(costs, key=lambda x: -x[1]):
+        load, shard = heapq.heappop(loads)
+        assignment[label] = shard
+        heapq.heappush(loads, (load + cost, shard))
+    return assignment
+
+
+def write_shard_plan(fpath, costs, assignment):
+    """Write the node to shard assignment"""
+    with open(fpath, "w") as outfile:
+        outfile.write("node_label\texpected_cost\tshard\n")
+        for label, cost in costs:
+            outfile.write("{}\t{:.6g}\t{}\n".format(label, cost,
+                                                    assignment[label]))
+    return ''
+
+
 def user_feedback_time(k, root_bipart_label, params, numnodes):
     """User feedback of time left"""
     mean_time_secs = ((time.time() - params['starttime']) /
@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+"""
+Unit checks of the library modules in ../pysrc, run by run_tests.py
+after the test datasets (or directly: python run_checks.py).
+"""
+
+import contextlib
+import io
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pysrc'))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+
+
+def read_phylip(fpath):
+    """Sequences of a sequential PHYLIP file, in file order"""
+    with open(fpath) as infile:
+        lines = infile.read().split('\n')[1:]
+    return [line.split()[1] for line in lines if line.strip()]
+
+
+# Newick reader
+
+def check_tree_reader():
+    from phylo.tree_reader import read_tree_string, read_trees
+    tree = read_tree_string("((a:1,'b c':2e-3)x:0.5[&support=1],d);")
+    assert tree.get_newick_repr(True) == (
+        "((a:1.0,b c:0.002)x:0.5,d:0.0):0.0"), tree.get_newick_repr(True)
+    assert len(list(read_trees("(a,b);\n(c,d);"))) == 2
+    for newick, message in (("(a,b):;", "Invalid branch length"),
+                            ("(a:x,b);", "Invalid branch length"),
+                            ("((a,b);", "Unbalanced '('"),
+                            ("((a,b)", "Unbalanced '('"),
+                            ("(a,b));", "Unbalanced ')'")):
+        try:
+            list(read_trees(newick))
+        except ValueError as exc:
+            assert str(exc).startswith(message), (newick, str(exc))
+        else:
+            raise AssertionError("{} was accepted".format(newick))
+
+
+def check_tree_splits():
+    from phylo.tree_reader import read_tree_string
+    from phylo.tree_utils import calc_biparts, rf_dist, split_support
+    tree1 = read_tree_string("((a,b),(c,d),e);")
+    tree2 = read_tree_string("((a,c),(b,d),e);")
+    assert rf_dist(tree1, tree2) == 4, rf_dist(tree1, tree2)
+    assert rf_dist(tree1, read_tree_string("((a,b),(c,d),e);")) == 0
+    # the same unrooted tree with another root
+    assert rf_dist(tree1, read_tree_string("(a,b,((c,d),e));")) == 0
+    # only the shared tips are compared
+    assert rf_dist(tree1, read_tree_string("(((a,b),f),(c,d),e);")) == 0
+    sides = sorted(sorted(sorted(x) for x in pair)
+                   for pair in zip(*calc_biparts(tree1)))
+    assert sides == [[['a', 'b'], ['c', 'd', 'e']],
+                     [['a', 'b', 'e'], ['c', 'd']]], sides
+    counts, first = split_support(
+        [tree1, tree2, read_tree_string("(a,b,((c,d),e));")])
+    assert sorted(counts.values()) == [1, 1, 2, 2], counts
+    for key, count in counts.items():
+        tree, node = first[key]
+        assert (count == 2) == (set(node.lvsnms()) in (
+            {'a', 'b'}, {'c', 'd'})), (count, node.lvsnms())
+
+
+# native likelihood engine
+
+def expm(qmat):
+    """Matrix exponential by scaling and squaring of the Taylor series
+       (independent of the eigen decomposition used by the engine)
+    """
+    import numpy as np
+    nsquare = max(0, int(math.ceil(math.log2(
+        max(np.abs(qmat).sum(axis=1).max(), 1e-300)))) + 4)
+    scaled = qmat / 2 ** nsquare
+    result = term = np.eye(len(qmat))
+    for k in range(1, 20):
+        term = np.dot(term, scaled) / k
+        result = result + term
+    for _ in range(nsquare):
+        result = np.dot(result, result)
+    return result
+
+
+def brute_force_lnlike(seqs, topology, brlens, exchange, freqs, rates):
+    """Quartet log-likelihood summed over the states of both internal
+       nodes, site by site
+    """
+    import numpy as np
+    from native_engine import TOPOLOGY_PAIRS
+    qmat = exchange * freqs[None, :]
+    np.fill_diagonal(qmat, 0.0)
+    np.fill_diagonal(qmat, -qmat.sum(axis=1))
+    qmat /= -np.dot(freqs, np.diag(qmat))
+    (tip1, tip2), (tip3, tip4) = TOPOLOGY_PAIRS[topology]
+    total = 0.0
+    for site in zip(*seqs):
+        states = ['ACGT'.index(x) for x in site]
+        sitelike = 0.0
+        for rate in rates:
+            pmat = [expm(qmat * brlen * rate) for brlen in brlens]
+            for xstate in range(4):
+                for ystate in range(4):
+                    sitelike += (freqs[xstate] * pmat[4][xstate, ystate] *
+                                 pmat[tip1][xstate, states[tip1]] *
+                                 pmat[tip2][xstate, states[tip2]] *
+                                 pmat[tip3][ystate, states[tip3]] *
+                                 pmat[tip4][ystate, states[tip4]])
+        total += math.log(sitelike / len(rates))
+    return total
+
+
+def check_native_gamma_rates():
+    from native_engine import discrete_gamma_rates
+    # Yang (1994) J Mol Evol 39:306, four categories, mean rates
+    for alpha, expected in ((0.5, (0.0334, 0.2519, 0.8203, 2.8944)),
+                            (1.0, (0.1370, 0.4768, 1.0000, 2.3863))):
+        rates = discrete_gamma_rates(alpha, 4)
+        assert max(abs(x - y) for x, y in zip(rates, expected)) < 1e-3, (
+            alpha, list(rates))
+
+
+def check_native_lnlike():
+    import numpy as np
+    from native_engine import (QuartetLikelihood, QuartetModel,
+                               discrete_gamma_rates)
+    seqs = read_phylip(os.path.join(FIXTURES, 'quartet.phy'))
+    brlens = [0.05, 0.3, 0.12, 0.2, 0.08]
+    # JC, no rate heterogeneity
+    qlike = QuartetLikelihood(seqs, QuartetModel('JC', 'nuc'))
+    for topology in (0, 1, 2):
+        expected = brute_force_lnlike(seqs, topology, brlens, np.ones((4, 4)),
+                                      np.full(4, 0.25), [1.0])
+        assert abs(qlike.lnlike(topology, brlens) - expected) < 1e-6, (
+            topology, qlike.lnlike(topology, brlens), expected)
+    # GTR+G4 at fixed parameters
+    qlike = QuartetLikelihood(seqs, QuartetModel('GTR+G4', 'nuc'))
+    qlike.params.update({'alpha': 0.5, 'rate0': 1.5, 'rate1': 4.0,
+                         'rate2': 0.7, 'rate3': 1.2, 'rate4': 5.0})
+    exchange = qlike.exchangeabilities()
+    for topology in (0, 1, 2):
+        expected = brute_force_lnlike(seqs, topology, brlens, exchange,
+                                      qlike.freqs,
+                                      discrete_gamma_rates(0.5, 4))
+        assert abs(qlike.lnlike(topology, brlens) - expected) < 1e-6, (
+            topology, qlike.lnlike(topology, brlens), expected)
+
+
+def check_native_optimum():
+    from native_engine import (QuartetLikelihood, QuartetModel,
+                               evaluate_quartet)
+    seqs = read_phylip(os.path.join(FIXTURES, 'quartet.phy'))
+    for model_string in ('JC', 'HKY', 'GTR+G4'):
+        lnlikes = evaluate_quartet(seqs, model_string, 'nuc')
+        # no random restart finds a better fit
+        rng = random.Random(1)
+        for topology in (0, 1, 2):
+            for _ in range(3):
+                qlike = QuartetLikelihood(seqs, QuartetModel(model_string,
+                                                             'nuc'))
+                for name in qlike.params:
+                    qlike.params[name] = math.exp(rng.uniform(-1.5, 1.5))
+                lnl, _ = qlike.optimize(
+                    topology, [rng.uniform(0.01, 1.0) for _ in range(5)],
+                    rounds=100)
+                assert lnl < lnlikes[topology] + 0.05, (
+                    model_string, topology, lnl, lnlikes[topology])
+    # identical sequences: zero branch lengths, lnL of the site frequencies
+    lnlikes = evaluate_quartet([seqs[0]] * 4, 'JC', 'nuc')
+    assert max(abs(x - len(seqs[0]) * math.log(0.25)) for x in lnlikes) < 0.01
+
+
+def check_native_raxmlng():
+    """Optimized GTR+G4 lnL against raxml-ng --evaluate, if installed"""
+    from native_engine import TOPOLOGY_PAIRS, evaluate_quartet
+    executable = shutil.which('raxml-ng')
+    if executable is None:
+        return "skipped, raxml-ng not found"
+    seqs = read_phylip(os.path.join(FIXTURES, 'quartet.phy'))
+    names = ('L1', 'L2', 'R1', 'R2')
+    lnlikes = evaluate_quartet(seqs, 'GTR+G4', 'nuc')
+    with tempfile.TemporaryDirectory() as temp_wd:
+        for topology, ((tip1, tip2), (tip3, tip4)) in TOPOLOGY_PAIRS.items():
+            with open(os.path.join(temp_wd, 'test.tre'), 'w') as outfile:
+                outfile.write("(({},{}),{},{});\n".format(
+                    names[tip1], names[tip2], names[tip3], names[tip4]))
+            proc = subprocess.run(
+                [executable, '--evaluate', '--msa',
+                 os.path.join(FIXTURES, 'quartet.phy'), '--tree', 'test.tre',
+                 '--model', 'GTR+G4+FC', '--threads', '1', '--prefix', 'q',
+                 '--force'], cwd=temp_wd, stdout=subprocess.PIPE,
+                universal_newlines=True)
+            found = [line for line in proc.stdout.split('\n')
+                     if line.startswith('Final LogLikelihood:')]
+            if not found:
+                return "skipped, raxml-ng did not report a likelihood"
+            # the native engine adds a pseudocount to the frequencies
+            expected = float(found[0].split()[-1])
+            assert abs(lnlikes[topology] - expected) < 0.5, (
+                topology, lnlikes[topology], expected)
+    return ''
+
+
+# alignment readers
+
+ALIGNMENT_FIXTURES = ('aln.phy', 'aln_interleaved.phy', 'aln.fa', 'aln.nex',
+                      'aln.phy.gz')
+
+
+def load_alignment(fpath, temp_wd, **options):
+    """Alignment read the way quartet_sampling.py reads --align"""
+    from alignment import Alignment, open_alignment
+    params = {'min_overlap': 0, 'data_type': 'nuc', 'alignment_cache': False,
+              'nprocs': 1, 'temp_wd': temp_wd, 'low_mem': False,
+              'verbose': False}
+    params.update(options)
+    aln = Alignment(params)
+    # the progress messages are not part of the check
+    with contextlib.redirect_stdout(io.StringIO()):
+        aln.read_align(open_alignment(fpath), params)
+    return aln
+
+
+def alignment_contents(aln):
+    """Sequence, valid site bits and valid site count of every taxon"""
+    return dict((name, (aln.seqs[name], aln.valid_sites[name],
+                        aln.valid_counts[name])) for name in aln.seqs)
+
+
+def check_alignment_formats():
+    with tempfile.TemporaryDirectory() as temp_wd:
+        expected = alignment_contents(load_alignment(
+            os.path.join(FIXTURES, 'aln.phy'), temp_wd))
+        assert len(expected) == 6 and all(
+            len(x[0]) == 30 for x in expected.values()), expected
+        # gaps and N/? are not valid sites
+        assert expected['taxon_D'][2] == 28, expected['taxon_D']
+        for fname in ALIGNMENT_FIXTURES[1:]:
+            found = alignment_contents(load_alignment(
+                os.path.join(FIXTURES, fname), temp_wd))
+            assert found == expected, (fname, found)
+        found = alignment_contents(load_alignment(
+            os.path.join(FIXTURES, 'aln.fa'), temp_wd, low_mem=True))
+        assert found == expected, ('low_mem', found)
+
+
+def check_alignment_cache():
+    from alignment import PackedSequenceMatrix
+    with tempfile.TemporaryDirectory() as temp_wd:
+        fpath = os.path.join(temp_wd, 'aln.fa')
+        shutil.copy(os.path.join(FIXTURES, 'aln.fa'), fpath)
+        expected = alignment_contents(load_alignment(fpath, temp_wd))
+        written = load_alignment(fpath, temp_wd, alignment_cache=True)
+        assert os.path.exists(fpath + '.qscache')
+        assert alignment_contents(written) == expected
+        cached = load_alignment(fpath, temp_wd, alignment_cache=True)
+        assert isinstance(cached.seqs, PackedSequenceMatrix)
+        assert alignment_contents(cached) == expected
+        assert cached.seqs.row('taxon_B', 5, 12) == b'ATGCCTT'
+        # a changed alignment invalidates the cache
+        with open(fpath, 'a') as outfile:
+            outfile.write('>taxon_G\n' + 'A' * 30 + '\n')
+        reread = load_alignment(fpath, temp_wd, alignment_cache=True)
+        assert not isinstance(reread.seqs, PackedSequenceMatrix)
+        assert len(reread.seqs) == 7
+
+
+def check_alignment_parallel():
+    import alignment
+    min_size = alignment.PARALLEL_LOAD_MIN_SIZE
+    # also tiny files are split into chunks
+    alignment.PARALLEL_LOAD_MIN_SIZE = 0
+    try:
+        with tempfile.TemporaryDirectory() as temp_wd:
+            for fname in ('aln.phy', 'aln.fa'):
+                fpath = os.path.join(FIXTURES, fname)
+                expected = alignment_contents(load_alignment(fpath, temp_wd))
+                aln = load_alignment(fpath, temp_wd, nprocs=2)
+                assert os.path.exists(os.path.join(temp_wd,
+                                                   'alignment.matrix'))
+                assert alignment_contents(aln) == expected, fname
+                os.remove(os.path.join(temp_wd, 'alignment.matrix'))
+            # interleaved and compressed files are read line by line
+            for fname in ('aln_interleaved.phy', 'aln.phy.gz'):
+                aln = load_alignment(os.path.join(FIXTURES, fname), temp_wd,
+                                     nprocs=2)
+                assert not os.path.exists(os.path.join(
+                    temp_wd, 'alignment.matrix')), fname
+                assert alignment_contents(aln) == expected, fname
+    finally:
+        alignment.PARALLEL_LOAD_MIN_SIZE = min_size
+
+
+# result cache
+
+def check_result_cache_shared():
+    """Two runs sharing one cache file (e.g. --shard) can both write"""
+    import sqlite3
+    from result_cache import ResultCache
+    with tempfile.TemporaryDirectory() as temp_wd:
+        params = {'result_cache_path': os.path.join(temp_wd, 'cache.sqlite'),
+                  'result_cache_size': 100, 'lnlikethresh': 0,
+                  'engine': 'raxml-ng', 'engine_executable': 'raxml-ng',
+                  'engine_model': 'GTR+G4', 'data_type': 'nuc',
+                  'partitions_file_path': None}
+        caches = [ResultCache(params), ResultCache(params)]
+        replicate = {'unique_label': 'QS1.0', 'seq_names': {},
+                     'genename': None}
+        for i in range(20):
+            cache = caches[i % 2]
+            if i > 0:
+                # the other run sees what was stored just before
+                assert cache.lookup('key{}'.format(i - 1),
+                                    replicate) is not None, i
+            cache.store('key{}'.format(i), {'best_tree': i % 3})
+        assert [x.stored for x in caches] == [10, 10]
+        # a run that holds the write lock makes the store a warning only
+        blocker = sqlite3.connect(params['result_cache_path'])
+        blocker.execute("BEGIN IMMEDIATE")
+        caches[0].conn.execute("PRAGMA busy_timeout = 100")
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            caches[0].store('key_locked', {'best_tree': 0})
+        assert caches[0].stored == 10 and 'WARNING' in out.getvalue()
+        blocker.rollback()
+        blocker.close()
+        for cache in caches:
+            cache.close()
+        check = ResultCache(params)
+        assert check.conn.execute(
+            "SELECT COUNT(*) FROM results").fetchone()[0] == 20
+        check.close()
+
+
+# run journal
+
+def check_journal_settings():
+    """A journal is only resumed by a run with the same settings and
+       unchanged input files
+    """
+    from journal import RunJournal
+    with tempfile.TemporaryDirectory() as temp_wd:
+        aln_path = os.path.join(temp_wd, 'aln.phy')
+        shutil.copy(os.path.join(FIXTURES, 'aln.phy'), aln_path)
+        params = {'journal_file_path': os.path.join(temp_wd, 'journal'),
+                  'engine': 'native', 'engine_executable': None,
+                  'engine_model': 'GTR+G4', 'data_type': 'nuc',
+                  'lnlikethresh': 2.0, 'nreps': 10, 'min_overlap': 1,
+                  'compress_patterns': False,
+                  'max_quartet_enumeration_threshold': 0.1,
+                  'genetrees_file_path': None, 'partitions_file_path': None,
+                  'resume': True}
+        RunJournal(params, [aln_path]).close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            RunJournal(params, [aln_path]).close()
+        changes = [('min_overlap', 5), ('engine_executable', '/bin/true'),
+                   ('compress_patterns', True),
+                   ('partitions_file_path', aln_path)]
+        for name, value in changes:
+            try:
+                RunJournal(dict(params, **{name: value}), [aln_path])
+            except RuntimeError:
+                continue
+            raise AssertionError("resumed with a different {}".format(name))
+        # the same path, edited in place
+        with open(aln_path, 'a') as outfile:
+            outfile.write('taxon_G ' + 'A' * 30 + '\n')
+        try:
+            RunJournal(params, [aln_path])
+        except RuntimeError:
+            return ''
+        raise AssertionError("resumed with a changed alignment")
+
+
+# node scheduler
+
+def stub_replicate(replicate):
+    """Pool task standing in for an engine, takes replicate['sleep']"""
+    time.sleep(replicate['sleep'])
+    return {'label': replicate['unique_label'],
+            'node_id': replicate['node_id']}
+
+
+class StubNode(object):
+
+    def __init__(self, label):
+        self.label = label
+
+
+class SchedulerData(object):
+    """Stands in for rep_data.DataStore, records what the scheduler
+       does with the results
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.finished = []
+
+    def add_rep_result(self, fnode, result, params):
+        assert fnode.label not in self.finished, fnode.label
+        assert result['node_id'] == fnode.label, (result, fnode.label)
+        self.added[fnode.label] = self.added.get(fnode.label, 0) + 1
+        return ''
+
+    def process_rep_results(self, fnode, params, nreplicates):
+        assert self.added[fnode.label] == nreplicates, fnode.label
+        self.finished.append(fnode.label)
+        return ''
+
+    def provisional_scores(self, fnode, ncompleted, nreplicates, params):
+        return {'node_label': fnode.label, 'completed': ncompleted,
+                'num_replicates': nreplicates}
+
+
+def check_scheduler_order():
+    """Nodes finishing out of order are finalized in submission order,
+       with every result added and the queue kept under its limit
+    """
+    import json
+    from scheduler import NodeScheduler
+    with tempfile.TemporaryDirectory() as temp_wd:
+        params = {'nprocs': 3, 'nreps': 3, 'engine': 'native',
+                  'lnlikethresh': 0, 'engine_batch_size': 1,
+                  'verbose': False, 'starttime': time.time(),
+                  'status_file_path': os.path.join(temp_wd, 'status.json'),
+                  'status_interval': 3600}
+        maindata = SchedulerData()
+        sched = NodeScheduler(params, maindata)
+        sched.func = stub_replicate
+        labels = ['QS{}'.format(i) for i in range(1, 9)]
+        try:
+            for i, label in enumerate(labels):
+                # the first replicates of each node take longest, and
+                # the nodes get faster, so later nodes finish first
+                replicates = [{'unique_label': '{}.{}'.format(label, j),
+                               'node_id': label,
+                               'sleep': 0.2 / (i + 1) / (j + 1)}
+                              for j in range(3)]
+                # QS2 has a result from an earlier run
+                completed = ([{'label': 'QS2.3', 'node_id': 'QS2'}]
+                             if label == 'QS2' else None)
+                sched.submit(StubNode(label), replicates, completed)
+                assert (len(sched.pending) < 2 or
+                        sched.queued_reps <= sched.max_queued_reps), (
+                            sched.queued_reps, sched.max_queued_reps)
+                if i == 4:
+                    sched.publish_status(force=True)
+                    with open(params['status_file_path']) as infile:
+                        status = json.load(infile)
+                    assert status['nodes_finished'] == len(maindata.finished)
+                    assert [x['node_label'] for x in status['nodes']] == [
+                        x['fnode'].label for x in sched.pending]
+            sched.close()
+        except BaseException:
+            sched.abort()
+            raise
+        assert maindata.finished == labels, maindata.finished
+        assert maindata.added['QS2'] == 4
+        assert sched.n_completed == 3 * len(labels)
+        assert sched.queued_reps == 0
+        with open(params['status_file_path']) as infile:
+            status = json.load(infile)
+        assert status['nodes_finished'] == len(labels)
+        assert status['replicates_completed'] == 3 * len(labels)
+        assert status['nodes'] == []
+
+
+# quartet samplers
+
+class SamplerNode(object):
+    label = 'QS1'
+
+
+class SamplerAlignment(object):
+    """Stands in for alignment.Alignment: the gene alignments of 'genes'
+       over the given leaves, every quartet overlapping except those in
+       'nonoverlapping'
+    """
+
+    def __init__(self, leaves, genes, nonoverlapping=()):
+        self.genes = genes
+        self.seqs = dict((gene, dict((leaf, 'ACGT') for leaf in leaves))
+                         for gene in genes)
+        self.nonoverlapping = set(nonoverlapping)
+
+    def check_aln_overlap(self, quartet):
+        return tuple(quartet) not in self.nonoverlapping
+
+
+def sampler_inputs(nreps, genes=('g1', 'g2'), nonoverlapping=()):
+    """Leaf sets (2 x 3 x 1 x 2 leaves), alignment and params for the
+       quartet samplers
+    """
+    from tree_data import LeafRange
+    labels = ['a1', 'a2', 'b1', 'b2', 'b3', 'c1', 'd1', 'd2']
+    leafsets = {'L1': LeafRange(labels, [(0, 2)]),
+                'L2': LeafRange(labels, [(2, 5)]),
+                'R1': LeafRange(labels, [(5, 6)]),
+                'R2': LeafRange(labels, [(6, 8)])}
+    params = {'nreps': nreps, 'verbose': False, 'using_genetrees': True,
+              'compress_patterns': False, 'engine': 'native',
+              'temp_wd': tempfile.gettempdir(),
+              'max_random_sample_proportion': 10}
+    return (leafsets, params,
+            SamplerAlignment(labels, list(genes), nonoverlapping))
+
+
+def sampled_quartets(replicates):
+    return [tuple(rep['seq_names'][x] for x in ('L1', 'L2', 'R1', 'R2')) +
+            (rep['genename'],) for rep in replicates]
+
+
+def check_sampler_permutation():
+    from rep_data import random_permutation
+    for npossible in (0, 1, 2, 7, 1000):
+        assert sorted(random_permutation(npossible)) == list(
+            range(npossible)), npossible
+
+
+def check_sampler_exhaustive():
+    import itertools
+    from rep_data import get_replicates_exhaustive, quartet_axes
+    leafsets, params, aln = sampler_inputs(100)
+    space = list(itertools.product(*quartet_axes(leafsets, params, aln)))
+    assert len(space) == 24
+    # more replicates than quartets: each quartet exactly once
+    with contextlib.redirect_stdout(io.StringIO()):
+        replicates, _ = get_replicates_exhaustive(
+            leafsets, params, aln, SamplerNode())
+    assert sorted(sampled_quartets(replicates)) == sorted(space)
+    # nonoverlapping quartets and those done earlier are left out
+    leafsets, params, aln = sampler_inputs(100, nonoverlapping=space[:3])
+    done = [{'seq_names': dict(zip(('L1', 'L2', 'R1', 'R2'), x[:4])),
+             'genename': x[4]} for x in space[3:8]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        replicates, repstats = get_replicates_exhaustive(
+            leafsets, params, aln, SamplerNode(), done=done)
+    assert sorted(sampled_quartets(replicates)) == sorted(space[8:])
+    assert repstats['nonoverlapping_count'] == 3
+    assert [rep['replicate_id'] for rep in replicates] == [
+        str(x) for x in range(5, 21)]
+    # fewer replicates than quartets: no duplicates
+    leafsets, params, aln = sampler_inputs(10)
+    replicates, _ = get_replicates_exhaustive(
+        leafsets, params, aln, SamplerNode())
+    assert len(set(sampled_quartets(replicates))) == 10
+
+
+def check_sampler_index():
+    import itertools
+    from rep_data import decode_quartet, encode_quartet, quartet_axes
+    for genes in (['g1', 'g2', 'g3'], [None]):
+        leafsets, params, aln = sampler_inputs(10, genes=genes)
+        params['using_genetrees'] = genes != [None]
+        axes = quartet_axes(leafsets, params, aln)
+        axes_index = [dict((item, i) for i, item in enumerate(axis))
+                      for axis in axes]
+        # the indices run through the quartets in product order
+        for index, quartet in enumerate(itertools.product(*axes)):
+            assert decode_quartet(index, axes) == quartet, (index, quartet)
+            assert encode_quartet(quartet, axes_index) == index, quartet
+
+
+def check_sampler_random():
+    from rep_data import get_replicates_random
+    leafsets, params, aln = sampler_inputs(20)
+    for _ in range(20):
+        replicates, _ = get_replicates_random(
+            leafsets, params, aln, SamplerNode())
+        quartets = sampled_quartets(replicates)
+        assert len(quartets) == 20 == len(set(quartets))
+    # quartets done by an earlier run are not drawn again
+    done = [{'seq_names': dict(zip(('L1', 'L2', 'R1', 'R2'), x[:4])),
+             'genename': x[4]} for x in quartets[:12]]
+    replicates, _ = get_replicates_random(
+        leafsets, params, aln, SamplerNode(), done=done)
+    assert len(replicates) == 8
+    assert not set(quartets[:12]).intersection(sampled_quartets(replicates))
+
+
+# complete runs (native engine on the test_native dataset)
+
+PYSRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                     'pysrc')
+# runs quartet_sampling.main, sending itself a SIGTERM once the scheduler
+# has stored argv[1] new replicate results (0: never)
+RUN_DRIVER = """
+import os, signal, sys
+import quartet_sampling, scheduler
+stop_after = int(sys.argv[1])
+store = scheduler.NodeScheduler._store_result
+def counting_store(self, block):
+    ret = store(self, block)
+    if stop_after and self.n_completed >= stop_after and not self.draining:
+        if self.stop_request is not None and not self.stop_request.is_set():
+            os.kill(os.getpid(), signal.SIGTERM)
+    return ret
+scheduler.NodeScheduler._store_result = counting_store
+quartet_sampling.main(sys.argv[2:])
+"""
+
+
+def run_native(run_wd, *args, stop_after=0):
+    """Run quartet_sampling.py on a copy of test_native in run_wd,
+       returns the exit code and the screen output
+    """
+    if not os.path.exists(run_wd):
+        os.mkdir(run_wd)
+        for fname in ('test.phy', 'test.tre'):
+            shutil.copy(os.path.join(os.path.dirname(FIXTURES),
+                                     'test_native', fname), run_wd)
+    proc = subprocess.run(
+        [sys.executable, '-c', RUN_DRIVER, str(stop_after),
+         '--tree', 'test.tre', '--align', 'test.phy', '--threads', '2',
+         '--reps', '100', '--min-overlap', '10', '--lnlike', '2',
+         '--engine', 'native'] + list(args),
+        cwd=run_wd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, env=dict(os.environ, PYTHONPATH=PYSRC))
+    return proc.returncode, proc.stdout
+
+
+def read_scores(fpath, delim=','):
+    """Rows of a result file by node label, numbers as floats"""
+    rows = {}
+    with open(fpath) as infile:
+        header = infile.readline().rstrip('\n').split(delim)
+        for line in infile:
+            row = {}
+            for key, value in zip(header, line.rstrip('\n').split(delim)):
+                try:
+                    row[key] = float(value)
+                except ValueError:
+                    row[key] = value
+            rows[row[header[0]]] = row
+    return header, rows
+
+
+def same_scores(fpath1, fpath2, delim=',', ignore=()):
+    """True if two result files agree in all columns but those in ignore
+       (up to the order in which the replicate results were added)
+    """
+    header1, rows1 = read_scores(fpath1, delim)
+    header2, rows2 = read_scores(fpath2, delim)
+    if header1 != header2 or set(rows1) != set(rows2):
+        return False
+    for label, row in rows1.items():
+        for key in header1:
+            val1, val2 = row[key], rows2[label][key]
+            if key in ignore:
+                continue
+            if isinstance(val1, float) and isinstance(val2, float):
+                if abs(val1 - val2) > 1e-9 * max(1.0, abs(val1)):
+                    return False
+            elif val1 != val2:
+                return False
+    return True
+
+
+def check_native_resume():
+    """A run stopped by a signal and resumed gives the same scores as
+       an uninterrupted run
+    """
+    with tempfile.TemporaryDirectory() as temp_wd:
+        full_wd = os.path.join(temp_wd, 'full')
+        code, out = run_native(full_wd)
+        assert code == 0, out[-500:]
+        resume_wd = os.path.join(temp_wd, 'resume')
+        code, out = run_native(resume_wd, stop_after=20)
+        assert code == 128 + 15, out[-500:]
+        assert os.path.exists(os.path.join(resume_wd, 'RESULT.journal'))
+        code, out = run_native(resume_wd)
+        assert code == 0, out[-500:]
+        assert 'resuming from' in out, out[-500:]
+        assert not os.path.exists(os.path.join(resume_wd, 'RESULT.journal'))
+        # diff and the example topologies come from whichever replicate
+        # of the node finished last
+        assert same_scores(
+            os.path.join(full_wd, 'RESULT.node.scores.csv'),
+            os.path.join(resume_wd, 'RESULT.node.scores.csv'),
+            ignore=('diff',))
+        assert same_scores(
+            os.path.join(full_wd, 'RESULT.node.counts.csv'),
+            os.path.join(resume_wd, 'RESULT.node.counts.csv'),
+            delim='\t', ignore=('topo0', 'topo1', 'topo2'))
+
+
+def check_native_shards():
+    """The scores of --shard 1/2 and 2/2 merged with merge_output.py are
+       those of an unsharded run
+    """
+    with tempfile.TemporaryDirectory() as temp_wd:
+        full_wd = os.path.join(temp_wd, 'full')
+        code, out = run_native(full_wd)
+        assert code == 0, out[-500:]
+        shard_wd = os.path.join(temp_wd, 'shard')
+        for shard in ('1/2', '2/2'):
+            code, out = run_native(shard_wd, '--shard', shard)
+            assert code == 0, out[-500:]
+        _, rows1 = read_scores(
+            os.path.join(shard_wd, 'RESULT.shard1of2.node.scores.csv'))
+        _, rows2 = read_scores(
+            os.path.join(shard_wd, 'RESULT.shard2of2.node.scores.csv'))
+        # every internal node is in exactly one shard
+        assert not set(x for x in rows1 if x.startswith('QS')).intersection(
+            x for x in rows2 if x.startswith('QS'))
+        # --nodedata takes score files and files listing score files
+        with open(os.path.join(shard_wd, 'shards.txt'), 'w') as listfile:
+            listfile.write('RESULT.shard2of2.node.scores.csv\n')
+        proc = subprocess.run(
+            [sys.executable, os.path.join(PYSRC, 'merge_output.py'),
+             '--nodedata', 'RESULT.shard1of2.node.scores.csv', 'shards.txt',
+             '--tree', 'test.tre', '--out', 'MERGED'],
+            cwd=shard_wd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        assert proc.returncode == 0, proc.stdout[-500:]
+        full_path = os.path.join(full_wd, 'RESULT.node.scores.csv')
+        merged_path = os.path.join(shard_wd, 'MERGED.nodes.scores.csv')
+        # merge_output.py rounds qf and writes the missing notes as NA
+        assert same_scores(full_path, merged_path,
+                           ignore=('diff', 'qf', 'notes'))
+        _, full = read_scores(full_path)
+        _, merged = read_scores(merged_path)
+        for label, row in full.items():
+            if row['qf'] != 'NA':
+                assert merged[label]['qf'] == float(
+                    '{:.2g}'.format(row['qf'])), label
+
+
+CHECKS = [check_alignment_formats, check_alignment_cache,
+          check_alignment_parallel, check_tree_reader, check_tree_splits,
+          check_result_cache_shared, check_journal_settings,
+          check_scheduler_order,
+          check_sampler_permutation, check_sampler_exhaustive,
+          check_sampler_index, check_sampler_random,
+          check_native_gamma_rates, check_native_lnlike,
+          check_native_optimum, check_native_raxmlng, check_native_resume,
+          check_native_shards]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        if check.__name__.startswith('check_native'):
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                print("{}: skipped, numpy not found".format(check.__name__))
+                continue
+        try:
+            note = check()
+        except Exception as exc:  # any error fails only this check
+            failed += 1
+            print("{}: FAILED {}: {}".format(check.__name__,
+                                             type(exc).__name__, exc))
+            continue
+        print("{}: {}".format(check.__name__, note or "ok"))
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
@@ -5,3 +5,4 @@ import subprocess
 for name in os.listdir('.'):
     if name[0:4] == 'test':
         subprocess.call('python run_single_test.py ' + name, shell=True)
+subprocess.call('python run_checks.py', shell=True)